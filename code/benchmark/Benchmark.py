@@ -0,0 +1,316 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _package in ('common', 'unwarping', 'face_detection', 'face_to_position', 'servo_control'):
+    sys.path.insert(0, os.path.join(_HERE, '..', _package))
+
+from FaceDetection import FaceDetection
+from ParallelFaceDetection import ParallelFaceDetection
+from FaceToPosition import FaceToPosition
+from FrameSource import open_source
+from ServoBackend import FileBackend
+from ServoControl import ServoControl
+from StageStats import StageStats
+from StageThread import RUNTIMES, start_stage, stop_stage
+from Undistortion import output_camera_matrix
+from Unwarping import Unwarping
+
+
+# --- Parameters of the setup used for benchmarking ---
+# width and height of camera image
+X = 640
+Y = 480
+# focal lengths
+F_X = 673.9683892
+F_Y = 676.08466459
+# center coordinates
+C_X = 343.68638231
+C_Y = 245.31865398
+# distortion coefficients
+D = 5.44787247e-02, 1.23043244e-01, -4.52559581e-04, 5.47011732e-03, -6.83110234e-01
+# face width in mm and fan position relative to the camera in mm
+FACE_WIDTH = 150.0
+FAN_POSITION = (-300.0, 100.0, -150.0)
+# servo pins, slopes and intercepts, update frequency, speed and pwm range
+SERVO = (1, 1.2290352706, 166.3342587025,
+         3, -1.2517764093, 166.7882520133,
+         100, 100, 90, 226)
+
+
+def _cpu_seconds(pid):
+    # User plus system time of a process in seconds, read from /proc
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def _memory_kb(pid):
+    # Proportional set size of a process in kB, memory shared with other processes is split between them.
+    # Falls back to the resident set size on kernels without smaps_rollup
+    for path, key in (('/proc/%d/smaps_rollup' % pid, 'Pss:'), ('/proc/%d/status' % pid, 'VmRSS:')):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(key):
+                        return int(line.split()[1])
+        except (IOError, OSError):
+            continue
+    return None
+
+
+class Benchmark(object):
+    '''
+    Runs the Unwarping -> FaceDetection -> FaceToPosition -> ServoControl
+    chain against a recorded or synthetic source and a fake servo device.
+    The stages run as processes or as threads of this process, see
+    StageThread.
+    '''
+
+    def __init__(self, source, duration=None, paced=True, detection_kwargs=None, workers=1, runtime='processes'):
+        self._source_spec = source
+        self._duration = duration
+        self._paced = paced
+        self._detection_kwargs = detection_kwargs or {}
+
+        # Number of face detection processes, more than one runs ParallelFaceDetection
+        self._workers = workers
+
+        # Processes or threads
+        self._runtime = runtime
+
+    def run(self):
+        # Start-up times are measured from here, including building the stages
+        launch = time.time()
+
+        K = np.array([[F_X, 0., C_X],
+                      [0., F_Y, C_Y],
+                      [0., 0., 1.]])
+
+        # A regular file stands in for /dev/servoblaster
+        handle, device = tempfile.mkstemp(prefix='servoblaster_')
+        os.close(handle)
+
+        # The stages keep their stats away from the ones of a running pipeline and of other runs
+        stats_dir = tempfile.mkdtemp(prefix='autofan_benchmark_')
+
+        # --- Tasks ---
+        source = open_source(self._source_spec, X, Y, paced=self._paced)
+        unwarper = Unwarping(X, Y, K, D, source=source, ring_slots=max(4, self._workers + 2),
+                             stats=StageStats('unwarping', stats_dir))
+        classifier = os.path.join(_HERE, '..', 'face_detection', 'haarcascade_frontalface_alt2.xml')
+        if self._workers > 1:
+            face_detection = ParallelFaceDetection(X, Y, unwarper.get_frame_ring(), workers=self._workers,
+                                                   classifier=classifier, stats=StageStats('face_detection', stats_dir),
+                                                   **self._detection_kwargs)
+        else:
+            face_detection = FaceDetection(X, Y, frame_ring=unwarper.get_frame_ring(), classifier=classifier,
+                                           stats=StageStats('face_detection', stats_dir), **self._detection_kwargs)
+        # ...faces are measured in the unwarped frames, with their camera matrix
+        K_out = output_camera_matrix(X, Y, K, D)
+        face_to_position = FaceToPosition(FACE_WIDTH, X, Y, K_out[0, 0], K_out[1, 1], FAN_POSITION,
+                                          face_record=face_detection.get_face_record(),
+                                          stats=StageStats('face_to_position', stats_dir))
+        servo_control = ServoControl(*SERVO, angle_record=face_to_position.get_angle_record(),
+                                     backend=FileBackend(device), stats=StageStats('servo_control', stats_dir))
+
+        stages = [('unwarping', unwarper),
+                  ('face_detection', face_detection),
+                  ('face_to_position', face_to_position),
+                  ('servo_control', servo_control)]
+
+        # Start the stages in reverse order so every consumer is ready before data arrives
+        running = dict((name, start_stage(stage, self._runtime)) for name, stage in reversed(stages))
+        stages = [(name, running[name]) for name, stage in stages]
+
+        # Every process of the run, with threads only this one
+        pids = set([os.getpid()])
+        for name, stage in stages:
+            pids.add(stage.pid)
+            if hasattr(stage, 'get_worker_pids'):
+                pids.update(stage.get_worker_pids())
+
+        cpu_start = dict((name, _cpu_seconds(stage.pid)) for name, stage in stages)
+        cpu_total_start = dict((pid, _cpu_seconds(pid)) for pid in pids)
+        memory_peak = 0
+        start = time.time()
+
+        # --- Main ---
+        # The stages hand faces and angles on by themselves, wait for the source to run out
+        unwarping = running['unwarping']
+        while unwarping.is_alive():
+            if self._duration is not None and time.time() - start > self._duration:
+                break
+            memory_peak = max(memory_peak, sum(_memory_kb(pid) or 0 for pid in pids))
+            unwarping.join(0.1)
+
+        elapsed = time.time() - start
+        cpu = {}
+        if self._runtime == 'processes':
+            for name, stage in stages:
+                # ...stages that already exited have no accounting left in /proc
+                cpu_end = _cpu_seconds(stage.pid)
+                if cpu_end is not None and cpu_start[name] is not None:
+                    cpu[name] = (cpu_end - cpu_start[name]) / elapsed * 100.0
+        cpu_total = 0.0
+        for pid in pids:
+            cpu_end = _cpu_seconds(pid)
+            if cpu_end is not None and cpu_total_start[pid] is not None:
+                cpu_total += cpu_end - cpu_total_start[pid]
+        cpu['total'] = cpu_total / elapsed * 100.0
+        frames = unwarper.get_frame_ring().latest_sequence()
+        faces = face_detection.get_face_record().version()
+        positions = face_to_position.get_angles_version()
+        dropped = unwarper.get_dropped_frames()
+        latencies = servo_control.get_latencies() * 1000.0
+        startup = self._startup(launch, stats_dir)
+
+        # ...stages that died during the run, only unwarping stops by itself, once the source ran out
+        crashed = [name for name, stage in stages
+                   if not stage.is_alive() and not (name == 'unwarping' and stage.exitcode == 0)]
+
+        for name, stage in stages:
+            stop_stage(stage)
+        shutil.rmtree(stats_dir, ignore_errors=True)
+
+        with open(device) as f:
+            pwm_writes = sum(1 for _ in f)
+        os.remove(device)
+
+        return {
+            'source': str(self._source_spec),
+            'paced': self._paced,
+            'workers': self._workers,
+            'runtime': self._runtime,
+            'processes': len(pids),
+            'memory_mb': memory_peak / 1024.0,
+            'duration': elapsed,
+            'frames': frames,
+            'dropped_frames': dropped,
+            'latency_ms': self._percentiles(latencies),
+            'startup_s': startup,
+            'throughput': {
+                'unwarping': frames / elapsed,
+                'face_detection': faces / elapsed,
+                'face_to_position': positions / elapsed,
+                'servo_control': pwm_writes / elapsed,
+            },
+            'cpu_percent': cpu,
+            'crashed': crashed,
+        }
+
+    @staticmethod
+    def _startup(launch, stats_dir):
+        # Seconds from launch until each stage was set up and until the first frame, face and servo write
+        startup = {}
+        milestones = {'unwarping': 'first_frame', 'face_detection': 'first_face', 'servo_control': 'first_actuation'}
+        for name, milestone in milestones.items():
+            snapshot = StageStats(name, stats_dir, readonly=True).snapshot()
+            if snapshot['ready']:
+                startup[name + '_ready'] = snapshot['ready'] - launch
+            if snapshot['first_output']:
+                startup[milestone] = snapshot['first_output'] - launch
+        return startup
+
+    @staticmethod
+    def _percentiles(samples):
+        if len(samples) == 0:
+            return {'samples': 0}
+        return {
+            'samples': len(samples),
+            'mean': float(np.mean(samples)),
+            'p50': float(np.percentile(samples, 50)),
+            'p95': float(np.percentile(samples, 95)),
+            'p99': float(np.percentile(samples, 99)),
+            'max': float(np.max(samples)),
+        }
+
+
+def _flatten(results, prefix=''):
+    # Flatten nested results into dotted keys with numeric values
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline):
+    '''
+    Return lines comparing every numeric result with a baseline run.
+    '''
+
+    current = _flatten(results)
+    previous = _flatten(baseline)
+    lines = []
+    for key in sorted(set(current) | set(previous)):
+        old = previous.get(key)
+        new = current.get(key)
+        if old is None or new is None:
+            lines.append('%-32s %12s %12s' % (key, old, new))
+        elif old == 0:
+            lines.append('%-32s %12.3f %12.3f' % (key, old, new))
+        else:
+            lines.append('%-32s %12.3f %12.3f %+8.1f%%' % (key, old, new, (new - old) / abs(old) * 100.0))
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the AutoFan pipeline from frame capture to servo write.')
+    parser.add_argument('source', help='video file, image directory, camera id or "synthetic"')
+    parser.add_argument('--duration', type=float, default=None, help='stop after this many seconds')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible instead of paced')
+    parser.add_argument('--workers', type=int, default=1, help='number of face detection processes')
+    parser.add_argument('--runtime', choices=RUNTIMES + ('both',), default='processes',
+                        help='run the stages as processes or threads, or both after another to compare them')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    duration = args.duration
+    if duration is None and args.source == 'synthetic':
+        duration = 30.0
+
+    runtimes = RUNTIMES if args.runtime == 'both' else (args.runtime,)
+    runs = dict((runtime, Benchmark(args.source, duration=duration, paced=not args.fast, workers=args.workers,
+                                    runtime=runtime).run())
+                for runtime in runtimes)
+    # ...the results of both runtimes are kept apart by runtime
+    results = runs if args.runtime == 'both' else runs[args.runtime]
+
+    print json.dumps(results, indent=2, sort_keys=True)
+
+    if args.runtime == 'both':
+        # ...threads side by side with processes
+        print '%-32s %12s %12s %9s' % ('metric', 'processes', 'threads', 'change')
+        for line in compare(runs['threads'], runs['processes']):
+            print line
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print '%-32s %12s %12s %9s' % ('metric', 'baseline', 'current', 'change')
+        for line in compare(results, baseline):
+            print line
+
+    # Results of a run in which a stage died are not comparable, fail instead of reporting them as normal
+    crashed = ['%s (%s)' % (name, runtime) for runtime in runtimes for name in runs[runtime]['crashed']]
+    if crashed:
+        print 'stages died during the run: ' + ', '.join(crashed)
+        sys.exit(1)
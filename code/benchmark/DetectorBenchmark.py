@@ -0,0 +1,263 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _package in ('common', 'unwarping', 'face_detection'):
+    sys.path.insert(0, os.path.join(_HERE, '..', _package))
+
+from Benchmark import Benchmark, compare
+from FaceDetector import create_detector, create_tracker
+from FrameSource import SyntheticFaceSource, open_source
+
+# Backends compared by default, a detector optionally followed by a tracker
+BACKENDS = ('haar', 'lbp', 'hog', 'haar+template', 'lbp+template')
+
+# Smallest overlap of a detected and a labelled face to count as found
+IOU_THRESHOLD = 0.5
+
+
+def iou(a, b):
+    # Intersection over union of two (x, y, w, h) boxes
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    intersection = max(x1 - x0, 0) * max(y1 - y0, 0)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / float(union) if union > 0 else 0.0
+
+
+def match(detected, labelled, threshold=IOU_THRESHOLD):
+    '''
+    Pair detected and labelled faces greedily, best overlap first. Returns
+    the overlaps of the pairs.
+    '''
+
+    pairs = sorted(((iou(d, l), i, j) for i, d in enumerate(detected) for j, l in enumerate(labelled)),
+                   reverse=True)
+    used_detected = set()
+    used_labelled = set()
+    overlaps = []
+    for overlap, i, j in pairs:
+        if overlap < threshold or i in used_detected or j in used_labelled:
+            continue
+        used_detected.add(i)
+        used_labelled.add(j)
+        overlaps.append(overlap)
+    return overlaps
+
+
+def read_labels(path):
+    '''
+    Read the labels of a clip: a CSV file with a "frame,x,y,w,h" row per
+    face, frames counted from 0. Returns {frame: [(x, y, w, h), ...]}, frames
+    without a row have no face.
+    '''
+
+    labels = {}
+    with open(path) as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip().isdigit():
+                # ...skip the header and empty lines
+                continue
+            frame, x, y, w, h = [int(float(v)) for v in row[:5]]
+            labels.setdefault(frame, []).append((x, y, w, h))
+    return labels
+
+
+def find_clips(path):
+    '''
+    Find the labelled clips of a clip set: every video file or image
+    directory in path with a CSV file of the same name next to it.
+    '''
+
+    clips = []
+    for labels in sorted(glob.glob(os.path.join(path, '*.csv'))):
+        base = os.path.splitext(labels)[0]
+        candidates = [base] if os.path.isdir(base) else sorted(glob.glob(base + '.*'))
+        candidates = [c for c in candidates if c != labels]
+        if candidates:
+            clips.append((candidates[0], labels))
+    return clips
+
+
+class SyntheticClip(object):
+    '''
+    A clip of SyntheticFaceSource frames labelled with the face it drew,
+    for trying the benchmark without footage.
+    '''
+
+    def __init__(self, frames=300, face_image=None):
+        self._frames = frames
+        self._face_image = face_image
+
+    def __str__(self):
+        return 'synthetic'
+
+    def frames(self):
+        source = SyntheticFaceSource(paced=False, frames=self._frames, face_image=self._face_image)
+        while True:
+            frame, _ = source.read()
+            if frame is None:
+                break
+            yield frame, [source.last_face]
+
+
+class LabelledClip(object):
+    def __init__(self, path, labels):
+        self._path = path
+        self._labels = read_labels(labels)
+
+    def __str__(self):
+        return os.path.basename(self._path)
+
+    def frames(self):
+        # Frames at their recorded size, so they match the labels
+        source = open_source(self._path, None, None, paced=False)
+        index = 0
+        try:
+            while True:
+                frame, _ = source.read()
+                if frame is None:
+                    break
+                yield frame, self._labels.get(index, [])
+                index += 1
+        finally:
+            source.release()
+
+
+class DetectorBenchmark(object):
+    '''
+    Runs face detector backends over labelled clips and measures their cost
+    (frames per second of detection time, latency per frame) and quality
+    (recall and precision at an IoU of 0.5, mean IoU of the found faces).
+
+    A backend is a detector name, optionally followed by a tracker that
+    runs between detections, e.g. "lbp+template". Frames are searched the
+    way FaceDetection searches them, calling the detector and tracker
+    directly within this process.
+    '''
+
+    def __init__(self, clips, minsize=(60, 60), find_biggest=True, tracker_interval=5):
+        self._clips = clips
+        self._minsize = minsize
+        self._find_biggest = find_biggest
+        self._tracker_interval = tracker_interval
+
+    def run(self, backend):
+        detector_name, _, tracker_name = backend.partition('+')
+
+        # ...load the detector once, e.g. parse its cascade, a missing one raises before any clip
+        detector = create_detector(detector_name)
+
+        latencies = []
+        overlaps = []
+        labelled = 0
+        detected = 0
+        tracked = 0
+
+        for clip in self._clips:
+            # ...a fresh tracker per clip, so no tracker state carries over
+            tracker = create_tracker(tracker_name or None)
+            following = False
+            frames_tracked = 0
+
+            for frame, faces in clip.frames():
+                if frame.ndim == 3:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+                start = time.time()
+
+                # ...follow the face with the tracker between detections, like FaceDetection does
+                found = ()
+                if tracker is not None and following and frames_tracked < self._tracker_interval:
+                    found = tracker.track(frame)
+                if len(found) > 0:
+                    frames_tracked += 1
+                    tracked += 1
+                else:
+                    frames_tracked = 0
+                    found = detector.detect(frame, self._minsize, find_biggest=self._find_biggest)
+                    following = len(found) > 0
+                    if following and tracker is not None:
+                        tracker.start(frame, found[-1])
+
+                latencies.append(time.time() - start)
+
+                overlaps += match(found, faces)
+                labelled += len(faces)
+                detected += len(found)
+
+        matched = len(overlaps)
+        seconds = sum(latencies)
+        return {
+            'frames': len(latencies),
+            'fps': len(latencies) / seconds if seconds > 0 else 0.0,
+            'latency_ms': Benchmark._percentiles(np.array(latencies) * 1000.0),
+            'recall': matched / float(labelled) if labelled else 0.0,
+            'precision': matched / float(detected) if detected else 0.0,
+            'mean_iou': float(np.mean(overlaps)) if overlaps else 0.0,
+            'tracked_frames': tracked,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare face detector backends on labelled footage.')
+    parser.add_argument('clips', help='directory of clips (video files or image directories) with a "frame,x,y,w,h" '
+                                      'CSV file of the same name each, or "synthetic"')
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        help='comma separated backends, a detector optionally followed by "+tracker"')
+    parser.add_argument('--minsize', type=int, default=60, help='smallest face width searched for in pixels')
+    parser.add_argument('--all-faces', action='store_true', help='search for every face, not only the biggest')
+    parser.add_argument('--tracker-interval', type=int, default=5, help='frames tracked between detections')
+    parser.add_argument('--frames', type=int, default=300, help='length of the synthetic clip')
+    parser.add_argument('--face-image', help='photo of a face for the synthetic clip')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    if args.clips == 'synthetic':
+        clips = [SyntheticClip(args.frames, args.face_image)]
+    else:
+        clips = [LabelledClip(path, labels) for path, labels in find_clips(args.clips)]
+        if not clips:
+            parser.error('no labelled clips found in ' + args.clips)
+
+    benchmark = DetectorBenchmark(clips, minsize=(args.minsize, args.minsize), find_biggest=not args.all_faces,
+                                  tracker_interval=args.tracker_interval)
+
+    results = {}
+    for backend in args.backends.split(','):
+        try:
+            results[backend] = benchmark.run(backend)
+        except (IOError, ImportError) as e:
+            # ...a backend this board lacks the cascade or library for
+            print '%s: skipped, %s' % (backend, e)
+
+    print '%-16s %8s %10s %10s %8s %9s %8s' % ('backend', 'fps', 'p50 ms', 'p95 ms', 'recall', 'precision', 'IoU')
+    for backend in sorted(results, key=lambda b: -results[b]['fps']):
+        result = results[backend]
+        latency = result['latency_ms']
+        line = '%-16s %8.1f %10.2f %10.2f %8.3f %9.3f %8.3f' % (
+            backend, result['fps'], latency.get('p50', 0.0), latency.get('p95', 0.0),
+            result['recall'], result['precision'], result['mean_iou'])
+        print line
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print '%-32s %12s %12s %9s' % ('metric', 'baseline', 'current', 'change')
+        for line in compare(results, baseline):
+            print line
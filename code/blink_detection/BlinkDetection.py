@@ -0,0 +1,234 @@
+import collections
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from Records import (BLINK_CLOSED, BLINK_DURATION, BLINK_LONG_CLOSURES, BLINK_OPENNESS, BLINK_PERCLOS,
+                     BLINK_RATE, BLINK_RECORD_SIZE, BLINK_TIMESTAMP,
+                     FACE_H, FACE_TIMESTAMP, FACE_W, FACE_X, FACE_Y)
+from StageStats import StageStats
+from VersionedRecord import VersionedRecord
+
+
+class BlinkDetection(multiprocessing.Process):
+    '''
+    Estimates eye state inside the upper part of the current face box and
+    keeps sliding-window blink statistics.
+
+    Eye openness is measured as the strength of horizontal edges (eyelids,
+    iris, pupil) in the eye region, relative to a slowly adapting baseline of
+    open eyes. It only looks at the face region, and it skips frames whenever
+    the measurement exceeds its time budget, so it never competes with face
+    tracking for more than a fraction of a core.
+    '''
+
+    def __init__(self, frame_ring, face_record, budget=0.004, max_rate=30.0, niceness=10,
+                 eye_region=(0.15, 0.2, 0.85, 0.55), strip_size=(48, 16),
+                 closed_ratio=0.6, blink_duration=(0.05, 0.5), window=60.0, max_face_age=0.5,
+                 tired_blink_rate=25.0, tired_perclos=0.15, blink_record=None, stats=None):
+
+        # Initialize multiprocessing.Process parent
+        multiprocessing.Process.__init__(self)
+
+        # Exit event for stopping process
+        self._exit = multiprocessing.Event()
+
+        # Event that is set while the driver is considered tired
+        self.tired_event = multiprocessing.Event()
+
+        # Inputs: frames and the face published by FaceDetection
+        self._frame_ring = frame_ring
+        self._face_record = face_record
+
+        # Time budget per measured frame in seconds, maximum measurement rate and process niceness
+        self._budget = budget
+        self._min_period = 1.0 / max_rate
+        self._niceness = niceness
+
+        # Eye region relative to the face box (left, top, right, bottom) and the size it is scaled to
+        self._eye_region = eye_region
+        self._strip_size = strip_size
+
+        # Openness below this fraction of the open-eye baseline counts as closed
+        self._closed_ratio = closed_ratio
+
+        # Closures within this range of durations in seconds count as blinks, longer ones as long closures
+        self._blink_duration = blink_duration
+
+        # Length of the sliding window for statistics in seconds
+        self._window = window
+
+        # Faces older than this in seconds are not used
+        self._max_face_age = max_face_age
+
+        # Thresholds for considering the driver tired
+        self._tired_blink_rate = tired_blink_rate
+        self._tired_perclos = tired_perclos
+
+        # A record in shared memory the eye state and blink statistics are published to
+        if blink_record is None:
+            blink_record = VersionedRecord(BLINK_RECORD_SIZE)
+        self._blink_record = blink_record
+
+        # A stats record in shared memory that is updated every measured frame
+        if stats is None:
+            stats = StageStats('blink_detection')
+        self._stats = stats
+
+    def run(self):
+        # Clear events
+        self._exit.clear()
+
+        self._stats.started()
+
+        # Run at a lower priority than the tracking stages
+        if self._niceness:
+            os.nice(self._niceness)
+
+        # Take over the blink record from a predecessor that may have died writing
+        self._blink_record.claim()
+        self._stats.ready()
+
+        # Sequence number of the last frame taken from the frame ring
+        last_sequence = 0
+
+        # Earliest time the next frame may be measured, pushed back when over budget
+        next_time = 0.0
+
+        # Open-eye baseline, current closure start and sliding windows of samples and closures
+        baseline = None
+        closed_since = None
+        samples = collections.deque()   # (timestamp, closed)
+        closures = collections.deque()  # (end timestamp, duration)
+
+        # While exit event is not set...
+        while not self._exit.is_set():
+            slot = self._frame_ring.acquire_latest(last_sequence, timeout=0.1)
+            if slot is None:
+                continue
+
+            try:
+                # ...count frames published since the last one this stage took
+                sequence = self._frame_ring.sequence(slot)
+                if last_sequence:
+                    self._stats.dropped(sequence - last_sequence - 1)
+                self._stats.consumed()
+                last_sequence = sequence
+                timestamp = self._frame_ring.timestamp(slot)
+
+                # ...keep within the rate limit and time budget
+                if timestamp < next_time:
+                    self._stats.skipped()
+                    continue
+
+                # ...only measure with a face from about the same time
+                face = self._face_record.read()[0]
+                if face[FACE_W] <= 0 or abs(timestamp - face[FACE_TIMESTAMP]) > self._max_face_age:
+                    self._stats.skipped()
+                    continue
+
+                start = time.time()
+                openness = self._measure(self._frame_ring.frame(slot), face, self._frame_ring.region(slot))
+            finally:
+                self._frame_ring.release(slot)
+
+            if openness is None:
+                self._stats.skipped()
+                continue
+
+            # ...skip frames in proportion to how far the measurement went over budget
+            elapsed = time.time() - start
+            self._stats.iteration(elapsed)
+            next_time = timestamp + max(self._min_period, self._min_period * elapsed / self._budget)
+
+            # ...adapt the open-eye baseline, quickly upwards and slowly downwards
+            if baseline is None:
+                baseline = openness
+            elif openness > baseline:
+                baseline += 0.2 * (openness - baseline)
+            else:
+                baseline += 0.002 * (openness - baseline)
+
+            closed = openness < self._closed_ratio * baseline
+
+            # ...track closures
+            if closed and closed_since is None:
+                closed_since = timestamp
+            elif not closed and closed_since is not None:
+                closures.append((timestamp, timestamp - closed_since))
+                closed_since = None
+
+            samples.append((timestamp, closed))
+
+            # ...drop samples and closures that left the window
+            while samples and samples[0][0] < timestamp - self._window:
+                samples.popleft()
+            while closures and closures[0][0] < timestamp - self._window:
+                closures.popleft()
+
+            self._publish(timestamp, openness / baseline if baseline else 0.0, closed, samples, closures)
+
+    def _measure(self, frame, face, region=None):
+        # Eye region in the upper part of the face, clipped to the region of the frame that was unwarped
+        if region is None:
+            region = (0, 0, frame.shape[1], frame.shape[0])
+        left, top, right, bottom = self._eye_region
+        x0 = int(max(face[FACE_X] + left * face[FACE_W], region[0]))
+        y0 = int(max(face[FACE_Y] + top * face[FACE_H], region[1]))
+        x1 = int(min(face[FACE_X] + right * face[FACE_W], region[0] + region[2]))
+        y1 = int(min(face[FACE_Y] + bottom * face[FACE_H], region[1] + region[3]))
+        if x1 - x0 < 4 or y1 - y0 < 4:
+            return None
+
+        # ...scale to a fixed size so cost and measure do not depend on the face size
+        strip = cv2.resize(frame[y0:y1, x0:x1], self._strip_size, interpolation=cv2.INTER_AREA)
+
+        # ...horizontal edge strength, normalized by brightness
+        edges = cv2.Sobel(strip, cv2.CV_32F, 0, 1, ksize=3)
+        return float(np.mean(np.abs(edges)) / (np.mean(strip) + 1.0))
+
+    def _publish(self, timestamp, openness, closed, samples, closures):
+        shortest, longest = self._blink_duration
+        blinks = [duration for end, duration in closures if shortest <= duration <= longest]
+
+        # ...rate over the part of the window covered so far
+        span = max(timestamp - samples[0][0], 1.0)
+
+        record = [0.0] * BLINK_RECORD_SIZE
+        record[BLINK_TIMESTAMP] = timestamp
+        record[BLINK_OPENNESS] = openness
+        record[BLINK_CLOSED] = float(closed)
+        record[BLINK_RATE] = len(blinks) * 60.0 / span
+        record[BLINK_DURATION] = float(np.mean(blinks)) if blinks else 0.0
+        record[BLINK_PERCLOS] = sum(1 for t, c in samples if c) / float(len(samples))
+        record[BLINK_LONG_CLOSURES] = sum(1 for end, duration in closures if duration > longest)
+        self._blink_record.write(record)
+        self._stats.output()
+        self._stats.latency(time.time() - timestamp)
+
+        # ...flag fatigue once the window is filled
+        if span >= self._window / 2 and (record[BLINK_RATE] > self._tired_blink_rate or
+                                         record[BLINK_PERCLOS] > self._tired_perclos or
+                                         record[BLINK_LONG_CLOSURES] > 0):
+            self.tired_event.set()
+        else:
+            self.tired_event.clear()
+
+    def terminate(self):
+        # Set exit event
+        self._exit.set()
+
+    def get_blink_record(self):
+        return self._blink_record
+
+    def get_blink_stats(self):
+        return self._blink_record.read()[0]
+
+    def is_tired(self):
+        return self.tired_event.is_set()
@@ -0,0 +1,202 @@
+import math
+
+import numpy as np
+
+
+def lowpass(x, y_old, rc, dt):
+    '''
+    1st order lowpass filter
+    '''
+
+    alpha = float(dt) / (rc + dt)
+    return alpha * x + (1 - alpha) * y_old
+
+
+def highpass(x, x_old, y_old, rc, dt):
+    '''
+    1st order highpass filter
+    '''
+
+    alpha = rc / (rc + float(dt))
+    return alpha * y_old + alpha * (x - x_old)
+
+
+class Filter(object):
+    '''
+    Base of the stateful filters.
+
+    A filter smooths a whole vector per call, e.g. the four coordinates of a
+    face box or the angles of both servo axes. The time step is taken from
+    the timestamps passed to filter(), or given directly to step(). The
+    first value passes through unchanged and sets the state. A value older
+    than the state, or a step of no or negative time, leaves it unchanged.
+    '''
+
+    def __init__(self):
+        self._timestamp = None
+        self._y = None
+
+    def reset(self, x=None, timestamp=None):
+        # Forget the state, or restart at rest at x
+        self._timestamp = timestamp
+        self._y = None if x is None else np.array(x, dtype='float64')
+        if x is not None:
+            self._reset(self._y)
+
+    def filter(self, x, timestamp):
+        # Filter a value captured at timestamp in seconds
+        if self._y is None:
+            # ...the first value sets the state, also if it is older than the timestamp given to reset()
+            self._timestamp = timestamp
+            return self.step(x, 0.0)
+        dt = 0.0 if self._timestamp is None else timestamp - self._timestamp
+        if dt < 0:
+            # ...a value older than the state is dropped
+            return self._y.copy()
+        self._timestamp = timestamp
+        return self.step(x, dt)
+
+    def step(self, x, dt):
+        # Filter a value dt seconds after the last one
+        x = np.asarray(x, dtype='float64')
+        if self._y is None:
+            self._y = x.copy()
+            self._reset(self._y)
+        elif dt > 0:
+            # ...no or negative time would divide by zero or run the filter backwards
+            self._y = self._step(x, float(dt))
+        return self._y.copy()
+
+    @property
+    def value(self):
+        return None if self._y is None else self._y.copy()
+
+    def _reset(self, x):
+        pass
+
+    def _step(self, x, dt):
+        raise NotImplementedError
+
+
+class LowpassFilter(Filter):
+    '''
+    1st order lowpass filter with time constant rc in seconds. The decay
+    over a step is exp(-dt / rc), so the response is the same at any frame
+    rate.
+    '''
+
+    def __init__(self, rc):
+        Filter.__init__(self)
+        self._rc = rc
+
+    def _step(self, x, dt):
+        decay = math.exp(-dt / self._rc)
+        return x + (self._y - x) * decay
+
+
+class HighpassFilter(Filter):
+    '''
+    1st order highpass filter with time constant rc in seconds, the
+    difference of the input and its lowpass filtered value. Its output
+    starts at zero.
+    '''
+
+    def __init__(self, rc):
+        Filter.__init__(self)
+        self._rc = rc
+        self._x = None
+
+    def step(self, x, dt):
+        x = np.asarray(x, dtype='float64')
+        if self._y is None:
+            self._x = x.copy()
+            self._y = np.zeros_like(x)
+        elif dt > 0:
+            self._y = (self._y + x - self._x) * math.exp(-float(dt) / self._rc)
+            self._x = x.copy()
+        return self._y.copy()
+
+    def _reset(self, x):
+        self._x = x.copy()
+        self._y = np.zeros_like(x)
+
+
+class OneEuroFilter(Filter):
+    '''
+    One Euro filter (Casiez et al., CHI 2012): a lowpass filter whose cutoff
+    frequency in Hz grows with the speed of the value, so it smooths jitter
+    at rest and follows fast motion with little lag. min_cutoff sets the
+    smoothing at rest, beta how fast the cutoff grows with speed and
+    d_cutoff the smoothing of the speed estimate.
+    '''
+
+    def __init__(self, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        Filter.__init__(self)
+        self._min_cutoff = min_cutoff
+        self._beta = beta
+        self._d_cutoff = d_cutoff
+        self._dx = None
+
+    def _reset(self, x):
+        self._dx = np.zeros_like(x)
+
+    def _step(self, x, dt):
+        # ...smooth the speed, then smooth the value with a cutoff that follows it
+        self._dx = lowpass((x - self._y) / dt, self._dx, self._rc(self._d_cutoff), dt)
+        cutoff = self._min_cutoff + self._beta * np.abs(self._dx)
+        return lowpass(x, self._y, self._rc(cutoff), dt)
+
+    @staticmethod
+    def _rc(cutoff):
+        return 1.0 / (2 * math.pi * cutoff)
+
+
+class CriticallyDampedFilter(Filter):
+    '''
+    Critically damped 2nd order filter with natural frequency omega in rad/s.
+    The value is pulled towards the input like a spring with just enough
+    damping not to overshoot, so it starts and stops smoothly. The input is
+    held over each step and the step is solved exactly, so the result does
+    not depend on how the time is divided into steps.
+    '''
+
+    def __init__(self, omega):
+        Filter.__init__(self)
+        self._omega = omega
+        self._v = None
+
+    @property
+    def velocity(self):
+        return None if self._v is None else self._v.copy()
+
+    def _reset(self, x):
+        self._v = np.zeros_like(x)
+
+    def _step(self, x, dt):
+        # ...the error decays as (e + (v + omega * e) * t) * exp(-omega * t)
+        e = self._y - x
+        c = self._v + self._omega * e
+        decay = math.exp(-self._omega * dt)
+        self._v = (self._v - self._omega * c * dt) * decay
+        return x + (e + c * dt) * decay
+
+
+# Filters by the name they are configured with
+FILTERS = {
+    'lowpass': LowpassFilter,
+    'highpass': HighpassFilter,
+    'one_euro': OneEuroFilter,
+    'critically_damped': CriticallyDampedFilter,
+}
+
+
+def create_filter(config):
+    '''
+    Create a filter from a config dict, e.g. {"type": "one_euro",
+    "min_cutoff": 1.0, "beta": 0.01}. None creates no filter.
+    '''
+
+    if config is None:
+        return None
+    config = dict(config)
+    return FILTERS[config.pop('type')](**config)
@@ -0,0 +1,299 @@
+import contextlib
+import errno
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import sharedmem
+
+# Most consumers that can hold one slot at the same time and be told apart by reclaim()
+_MAX_HOLDERS = 16
+
+# Seconds between checks for a new frame while a consumer waits for one
+_POLL = 0.001
+
+
+def _alive(pid):
+    # Whether a process exists, also if it belongs to someone else
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class FrameRing(object):
+    '''
+    Fixed-slot ring of frame buffers in shared memory.
+
+    A single producer writes frames in place into a free slot and commits
+    them. Consumers take the newest committed slot, read it in place and
+    release it again. Slots held by a consumer are never overwritten.
+
+    A consumer may ask for a region of the frames only, e.g. the face search
+    window, see request_region(). The producer then may write only that
+    region and commits the region it wrote with the frame. Pixels of a slot
+    outside its region() are left over from older frames and must not be
+    read.
+
+    The ring outlives the processes that use it. Consumers poll for new
+    frames instead of sleeping on a shared condition, which a process
+    killed while waiting would leave broken. The slots a process holds and
+    the lock it holds are noted with its pid, so reclaim() can free them
+    if the process dies.
+    '''
+
+    # Indices into the shared state array
+    _LATEST = 0    # slot holding the newest committed frame (-1 if none)
+    _SEQUENCE = 1  # sequence number of the newest committed frame
+    _WRITING = 2   # slot the producer is currently writing to (-1 if none)
+    _DROPPED = 3   # frames overwritten before any consumer acquired them
+    _STALLED = 4   # writes that found no free slot
+    _OWNER = 5     # pid of the process holding the lock (0 if none)
+
+    def __init__(self, x, y, slots=4, dtype='uint8'):
+        if slots < 2:
+            raise ValueError('A frame ring needs at least two slots')
+
+        self._x = x
+        self._y = y
+        self._slots = slots
+
+        # The frame buffers, one per slot
+        self._frames = sharedmem.empty((slots, y, x), dtype=dtype)
+
+        # Sequence number of the frame held by each slot (0 means empty)
+        self._sequences = sharedmem.zeros(slots, dtype='int64')
+
+        # Capture timestamp of the frame held by each slot
+        self._timestamps = sharedmem.zeros(slots, dtype='float64')
+
+        # Region (x, y, w, h) of each slot that holds pixels of its frame
+        self._regions = sharedmem.zeros((slots, 4), dtype='int32')
+
+        # Region (x, y, w, h) a consumer asked the producer for, a width of 0 asks for whole frames
+        self._request = sharedmem.zeros(4, dtype='int32')
+
+        # Number of consumers currently holding each slot, and their pids
+        self._readers = sharedmem.zeros(slots, dtype='int32')
+        self._holders = sharedmem.zeros((slots, _MAX_HOLDERS), dtype='int64')
+
+        # Whether the frame held by each slot has been acquired at least once
+        self._consumed = sharedmem.zeros(slots, dtype='uint8')
+
+        # Ring state, see the index constants above
+        self._state = sharedmem.zeros(6, dtype='int64')
+        self._state[self._LATEST] = -1
+        self._state[self._WRITING] = -1
+
+        # Lock protecting the slot bookkeeping (never held while copying pixels), see _locked()
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @property
+    def shape(self):
+        return self._y, self._x
+
+    def begin_write(self):
+        '''
+        Reserve a slot for the producer and return its index, or None if
+        every slot is held by a consumer.
+        '''
+
+        with self._locked():
+            latest = self._state[self._LATEST]
+            slot = None
+            for i in range(self._slots):
+                # ...never hand out the newest frame or a slot a consumer holds
+                if i == latest or self._readers[i] > 0:
+                    continue
+                # ...prefer the slot holding the oldest frame
+                if slot is None or self._sequences[i] < self._sequences[slot]:
+                    slot = i
+
+            if slot is None:
+                self._state[self._STALLED] += 1
+                return None
+
+            # ...count the frame about to be overwritten if nobody ever saw it
+            if self._sequences[slot] > 0 and not self._consumed[slot]:
+                self._state[self._DROPPED] += 1
+
+            self._sequences[slot] = 0
+            self._consumed[slot] = 0
+            self._state[self._WRITING] = slot
+
+        return slot
+
+    def commit(self, slot, timestamp=None, region=None):
+        '''
+        Publish a slot previously reserved with begin_write() and return the
+        sequence number assigned to the frame. region is the (x, y, w, h)
+        region the producer wrote, None for the whole frame.
+        '''
+
+        if timestamp is None:
+            timestamp = time.time()
+        if region is None:
+            region = (0, 0, self._x, self._y)
+
+        with self._locked():
+            sequence = self._state[self._SEQUENCE] + 1
+            self._sequences[slot] = sequence
+            self._timestamps[slot] = timestamp
+            self._regions[slot] = region
+            self._state[self._SEQUENCE] = sequence
+            self._state[self._LATEST] = slot
+            self._state[self._WRITING] = -1
+
+        return sequence
+
+    def abort(self, slot):
+        '''
+        Give back a slot reserved with begin_write() without publishing it.
+        '''
+
+        with self._locked():
+            self._state[self._WRITING] = -1
+
+    def acquire_latest(self, last_sequence=0, timeout=None):
+        '''
+        Acquire the newest committed slot if its sequence number is greater
+        than last_sequence. Blocks for up to timeout seconds (forever if
+        None) and returns None if no newer frame arrived in time.
+        '''
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        # ...the sequence number only grows, so it can be watched without the lock
+        while self._state[self._SEQUENCE] <= last_sequence:
+            if timeout is not None and time.time() >= deadline:
+                return None
+            time.sleep(_POLL)
+
+        with self._locked():
+            slot = int(self._state[self._LATEST])
+            self._readers[slot] += 1
+            self._consumed[slot] = 1
+
+            # ...note the holder, a slot held by more consumers than can be noted cannot be reclaimed
+            free = np.flatnonzero(self._holders[slot] == 0)
+            if len(free):
+                self._holders[slot, free[0]] = os.getpid()
+
+        return slot
+
+    def release(self, slot):
+        '''
+        Release a slot acquired with acquire_latest().
+        '''
+
+        with self._locked():
+            self._readers[slot] -= 1
+            held = np.flatnonzero(self._holders[slot] == os.getpid())
+            if len(held):
+                self._holders[slot, held[0]] = 0
+
+    def reclaim(self, pids=None, timeout=1.0):
+        '''
+        Free what processes that died left behind: the slots they held and
+        the lock if they died holding it. pids are the processes that died,
+        by default every holder that no longer exists. Only processes can be
+        reclaimed, the threads of a process share its pid. Returns the
+        number of slot holds freed.
+        '''
+
+        if pids is None:
+            dead = lambda pid: not _alive(pid)
+        else:
+            pids = set(pids)
+            dead = lambda pid: pid in pids
+
+        if not self._lock.acquire(True, timeout):
+            owner = int(self._state[self._OWNER])
+            if not owner or not dead(owner):
+                return 0
+            # ...the owner died holding the lock, release it on its behalf
+            self._state[self._OWNER] = 0
+            self._lock.release()
+            if not self._lock.acquire(True, timeout):
+                return 0
+
+        try:
+            freed = 0
+            for slot in range(self._slots):
+                for i in np.flatnonzero(self._holders[slot]):
+                    if dead(int(self._holders[slot, i])):
+                        self._holders[slot, i] = 0
+                        self._readers[slot] = max(self._readers[slot] - 1, 0)
+                        freed += 1
+            return freed
+        finally:
+            self._lock.release()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Hold the lock and note the holding process, see reclaim()
+        with self._lock:
+            self._state[self._OWNER] = os.getpid()
+            try:
+                yield
+            finally:
+                self._state[self._OWNER] = 0
+
+    def frame(self, slot):
+        # A view into shared memory, valid until the slot is released
+        return self._frames[slot]
+
+    def sequence(self, slot):
+        return int(self._sequences[slot])
+
+    def timestamp(self, slot):
+        return float(self._timestamps[slot])
+
+    def region(self, slot):
+        # Region (x, y, w, h) of the slot that holds pixels of its frame
+        return tuple(int(v) for v in self._regions[slot])
+
+    def complete(self, slot):
+        # Whether the slot holds the whole frame
+        return self.region(slot) == (0, 0, self._x, self._y)
+
+    def request_region(self, region):
+        '''
+        Ask the producer to write only an (x, y, w, h) region of the next
+        frames, None to ask for whole frames again. There is one request
+        for all consumers, so only one of them may make it.
+        '''
+
+        if region is None:
+            self._request[:] = 0
+        else:
+            self._request[:] = [int(round(v)) for v in region]
+
+    def requested_region(self):
+        # Region (x, y, w, h) a consumer asked for, None for whole frames
+        if self._request[2] <= 0 or self._request[3] <= 0:
+            return None
+        return tuple(int(v) for v in self._request)
+
+    def latest_sequence(self):
+        return int(self._state[self._SEQUENCE])
+
+    def latest_frame(self):
+        # Unsynchronized view of the newest frame, for callers that only peek
+        latest = self._state[self._LATEST]
+        if latest < 0:
+            return None
+        return self._frames[latest]
+
+    def dropped(self):
+        return int(self._state[self._DROPPED])
+
+    def stalled(self):
+        return int(self._state[self._STALLED])
@@ -0,0 +1,77 @@
+import time
+
+import sharedmem
+
+# Layout of the shared state: the rate in Hz and the time the next iteration is due
+_RATE, _NEXT = range(2)
+
+
+class RateLimiter(object):
+    '''
+    A rate limit in shared memory, set from another process (e.g. by the
+    governor in the supervisor) and applied by a stage within its loop. A
+    rate of 0 means no limit.
+
+    The schedule is shared as well, so several processes that take turns,
+    e.g. the workers of ParallelFaceDetection claiming frames under a lock,
+    are limited together.
+    '''
+
+    def __init__(self, rate=None):
+        self._data = sharedmem.zeros(2, dtype='float64')
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        # None lifts the limit
+        self._data[_RATE] = max(float(rate or 0.0), 0.0)
+
+    def get_rate(self):
+        return float(self._data[_RATE])
+
+    def period(self):
+        # Time between iterations in seconds, 0 without a limit
+        rate = self._data[_RATE]
+        return 1.0 / rate if rate > 0 else 0.0
+
+    def due(self, now=None):
+        '''
+        Whether an iteration may run at now, claims it if so. For loops
+        that must not wait, e.g. on a camera that delivers frames at its
+        own pace and whose surplus frames are skipped instead.
+        '''
+
+        period = self.period()
+        if period == 0:
+            return True
+        if now is None:
+            now = time.time()
+        if now < self._data[_NEXT]:
+            return False
+        self._claim(now, period)
+        return True
+
+    def wait(self, exit_event=None):
+        '''
+        Wait until the next iteration is due and claim it. Returns False if
+        exit_event was set while waiting.
+        '''
+
+        period = self.period()
+        if period == 0:
+            return True
+        remaining = self._data[_NEXT] - time.time()
+        if remaining > 0:
+            if exit_event is not None:
+                if exit_event.wait(remaining):
+                    return False
+            else:
+                time.sleep(remaining)
+        self._claim(time.time(), period)
+        return True
+
+    def _claim(self, now, period):
+        # Keep to the grid of due times, but start over after falling behind by more than a period
+        if now - self._data[_NEXT] < period:
+            self._data[_NEXT] += period
+        else:
+            self._data[_NEXT] = now + period
@@ -0,0 +1,34 @@
+import numpy as np
+
+# Layout of the face record published by FaceDetection
+FACE_X, FACE_Y, FACE_W, FACE_H, FACE_TIMESTAMP, FACE_MODE = range(6)
+FACE_RECORD_SIZE = 6
+
+# Layout of the detections record published by FaceDetection, every face found in a frame
+DETECTIONS_TIMESTAMP, DETECTIONS_MODE, DETECTIONS_COUNT, DETECTIONS_BOXES = range(4)
+DETECTIONS_MAX = 8  # faces beyond this are not published
+DETECTIONS_RECORD_SIZE = DETECTIONS_BOXES + 4 * DETECTIONS_MAX
+
+# Layout of the record a ParallelFaceDetection worker hands its result over in: the sequence number of the
+# frame, followed by the detections of it in the layout above
+RESULT_SEQUENCE, RESULT_DETECTIONS = range(2)
+RESULT_RECORD_SIZE = RESULT_DETECTIONS + DETECTIONS_RECORD_SIZE
+
+# Layout of the angle record published by FaceToPosition
+ANGLE_HORIZONTAL, ANGLE_VERTICAL, ANGLE_TIMESTAMP = range(3)
+ANGLE_RECORD_SIZE = 3
+
+# Layout of the eye state record published by BlinkDetection
+(BLINK_TIMESTAMP, BLINK_OPENNESS, BLINK_CLOSED, BLINK_RATE, BLINK_DURATION,
+ BLINK_PERCLOS, BLINK_LONG_CLOSURES) = range(7)
+BLINK_RECORD_SIZE = 7
+
+# Kinds and layout of telemetry records, see TelemetryChannel
+TELEMETRY_FACE = 1    # values: x, y, w, h of the face FaceToPosition got, flags: detection mode
+TELEMETRY_ANGLES = 2  # values: horizontal and vertical angle computed by FaceToPosition
+TELEMETRY_SERVO = 3   # values: target angles, filtered angles and pwm of one ServoControl tick, flags: pwm changed
+TELEMETRY_DTYPE = np.dtype([('time', '<f8'),      # when the record was written
+                            ('capture', '<f8'),   # capture timestamp of the frame the record goes back to
+                            ('kind', '<u2'),
+                            ('flags', '<u2'),
+                            ('values', '<f8', (6,))])
@@ -0,0 +1,160 @@
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+# Directory the stats records are kept in, a RAM-backed file system if available
+DEFAULT_STATS_DIR = '/dev/shm/autofan' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(), 'autofan')
+
+# Layout of the fixed-size record header
+_MAGIC, _PID, _ITERATIONS, _CONSUMED, _DROPPED, _LAST_OUTPUT, _LAST_UPDATE, _SKIPPED, \
+    _STARTED, _READY, _FIRST_OUTPUT = range(11)
+_HEADER_SIZE = 16
+_MAGIC_VALUE = 0x4175746f46616e04
+
+# Histograms of iteration times and of latencies in microseconds with 16 linear sub-buckets per power of two
+_SUB_BUCKETS = 16
+_MAX_BITS = 40
+_BUCKETS = (_MAX_BITS - 3) * _SUB_BUCKETS
+
+
+def bucket_index(value):
+    '''
+    Histogram bucket of a non-negative integer value.
+    '''
+
+    value = min(int(value), (1 << _MAX_BITS) - 1)
+    if value < 2 * _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - 5
+    return (shift + 1) * _SUB_BUCKETS + (value >> shift) - _SUB_BUCKETS
+
+
+def bucket_value(index):
+    '''
+    Lowest value that falls into a histogram bucket.
+    '''
+
+    if index < 2 * _SUB_BUCKETS:
+        return index
+    shift = index // _SUB_BUCKETS - 1
+    return (index % _SUB_BUCKETS + _SUB_BUCKETS) << shift
+
+
+def histogram_percentile(histogram, percentile):
+    # Value below which the given percentage of the samples fall
+    total = histogram.sum()
+    if total == 0:
+        return 0
+    index = int(np.searchsorted(np.cumsum(histogram), total * percentile / 100.0))
+    return bucket_value(min(index, len(histogram) - 1))
+
+
+class StageStats(object):
+    '''
+    Fixed-layout statistics record of a pipeline stage in a memory-mapped
+    file, so that other processes (e.g. autofan-top) can attach to it.
+
+    Each record has a single writer, the stage, which updates plain counters
+    without locking. Readers may see a counter a tick out of date, which is
+    fine for monitoring.
+
+    Next to the time each iteration of the stage takes, a stage that knows
+    when its input was captured records the latency from capture to its
+    output, see latency().
+    '''
+
+    def __init__(self, name, directory=DEFAULT_STATS_DIR, readonly=False):
+        self.name = name
+        self.path = os.path.join(directory, name + '.stats')
+
+        size = _HEADER_SIZE + 2 * _BUCKETS
+        if readonly:
+            self._data = np.memmap(self.path, dtype='int64', mode='r', shape=(size,))
+            if self._data[_MAGIC] != _MAGIC_VALUE:
+                raise ValueError('Not a stage stats record: ' + self.path)
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._data = np.memmap(self.path, dtype='int64', mode='w+', shape=(size,))
+            self._data[_MAGIC] = _MAGIC_VALUE
+            self._data[_PID] = os.getpid()
+
+        self._header = self._data[:_HEADER_SIZE]
+        self._histogram = self._data[_HEADER_SIZE:_HEADER_SIZE + _BUCKETS]
+        self._latencies = self._data[_HEADER_SIZE + _BUCKETS:]
+
+    @classmethod
+    def attach_all(cls, directory=DEFAULT_STATS_DIR):
+        # Attach read-only to every record in the directory
+        records = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.stats'))):
+            try:
+                records.append(cls(os.path.basename(path)[:-len('.stats')], directory, readonly=True))
+            except (IOError, OSError, ValueError):
+                pass
+        return records
+
+    def started(self):
+        # Called by the stage from within its process
+        self._header[_PID] = os.getpid()
+        self._header[_STARTED] = int(time.time() * 1e6)
+
+    def ready(self):
+        # The stage finished setting up and starts processing
+        self._header[_READY] = int(time.time() * 1e6)
+
+    def iteration(self, duration):
+        # One loop iteration that took duration seconds
+        self._header[_ITERATIONS] += 1
+        self._histogram[bucket_index(duration * 1e6)] += 1
+        self._header[_LAST_UPDATE] = int(time.time() * 1e6)
+
+    def latency(self, duration):
+        # An output published duration seconds after its input was captured
+        self._latencies[bucket_index(max(duration, 0.0) * 1e6)] += 1
+
+    def consumed(self, count=1):
+        self._header[_CONSUMED] += count
+
+    def dropped(self, count=1):
+        self._header[_DROPPED] += count
+
+    def set_dropped(self, count):
+        self._header[_DROPPED] = count
+
+    def skipped(self, count=1):
+        # Inputs the stage chose not to process, e.g. static frames
+        self._header[_SKIPPED] += count
+
+    def output(self):
+        # The stage published a result
+        now = int(time.time() * 1e6)
+        self._header[_LAST_OUTPUT] = now
+        if not self._header[_FIRST_OUTPUT]:
+            self._header[_FIRST_OUTPUT] = now
+
+    def snapshot(self):
+        return {
+            'pid': int(self._header[_PID]),
+            'iterations': int(self._header[_ITERATIONS]),
+            'consumed': int(self._header[_CONSUMED]),
+            'dropped': int(self._header[_DROPPED]),
+            'skipped': int(self._header[_SKIPPED]),
+            'last_output': self._header[_LAST_OUTPUT] / 1e6,
+            'last_update': self._header[_LAST_UPDATE] / 1e6,
+            'started': self._header[_STARTED] / 1e6,
+            'ready': self._header[_READY] / 1e6,
+            'first_output': self._header[_FIRST_OUTPUT] / 1e6,
+            'histogram': np.array(self._histogram),
+            'latencies': np.array(self._latencies),
+        }
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
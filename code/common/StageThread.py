@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger('autofan.runtime')
+
+# Ways of running the pipeline stages
+RUNTIMES = ('processes', 'threads')
+
+
+class StageThread(threading.Thread):
+    '''
+    Runs a pipeline stage as a thread of the calling process instead of as
+    a process of its own.
+
+    The stage is built exactly as for the process runtime and only its run()
+    is called in the thread, so frames and results are handed on through the
+    same frame ring and records, only without crossing a process boundary.
+    Worker stages of a stage (see ParallelFaceDetection.get_workers()) get a
+    thread each. OpenCV releases the GIL in its heavy calls, so threads can
+    keep up with processes while the interpreter and OpenCV are only loaded
+    once.
+
+    It stands in for the stage towards the supervisor and the benchmark:
+    start(), terminate(), join(), is_alive(), pid and exitcode behave as
+    for a process, everything else is looked up on the stage. is_alive() is
+    true only while the stage and all of its workers run, any_alive() while
+    any of them still does.
+    '''
+
+    def __init__(self, stage, name=None):
+        threading.Thread.__init__(self, name=name or type(stage).__name__)
+
+        # A thread that is left running must not keep the process from exiting
+        self.daemon = True
+
+        self.stage = stage
+        self.exitcode = None
+
+        workers = stage.get_workers() if hasattr(stage, 'get_workers') else []
+        self._workers = [StageThread(worker, '%s.worker%d' % (self.name, i)) for i, worker in enumerate(workers)]
+
+    def __getattr__(self, name):
+        # Only called for attributes the thread does not have itself
+        if name == 'stage':
+            raise AttributeError(name)
+        return getattr(self.stage, name)
+
+    @property
+    def pid(self):
+        return os.getpid() if self.ident is not None else None
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        threading.Thread.start(self)
+
+    def run(self):
+        try:
+            self.stage.run()
+        except Exception:
+            logger.exception('%s failed', self.name)
+            self.exitcode = 1
+        else:
+            self.exitcode = 0
+
+    def terminate(self):
+        # Set the exit event of the stage, threads can only stop by themselves
+        self.stage.terminate()
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def is_alive(self):
+        # The stage is only alive as a whole
+        return threading.Thread.is_alive(self) and all(worker.is_alive() for worker in self._workers)
+
+    def any_alive(self):
+        # Whether any part of the stage still runs, a stage that partly died must not be started again
+        return bool(self.running())
+
+    def running(self):
+        # Names of the threads of the stage that still run
+        return [t.name for t in [self] + self._workers if threading.Thread.is_alive(t)]
+
+    def get_worker_pids(self):
+        return []
+
+
+def start_stage(stage, runtime='processes'):
+    '''
+    Start a stage in the given runtime, returns what stands for the running
+    stage: the stage itself or its StageThread.
+    '''
+
+    if runtime not in RUNTIMES:
+        raise ValueError('Unknown runtime %r, expected one of %s' % (runtime, ', '.join(RUNTIMES)))
+    if runtime == 'threads':
+        stage = StageThread(stage)
+    stage.start()
+    return stage
+
+
+def stop_stage(stage, timeout=2.0):
+    '''
+    Stop a stage started by start_stage(). Stages override terminate() to
+    set their exit event; a process that does not stop in time is killed,
+    and so is every worker process still running, also if the stage died
+    only partly. A thread cannot be killed and is left to the daemon flag.
+    Returns whether the stage stopped, a thread left running must not be
+    started a second time.
+    '''
+
+    stage.terminate()
+    stage.join(timeout)
+    if isinstance(stage, StageThread):
+        # ...a thread is only gone once it and all of its workers are
+        running = stage.running()
+        if running:
+            logger.warning('%s did not stop within %.1f s', ', '.join(running), timeout)
+            return False
+        return True
+
+    # ...kill every process of the stage that is left, is_alive() of a stage is false as soon as one part died
+    workers = stage.get_workers() if hasattr(stage, 'get_workers') else []
+    for process in [stage] + workers:
+        if multiprocessing.Process.is_alive(process):
+            multiprocessing.Process.terminate(process)
+            multiprocessing.Process.join(process)
+    return True
@@ -0,0 +1,87 @@
+import os
+
+# Files the readings are taken from, relative to the root of the sensor tree
+THERMAL_ZONE = 'sys/class/thermal/thermal_zone%d/temp'
+CPU_FREQUENCY = 'sys/devices/system/cpu/cpu%d/cpufreq/scaling_cur_freq'
+CPU_MAX_FREQUENCY = 'sys/devices/system/cpu/cpu%d/cpufreq/cpuinfo_max_freq'
+PROCESS_STAT = 'proc/%d/stat'
+
+
+class SystemSensors(object):
+    '''
+    Reads the CPU temperature and clock from /sys and the CPU time of
+    processes from /proc. A reading that is not available, e.g. a clock on
+    a board without cpufreq or a process that has exited, is None.
+
+    root points at another tree of the same layout instead, e.g. one written
+    by write_sensor_files() to stand in for a board that heats up.
+    '''
+
+    def __init__(self, root='/', thermal_zone=0, cpu=0):
+        self._root = root
+        self._thermal_zone = thermal_zone
+        self._cpu = cpu
+
+        # Clock ticks per second the CPU times in /proc are counted in
+        self._clock_ticks = float(os.sysconf('SC_CLK_TCK')) if hasattr(os, 'sysconf') else 100.0
+
+    def temperature(self):
+        # CPU temperature in degree Celsius, the kernel reports millidegrees
+        value = self._read(THERMAL_ZONE % self._thermal_zone)
+        return None if value is None else int(value) / 1000.0
+
+    def frequency(self):
+        # Current CPU clock in MHz, the kernel reports kHz
+        value = self._read(CPU_FREQUENCY % self._cpu)
+        return None if value is None else int(value) / 1000.0
+
+    def max_frequency(self):
+        value = self._read(CPU_MAX_FREQUENCY % self._cpu)
+        return None if value is None else int(value) / 1000.0
+
+    def cpu_time(self, pid):
+        # User and system CPU time of a process in seconds
+        value = self._read(PROCESS_STAT % pid)
+        if value is None:
+            return None
+        # ...the fields after the command name, which may contain spaces, start with the state
+        fields = value.rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self._clock_ticks
+
+    def _read(self, path):
+        try:
+            with open(os.path.join(self._root, path)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+
+def write_sensor_files(root, temperature=None, frequency=None, max_frequency=None, cpu_times=None,
+                       thermal_zone=0, cpu=0, clock_ticks=100):
+    '''
+    Write readings into a sensor tree for SystemSensors(root): temperature
+    in degree Celsius, clocks in MHz and cpu_times as {pid: seconds}.
+    Readings left at None are not touched, so a test or a script can heat
+    up the board one reading at a time.
+    '''
+
+    files = {}
+    if temperature is not None:
+        files[THERMAL_ZONE % thermal_zone] = '%d' % round(temperature * 1000)
+    if frequency is not None:
+        files[CPU_FREQUENCY % cpu] = '%d' % round(frequency * 1000)
+    if max_frequency is not None:
+        files[CPU_MAX_FREQUENCY % cpu] = '%d' % round(max_frequency * 1000)
+    for pid, seconds in (cpu_times or {}).items():
+        ticks = int(round(seconds * clock_ticks))
+        files[PROCESS_STAT % pid] = '%d (stage) S 1 %d %d 0 -1 0 0 0 0 0 %d 0 0 0 20 0 1 0 0 0 0' % (
+            pid, pid, pid, ticks)
+
+    for path, value in files.items():
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # ...replace the file at once, so a reader never sees it half written
+        with open(path + '.tmp', 'w') as f:
+            f.write(value + '\n')
+        os.rename(path + '.tmp', path)
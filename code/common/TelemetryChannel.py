@@ -0,0 +1,52 @@
+import time
+
+import numpy as np
+import sharedmem
+
+from Records import TELEMETRY_DTYPE
+
+
+class TelemetryChannel(object):
+    '''
+    Ring of telemetry records in shared memory with a single writer.
+
+    Writing a record is a plain store into shared memory, nothing blocks and
+    nothing touches the disk. A TelemetryRecorder drains the ring in the
+    background; records it could not drain before they were overwritten
+    are counted as lost.
+    '''
+
+    def __init__(self, capacity=8192):
+        self._records = sharedmem.empty(capacity, dtype=TELEMETRY_DTYPE)
+
+        # Number of records written so far
+        self._count = sharedmem.zeros(1, dtype='int64')
+
+    def __len__(self):
+        return len(self._records)
+
+    def record(self, kind, capture, values, flags=0, timestamp=None):
+        # Write a record, timestamp defaults to now
+        if timestamp is None:
+            timestamp = time.time()
+        values = tuple(values)
+        self._records[self._count[0] % len(self._records)] = (
+            timestamp, capture, kind, flags, values + (0.0,) * (6 - len(values)))
+        self._count[0] += 1
+
+    def drain(self, read):
+        '''
+        Copy the records written since read records had been drained.
+        Returns the records, the new read count and the number of records
+        that were overwritten before they could be drained.
+        '''
+
+        capacity = len(self._records)
+        count = int(self._count[0])
+        lost = max(count - read - capacity, 0)
+        start = read + lost
+        records = self._records[np.arange(start, count) % capacity]
+
+        # ...records the writer overwrote while they were copied are lost as well
+        overwritten = min(max(int(self._count[0]) - start - capacity, 0), len(records))
+        return records[overwritten:], count, lost + overwritten
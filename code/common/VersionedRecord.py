@@ -0,0 +1,94 @@
+import time
+
+import numpy as np
+import sharedmem
+
+# Spins a reader waits for a write in progress before it starts to sleep between tries
+_SPINS = 1000
+
+# Seconds between checks for a new version while a reader waits for one
+_POLL = 0.001
+
+
+class VersionedRecord(object):
+    '''
+    Fixed-size record of floats in shared memory, published with a sequence
+    lock.
+
+    A single writer publishes whole records, readers always get a consistent
+    copy together with its version number and can block until a version newer
+    than the one they have seen is published. Waiting readers poll the
+    version instead of sleeping on a shared condition, which a reader killed
+    while waiting would leave broken, blocking the writer for good.
+    '''
+
+    def __init__(self, size):
+        # The record values
+        self._data = sharedmem.zeros(size, dtype='float64')
+
+        # Sequence counter, odd while a write is in progress
+        self._sequence = sharedmem.zeros(1, dtype='int64')
+
+    def __len__(self):
+        return len(self._data)
+
+    def write(self, values):
+        # ...check the values before the record is marked, so a bad record cannot leave it marked
+        values = np.asarray(values, dtype='float64')
+        if values.shape != self._data.shape:
+            raise ValueError('A record of %d values cannot hold %s' % (len(self._data), values.shape))
+
+        # Mark the record as being written, store it and mark it consistent again
+        self._sequence[0] += 1
+        try:
+            self._data[:] = values
+        finally:
+            self._sequence[0] += 1
+
+    def read(self):
+        '''
+        Return a consistent copy of the record and its version number.
+        '''
+
+        spins = 0
+        while True:
+            before = self._sequence[0]
+            if before % 2:
+                # ...a write is in progress, back off if it takes long, e.g. its writer died
+                spins += 1
+                time.sleep(0 if spins < _SPINS else 0.001)
+                continue
+
+            values = self._data.copy()
+            if self._sequence[0] == before:
+                return values, int(before // 2)
+
+    def claim(self):
+        '''
+        Called by the writer when it starts. A writer that was killed during
+        a write leaves the record marked as being written, which would keep
+        readers waiting and flip the meaning of the marks for the next one.
+        '''
+
+        if self._sequence[0] % 2:
+            self._sequence[0] += 1
+
+    def version(self):
+        # Number of records published so far
+        return int(self._sequence[0] // 2)
+
+    def wait(self, last_version, timeout=None):
+        '''
+        Block until a version newer than last_version is published. Returns
+        False if none arrived within timeout seconds.
+        '''
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while self.version() <= last_version:
+            if timeout is not None and time.time() >= deadline:
+                return False
+            time.sleep(_POLL)
+
+        return True
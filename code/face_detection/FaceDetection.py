@@ -1,14 +1,42 @@
 import multiprocessing
+import os
+import sys
+import time
 import cv2
+import numpy as np
 import sharedmem
-from Filter import lowpass
+from FaceDetector import create_detector, create_tracker
+from MotionGate import MotionGate
+from ResolutionController import ResolutionController
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from Filter import LowpassFilter, create_filter
+from RateLimiter import RateLimiter
+from Records import (DETECTIONS_BOXES, DETECTIONS_COUNT, DETECTIONS_MAX, DETECTIONS_MODE,
+                     DETECTIONS_RECORD_SIZE, DETECTIONS_TIMESTAMP, FACE_MODE, FACE_RECORD_SIZE, FACE_TIMESTAMP)
+from StageStats import StageStats
+from VersionedRecord import VersionedRecord
+
+
+# Modes that can produce a detection
+MODE_NONE = 0   # no face detected
+MODE_FULL = 1   # full-frame search
+MODE_TRACK = 2  # search window around the last face
+MODE_REUSE = 3  # last detection reused on a static frame
+MODE_TEMPLATE = 4  # face followed by the tracker between detections
 
 
 class FaceDetection(multiprocessing.Process):
     def __init__(self, x, y, scale_factor=1.1, minsize=(60, 60),
                  classifier='haarcascade_frontalface_alt2.xml',
-                 use_lowpass=True, lowpass_rc=50,
-                 visualize=False):
+                 use_lowpass=True, lowpass_rc=0.05, frame_ring=None,
+                 tracking=False, track_margin=0.5, track_scale_range=(0.8, 1.25),
+                 max_misses=3, reacquire_interval=30, face_record=None,
+                 detection_budget=None, motion_threshold=None, motion_max_interval=1.0,
+                 find_biggest=True, detections_record=None, box_filter=None,
+                 detector=None, tracker=None, tracker_interval=5, rate_limiter=None, stats=None,
+                 remap_window=False):
 
         # Initialize multiprocessing.Process parent
         multiprocessing.Process.__init__(self)
@@ -25,111 +53,380 @@ class FaceDetection(multiprocessing.Process):
         # An array in shared memory to store the current image frame
         self._currentframe = sharedmem.empty((y, x), dtype='uint8')
 
+        # An optional frame ring to take frames from in place instead of set_frame()
+        self._frame_ring = frame_ring
+
         # Set camera parameters
         self._x = x
         self._y = y
 
         # Set parameters for face detection algorithm
-        self._scale_factor = scale_factor
         self._minsize = minsize
-        self._classifier_file = classifier
-        self._use_lowpass = use_lowpass
-        self._lowpass_rc = lowpass_rc
-
-        # Defines whether to visualize the camera output
-        self._visualize = visualize
 
-        # A tuple for storing the current width and height of a face
+        # Face detector, by default the Haar cascade. detector configures another one, see
+        # FaceDetector.create_detector(). It is loaded by _setup()
+        if detector is None:
+            detector = {'type': 'haar', 'classifier': classifier, 'scale_factor': scale_factor}
+        self._detector_config = detector
+        self._detector = None
+
+        # Optional tracker that follows the face on up to tracker_interval frames between detections,
+        # see FaceDetector.create_tracker()
+        self._tracker = create_tracker(tracker)
+        self._tracker_interval = tracker_interval
+        self._frames_tracked = 0
+
+        # Temporal filter of the face box, by default a lowpass filter with a time constant in seconds.
+        # box_filter configures another one, see Filter.create_filter()
+        if box_filter is not None:
+            self._box_filter = create_filter(box_filter)
+        elif use_lowpass:
+            self._box_filter = LowpassFilter(lowpass_rc)
+        else:
+            self._box_filter = None
+
+        # Set parameters for tracking mode, which only searches a window around the last face
+        self._tracking = tracking
+        self._track_margin = track_margin  # Enlargement of the window on each side, relative to the face size
+        self._track_scale_range = track_scale_range  # Range of face sizes relative to the last face
+        self._max_misses = max_misses  # Misses in a row before falling back to a full-frame search
+        self._reacquire_interval = reacquire_interval  # Frames between forced full-frame searches
+
+        # Only have the search window unwarped while tracking, see FrameRing.request_region(). The tracker and
+        # the motion gate look beyond the window, so they cannot be combined with it
+        if remap_window and (not tracking or tracker is not None or motion_threshold is not None):
+            raise ValueError('remap_window needs tracking mode without a tracker or motion gate')
+        self._remap_window = remap_window
+
+        # State of the tracking mode, only used within the process
+        self._trackedface = None
+        self._misses = 0
+        self._frames_since_full = 0
+
+        # Optional controller that downscales frames to keep the detection time within a budget in seconds
+        self._resolution = None
+        if detection_budget is not None:
+            self._resolution = ResolutionController(detection_budget)
+
+        # Optional gate that skips the cascade on frames that hardly changed since the last detection
+        self._motion_gate = None
+        if motion_threshold is not None:
+            self._motion_gate = MotionGate(motion_threshold, motion_max_interval)
+
+        # Last detection, reused while the motion gate skips the cascade
+        self._lastdetection = ()
+
+        # A record in shared memory the current face is published to, see FACE_*
+        if face_record is None:
+            face_record = VersionedRecord(FACE_RECORD_SIZE)
+        self._face_record = face_record
+
+        # Only look for the biggest face, otherwise every face is found, e.g. for FaceTracking
+        self._find_biggest = find_biggest
+
+        # An optional record in shared memory every detection result is published to, see DETECTIONS_*
+        self._detections_record = detections_record
+
+        # Optional limit of the detection rate, shared with the workers of a ParallelFaceDetection
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self._rate_limiter = rate_limiter
+
+        # A stats record in shared memory that is updated every iteration
+        if stats is None:
+            stats = StageStats('face_detection')
+        self._stats = stats
+
+        # The current position, width and height of a face
         self._currentface = sharedmem.empty((4, 1), dtype='float')
 
-        # A tuple for storing the last width and height of a face
-        self._lastface = sharedmem.empty((4, 1), dtype='float')
-
-        # Setup a multiscale classifier
-        self._classifier = cv2.CascadeClassifier(self._classifier_file)
-
     def run(self):
         # Clear events
         self._exit.clear()
         self.newface_event.clear()
 
-        # While exit event is not set...
-        while not self._exit.is_set() or not self._pause_event.is_set():
-            # ..clear new face event
-            self.newface_event.clear()
+        self._stats.started()
+        self._claim_records()
+
+        # Set up in this process, in parallel with the other stages
+        self._setup()
+        self._stats.ready()
 
-            # ...try to detect face
-            face = self._detect_face(self._currentframe, self._scale_factor, self._minsize)
-            # ...if face is detected ...
-            if face != ():
-                # ...get boundaries of face in pixels
-                for (x, y, w, h) in face:
+        # ...start over with whole frames, a predecessor may have asked for its search window
+        if self._remap_window and self._frame_ring is not None:
+            self._frame_ring.request_region(None)
 
-                    if self._use_lowpass:
-                        # ...apply temporal lowpass filter to face boundary
-                        self._currentface[0] = lowpass(x, self._lastface[0], self._lowpass_rc, 33.333).copy()
+        # Sequence number of the last frame taken from the frame ring
+        last_sequence = 0
 
-                        self._currentface[1] = lowpass(y, self._lastface[1], self._lowpass_rc, 33.333).copy()
+        # While exit event is not set...
+        while not self._exit.is_set():
+            # ..clear new face event
+            self.newface_event.clear()
 
-                        self._currentface[2] = lowpass(w, self._lastface[2], self._lowpass_rc, 33.333).copy()
+            # ...wait while the detection rate is limited
+            if not self._rate_limiter.wait(self._exit):
+                break
+
+            start = time.time()
+            if self._frame_ring is None:
+                self._process_frame(self._currentframe, start)
+                self._stats.iteration(time.time() - start)
+                continue
+
+            # ...take the newest frame from the ring without copying it
+            slot = self._frame_ring.acquire_latest(last_sequence, timeout=0.1)
+            if slot is None:
+                continue
+
+            try:
+                # ...count frames published since the last one this stage took
+                sequence = self._frame_ring.sequence(slot)
+                if last_sequence:
+                    self._stats.dropped(sequence - last_sequence - 1)
+                self._stats.consumed()
+                last_sequence = sequence
+
+                start = time.time()
+                self._process_frame(self._frame_ring.frame(slot), self._frame_ring.timestamp(slot),
+                                    self._frame_ring.region(slot))
+                self._stats.iteration(time.time() - start)
+            finally:
+                self._frame_ring.release(slot)
+
+    def _claim_records(self):
+        # Take over the records this stage publishes to, from a predecessor that may have died writing
+        self._face_record.claim()
+        if self._detections_record is not None:
+            self._detections_record.claim()
+
+    def _setup(self):
+        # Load the detector, e.g. parse the cascade file
+        if self._detector is None:
+            self._detector = create_detector(self._detector_config)
+
+    def _process_frame(self, frame, timestamp, region=None):
+        # ...a full-frame search needs the whole frame, skip frames that only hold an older search window
+        if region is not None and region != (0, 0, frame.shape[1], frame.shape[0]) and self._full_search_due():
+            self._stats.skipped()
+            self._request_window(frame.shape)
+            return
+
+        # ...reuse the last detection if the frame hardly changed
+        if self._motion_gate is not None and not self._motion_gate.check(frame, timestamp):
+            self._stats.skipped()
+            self._publish_detections(self._lastdetection, MODE_REUSE, timestamp)
+            if len(self._lastdetection) > 0:
+                self._publish_face(self._lastdetection, MODE_REUSE, timestamp)
+            return
+
+        # ...try to detect face, and ask for the window the next search needs
+        face, mode = self._search_face(frame, region)
+        self._request_window(frame.shape)
+        if self._motion_gate is not None:
+            self._motion_gate.update(frame, timestamp, face[-1] if len(face) > 0 else None)
+            self._lastdetection = face
+
+        self._publish_detections(face, mode, timestamp)
+
+        # ...if face is detected ...
+        if len(face) > 0:
+            self._publish_face(face, mode, timestamp)
+
+    def _publish_detections(self, face, mode, timestamp):
+        # Publish all faces of a frame, also when none was found, and note the latency from its capture
+        self._stats.latency(time.time() - timestamp)
+        if self._detections_record is None:
+            return
+
+        record = [0.0] * DETECTIONS_RECORD_SIZE
+        record[DETECTIONS_TIMESTAMP] = timestamp
+        record[DETECTIONS_MODE] = mode
+        record[DETECTIONS_COUNT] = min(len(face), DETECTIONS_MAX)
+        for i, box in enumerate(face[:DETECTIONS_MAX]):
+            record[DETECTIONS_BOXES + 4 * i:DETECTIONS_BOXES + 4 * i + 4] = [float(v) for v in box]
+        self._detections_record.write(record)
+
+    def _publish_face(self, face, mode, timestamp):
+        # ...keep the biggest face, the one closest to the camera
+        if len(face) > 1:
+            face = face[[int(np.argmax(np.asarray(face)[:, 2]))]]
+
+        # ...get boundaries of face in pixels
+        box = np.asarray(face[-1], dtype='float64')
+
+        # ...apply temporal filter to face boundary, with the time between the captures
+        if self._box_filter is not None:
+            box = self._box_filter.filter(box, timestamp)
+
+        # ...copy coordinates into shared memory
+        self._currentface[:, 0] = box
+
+        # ...publish the face together with its capture timestamp and mode
+        self._face_record.write([float(v) for v in self._currentface[:, 0]] + [timestamp, mode])
+        self._stats.output()
+        self.newface_event.set()
+
+    def _search_face(self, frame, region=None):
+        # Follow the face with the tracker between detections
+        if self._tracker is not None and self._trackedface is not None and \
+                self._frames_tracked < self._tracker_interval:
+            face = self._tracker.track(frame)
+            if len(face) > 0:
+                self._frames_tracked += 1
+                self._trackedface = tuple(face[-1])
+                return face, MODE_TEMPLATE
+        self._frames_tracked = 0
+
+        start = time.time()
+
+        # Search the whole frame unless tracking a face that is not due for re-acquisition
+        if self._full_search_due():
+            face = self._detect_face(frame, self._minsize)
+            mode = MODE_FULL
+            self._frames_since_full = 0
+        else:
+            face = self._track_face(frame, region)
+            mode = MODE_TRACK
+            self._frames_since_full += 1
+
+        # Let the resolution controller adapt to the time the detection took
+        if self._resolution is not None:
+            self._resolution.update(time.time() - start, face[-1][2] if len(face) > 0 else None)
+
+        if len(face) > 0:
+            self._trackedface = tuple(face[-1])
+            self._misses = 0
+            if self._tracker is not None:
+                self._tracker.start(frame, face[-1])
+        else:
+            self._misses += 1
+            if mode == MODE_FULL:
+                self._trackedface = None
+            mode = MODE_NONE
+
+        return face, mode
+
+    def _full_search_due(self):
+        # Whether the next search covers the whole frame instead of a window around the tracked face
+        return (not self._tracking or self._trackedface is None or
+                self._misses >= self._max_misses or
+                self._frames_since_full >= self._reacquire_interval)
+
+    def _track_window(self, shape):
+        # Window (x0, y0, x1, y1) around the tracked face, enlarged by the margin and clipped to the frame
+        x, y, w, h = self._trackedface
+        x0 = int(max(x - self._track_margin * w, 0))
+        y0 = int(max(y - self._track_margin * h, 0))
+        x1 = int(min(x + w + self._track_margin * w, shape[1]))
+        y1 = int(min(y + h + self._track_margin * h, shape[0]))
+        return x0, y0, x1, y1
+
+    def _request_window(self, shape):
+        # Ask Unwarping for only the window the next search looks at, or for the whole frame
+        if not self._remap_window or self._frame_ring is None:
+            return
+        if self._full_search_due():
+            self._frame_ring.request_region(None)
+        else:
+            x0, y0, x1, y1 = self._track_window(shape)
+            self._frame_ring.request_region((x0, y0, x1 - x0, y1 - y0))
+
+    def _track_face(self, frame, region=None):
+        x, y, w, h = self._trackedface
+        x0, y0, x1, y1 = self._track_window(frame.shape)
+
+        # ...only search what the frame holds of the window, it may have been unwarped for an older one
+        if region is not None:
+            x0 = max(x0, region[0])
+            y0 = max(y0, region[1])
+            x1 = min(x1, region[0] + region[2])
+            y1 = min(y1, region[1] + region[3])
+            if x1 <= x0 or y1 <= y0:
+                return np.zeros((0, 4), dtype='int32')
+
+        # Only look for faces of about the size of the last one
+        minsize = (int(w * self._track_scale_range[0]), int(h * self._track_scale_range[0]))
+        maxsize = (int(w * self._track_scale_range[1]), int(h * self._track_scale_range[1]))
+
+        face = self._detect_face(frame[y0:y1, x0:x1], minsize, maxsize=maxsize)
+        if len(face) == 0:
+            return face
+
+        # Shift boundaries from window to frame coordinates
+        face = face.copy()
+        face[:, 0] += x0
+        face[:, 1] += y0
+        return face
 
-                        self._currentface[3] = lowpass(h, self._lastface[3], self._lowpass_rc, 33.333).copy()
+    def terminate(self):
+        # Set exit event
+        self._exit.set()
 
-                    else:
-                        # ...copy coordinates into shared memory
-                        self._currentface[0] = x.copy()
-                        self._currentface[1] = y.copy()
-                        self._currentface[2] = w.copy()
-                        self._currentface[3] = h.copy()
+    def _detect_face(self, frame, minsize=(60, 60), maxsize=None):
+        # Downscale the frame if a resolution controller is set
+        scale = 1.0
+        if self._resolution is not None and self._resolution.scale < 1.0:
+            scale = self._resolution.scale
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            minsize = self._resolution.minsize(minsize)
+            maxsize = self._resolution.maxsize(maxsize)
 
-                if self._visualize:
-                    # ...draw a rectangle around the boundaries
-                    cv2.rectangle(self._currentframe,
-                                  (int(self._currentface[0]), int(self._currentface[1])),
-                                  (int(self._currentface[0]) + int(self._currentface[2]),
-                                   int(self._currentface[1]) + int(self._currentface[3])),
-                                  (0, 255, 0), 2)
+        # Detect faces, only the biggest unless every face is wanted
+        face = self._detector.detect(frame, minsize, maxsize, find_biggest=self._find_biggest)
 
-                    # ...display image
-                    cv2.imshow('FaceDetection', self._currentframe)
-                    cv2.waitKey(1)
+        # Scale boundaries back to full resolution
+        if scale < 1.0 and len(face) > 0:
+            face = (face / scale).round().astype(face.dtype)
 
-                self._lastface = self._currentface.copy()
-                self.newface_event.set()
+        return face
 
-        # If exit event set...
-        if self._exit_event.is_set():
-            # ...close windows
-            cv2.destroyAllWindows()
+    def detect(self, frame):
+        '''
+        Search a grayscale frame for faces the way the stage does, within
+        the calling process. Returns the faces, biggest last, and the mode.
+        '''
 
-    def terminate(self):
-        # Set exit event
-        self._exit.set()
+        self._setup()
+        return self._search_face(frame)
 
-    def _detect_face(self, frame, scalefactor=1.1, minsize=(60, 60), flags=(cv2.cv.CV_HAAR_SCALE_IMAGE +
-                                                                            cv2.cv.CV_HAAR_DO_CANNY_PRUNING +
-                                                                            cv2.cv.CV_HAAR_FIND_BIGGEST_OBJECT +
-                                                                            cv2.cv.CV_HAAR_DO_ROUGH_SEARCH)):
-        # Detect face using a multiscale haar classifier
-        face = self._classifier.detectMultiScale(frame,
-                                                 scaleFactor=scalefactor,
-                                                 minSize=minsize,
-                                                 flags=flags)
+    def set_rate(self, rate):
+        # Limit the detection rate in Hz, None for detecting on every new frame
+        self._rate_limiter.set_rate(rate)
 
-        return face
+    def get_rate(self):
+        return self._rate_limiter.get_rate()
 
     def set_frame(self, image):
         self._currentframe[:] = image.copy()
 
     def get_face(self):
-        return self._currentface
+        return self._face_record.read()[0][:4].reshape((4, 1))
+
+    def get_face_timestamp(self):
+        return float(self._face_record.read()[0][FACE_TIMESTAMP])
+
+    def get_face_mode(self):
+        return int(self._face_record.read()[0][FACE_MODE])
+
+    def get_face_record(self):
+        return self._face_record
+
+    def get_detections_record(self):
+        return self._detections_record
+
+    def get_skipped_frames(self):
+        # Frames the motion gate skipped the cascade on
+        return self._stats.snapshot()['skipped']
 
 
 if __name__ == "__main__":
     import sys
 
     sys.path.insert(0, '../unwarping')
+    sys.path.insert(0, '../visualization')
 
+    from DebugView import DebugView
     from Unwarping import Unwarping
     import numpy as np
 
@@ -150,21 +447,18 @@ if __name__ == "__main__":
 
     # --- Tasks ---
     # Start unwarping task
-    unwarper = Unwarping(x, y, K, d, visualize=True, debug=False)
+    unwarper = Unwarping(x, y, K, d, debug=False)
     unwarper.start()
 
-    # Start face detection task
-    face_detection = FaceDetection(x, y, visualize=True)
+    # Start face detection task, reading frames in place from the unwarper's frame ring
+    face_detection = FaceDetection(x, y, frame_ring=unwarper.get_frame_ring())
     face_detection.start()
 
+    # Start the debug view, drawing the detected face on its own copy of the frames
+    debug_view = DebugView(unwarper.get_frame_ring(), face_detection.get_face_record())
+    debug_view.start()
+
     # --- Main ---
     while True:
-        # Wait for new image frame from unwarper
-        unwarper.newframe_event.wait()
-        # Get frame from unwarper
-        unwarped_frame = unwarper.get_current_frame()
-
-        # Pass frame into face detection task
-        face_detection.set_frame(unwarped_frame)
-        # Wait for new face to be detected
-        face_detection.newface_event.wait(0.0333)
+        time.sleep(1)
+        print str(unwarper.get_dropped_frames()) + " frames dropped"
@@ -0,0 +1,256 @@
+import glob
+import os
+
+import cv2
+import numpy as np
+
+# Cascade flags, as named since OpenCV 2.4 instead of the legacy cv2.cv.CV_HAAR_* constants
+CASCADE_DO_CANNY_PRUNING = getattr(cv2, 'CASCADE_DO_CANNY_PRUNING', 1)
+CASCADE_SCALE_IMAGE = getattr(cv2, 'CASCADE_SCALE_IMAGE', 2)
+CASCADE_FIND_BIGGEST_OBJECT = getattr(cv2, 'CASCADE_FIND_BIGGEST_OBJECT', 4)
+CASCADE_DO_ROUGH_SEARCH = getattr(cv2, 'CASCADE_DO_ROUGH_SEARCH', 8)
+
+# Flags the Haar cascade has always been run with
+HAAR_FLAGS = CASCADE_SCALE_IMAGE | CASCADE_DO_CANNY_PRUNING | CASCADE_FIND_BIGGEST_OBJECT | CASCADE_DO_ROUGH_SEARCH
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Directories OpenCV installs its cascades to, on Raspbian and in the pip packages
+_CASCADE_DIRS = [_HERE,
+                 '/usr/share/opencv', '/usr/share/opencv4', '/usr/local/share/OpenCV', '/usr/local/share/opencv4']
+if hasattr(cv2, 'data'):
+    _CASCADE_DIRS.append(cv2.data.haarcascades)
+
+
+def find_cascade(filename):
+    '''
+    Path of a cascade file bundled with this package or OpenCV, searched
+    for in the OpenCV data directories and their haarcascades/lbpcascades
+    subdirectories.
+    '''
+
+    for directory in _CASCADE_DIRS:
+        for path in [os.path.join(directory, filename)] + glob.glob(os.path.join(directory, '*', filename)):
+            if os.path.isfile(path):
+                return path
+    raise IOError('Could not find cascade ' + filename)
+
+
+def _empty():
+    return np.zeros((0, 4), dtype='int32')
+
+
+class FaceDetector(object):
+    '''
+    Base class for face detectors.
+
+    detect() takes a grayscale frame and returns the faces found in it as
+    an array of (x, y, w, h) rows, the biggest face last. maxsize None
+    means no upper limit. With find_biggest, a detector may stop at the
+    biggest face.
+    '''
+
+    def detect(self, frame, minsize=(60, 60), maxsize=None, find_biggest=True):
+        raise NotImplementedError
+
+    @staticmethod
+    def _filter(faces, minsize, maxsize):
+        # Keep faces within the size range and sort them by width, biggest last
+        faces = np.asarray(faces, dtype='int32').reshape((-1, 4))
+        keep = (faces[:, 2] >= minsize[0]) & (faces[:, 3] >= minsize[1])
+        if maxsize:
+            keep &= (faces[:, 2] <= maxsize[0]) & (faces[:, 3] <= maxsize[1])
+        faces = faces[keep]
+        return faces[np.argsort(faces[:, 2], kind='mergesort')]
+
+
+class CascadeDetector(FaceDetector):
+    '''
+    Multiscale cascade classifier, Haar or LBP.
+
+    The cascade is loaded when the detector is built, so a stage fails on
+    start-up and not on its first frame if the file is missing.
+    '''
+
+    def __init__(self, classifier, scale_factor=1.1, min_neighbors=3, flags=CASCADE_SCALE_IMAGE):
+        self._classifier_file = classifier
+        self._classifier = cv2.CascadeClassifier(classifier)
+        if self._classifier.empty():
+            raise IOError('Could not load cascade ' + classifier)
+
+        self._scale_factor = scale_factor
+        self._min_neighbors = min_neighbors
+        self._flags = flags
+
+    def detect(self, frame, minsize=(60, 60), maxsize=None, find_biggest=True):
+        # Return every face unless only the biggest is wanted
+        flags = self._flags
+        if not find_biggest:
+            flags &= ~CASCADE_FIND_BIGGEST_OBJECT
+
+        # ...newer OpenCV versions only take a maximum size that is set
+        kwargs = {'maxSize': tuple(maxsize)} if maxsize else {}
+        faces = self._classifier.detectMultiScale(frame,
+                                                  scaleFactor=self._scale_factor,
+                                                  minNeighbors=self._min_neighbors,
+                                                  minSize=tuple(minsize),
+                                                  flags=flags,
+                                                  **kwargs)
+        if len(faces) == 0:
+            return _empty()
+        return self._filter(faces, minsize, maxsize)
+
+
+class HaarDetector(CascadeDetector):
+    def __init__(self, classifier='haarcascade_frontalface_alt2.xml', scale_factor=1.1, min_neighbors=3,
+                 flags=HAAR_FLAGS):
+        if not os.path.isfile(classifier):
+            classifier = find_cascade(classifier)
+        CascadeDetector.__init__(self, classifier, scale_factor, min_neighbors, flags)
+
+
+class LbpDetector(CascadeDetector):
+    '''
+    OpenCV's LBP frontal face cascade. It works on integer features and is
+    several times faster than the Haar cascade, at a somewhat lower hit
+    rate. The cascade is in the new format, which ignores the search flags.
+    '''
+
+    def __init__(self, classifier='lbpcascade_frontalface.xml', scale_factor=1.1, min_neighbors=3,
+                 flags=CASCADE_SCALE_IMAGE):
+        if not os.path.isfile(classifier):
+            classifier = find_cascade(classifier)
+        CascadeDetector.__init__(self, classifier, scale_factor, min_neighbors, flags)
+
+
+class HogDetector(FaceDetector):
+    '''
+    HOG features with a linear SVM, the frontal face detector of dlib. It is
+    more robust to lighting and slight turns of the head than the cascades,
+    but slower and blind to faces smaller than about 80 pixels unless the
+    frame is upsampled. Needs the optional dlib package.
+    '''
+
+    def __init__(self, upsample=0, threshold=0.0):
+        try:
+            import dlib
+        except ImportError:
+            raise ImportError('The HOG face detector needs dlib (pip install dlib)')
+        self._detector = dlib.get_frontal_face_detector()
+
+        # Times the frame is upsampled to find small faces, and the lowest SVM score of a face
+        self._upsample = upsample
+        self._threshold = threshold
+
+    def detect(self, frame, minsize=(60, 60), maxsize=None, find_biggest=True):
+        rects = self._detector.run(np.ascontiguousarray(frame), self._upsample, self._threshold)[0]
+        if len(rects) == 0:
+            return _empty()
+        faces = [(r.left(), r.top(), r.width(), r.height()) for r in rects]
+        return self._filter(faces, minsize, maxsize)
+
+
+class TemplateTracker(object):
+    '''
+    Follows a face between detections by normalized cross-correlation.
+
+    start() takes the face a detector found as the template. track() then
+    searches a window around the last position for the best match and
+    returns it if it is good enough, otherwise no face, so the caller falls
+    back to detection. Matching a template is much cheaper than a cascade,
+    but it follows the face without checking it still is one and drifts
+    slowly, so it is only meant for a few frames between detections.
+    '''
+
+    def __init__(self, margin=0.5, min_score=0.6, scale=0.5):
+        # Enlargement of the search window on each side, relative to the face size
+        self._margin = margin
+
+        # Lowest correlation of a match
+        self._min_score = min_score
+
+        # Factor frames are downscaled by for matching
+        self._scale = scale
+
+        self._template = None
+        self._face = None
+        self.score = None
+
+    def start(self, frame, face):
+        x, y, w, h = [int(v) for v in face]
+        self._face = (x, y, w, h)
+        self._template = self._resize(frame[y:y + h, x:x + w])
+
+    def stop(self):
+        self._template = None
+        self._face = None
+
+    def track(self, frame):
+        if self._template is None:
+            return _empty()
+
+        x, y, w, h = self._face
+
+        # Search window around the last position, clipped to the frame
+        x0 = int(max(x - self._margin * w, 0))
+        y0 = int(max(y - self._margin * h, 0))
+        x1 = int(min(x + w + self._margin * w, frame.shape[1]))
+        y1 = int(min(y + h + self._margin * h, frame.shape[0]))
+
+        window = self._resize(frame[y0:y1, x0:x1])
+        if window.shape[0] < self._template.shape[0] or window.shape[1] < self._template.shape[1]:
+            self.stop()
+            return _empty()
+
+        scores = cv2.matchTemplate(window, self._template, cv2.TM_CCOEFF_NORMED)
+        _, self.score, _, best = cv2.minMaxLoc(scores)
+        if self.score < self._min_score:
+            self.stop()
+            return _empty()
+
+        self._face = (x0 + int(round(best[0] / self._scale)), y0 + int(round(best[1] / self._scale)), w, h)
+        return np.array([self._face], dtype='int32')
+
+    def _resize(self, image):
+        if self._scale == 1.0:
+            return image.copy()
+        return cv2.resize(image, None, fx=self._scale, fy=self._scale, interpolation=cv2.INTER_AREA)
+
+
+# Detectors and trackers by the name they are configured with
+DETECTORS = {
+    'haar': HaarDetector,
+    'lbp': LbpDetector,
+    'hog': HogDetector,
+}
+
+TRACKERS = {
+    'template': TemplateTracker,
+}
+
+
+def _create(registry, config):
+    if config is None:
+        return None
+    if not isinstance(config, dict):
+        config = {'type': config}
+    config = dict(config)
+    return registry[config.pop('type')](**config)
+
+
+def create_detector(config):
+    '''
+    Create a detector from its name or a config dict, e.g. {"type": "lbp",
+    "min_neighbors": 4}.
+    '''
+
+    return _create(DETECTORS, config)
+
+
+def create_tracker(config):
+    '''
+    Create a tracker from its name or a config dict, e.g. {"type":
+    "template", "min_score": 0.7}. None creates no tracker.
+    '''
+
+    return _create(TRACKERS, config)
@@ -0,0 +1,77 @@
+import cv2
+import numpy as np
+
+
+class MotionGate(object):
+    '''
+    Decides whether a frame is worth running the cascade on.
+
+    The frame is compared with the frame of the last detection on small
+    thumbnails, restricted to the last face and a margin around it if there
+    was one. Below the threshold the scene is taken as static and the last
+    detection can be reused, up to a maximum interval after which the
+    cascade runs anyway.
+    '''
+
+    def __init__(self, threshold=4.0, max_interval=1.0, size=(32, 24), face_margin=0.5):
+
+        # Mean absolute difference in grey levels above which a frame counts as changed
+        self._threshold = threshold
+
+        # Longest time in seconds a detection is reused
+        self._max_interval = max_interval
+
+        # Size of the thumbnails that are compared
+        self._size = size
+
+        # Enlargement of the compared region on each side of the face, relative to the face size
+        self._face_margin = face_margin
+
+        # Thumbnail, region and timestamp of the frame of the last detection
+        self._reference = None
+        self._region = None
+        self._timestamp = None
+
+        # Frames the cascade was skipped on
+        self.skipped = 0
+
+    def check(self, frame, timestamp):
+        '''
+        Return True if the cascade has to run on the frame, False if the
+        last detection can be reused.
+        '''
+
+        if self._reference is None or timestamp - self._timestamp >= self._max_interval:
+            return True
+
+        difference = np.mean(cv2.absdiff(self._thumbnail(frame, self._region), self._reference))
+        if difference >= self._threshold:
+            return True
+
+        self.skipped += 1
+        return False
+
+    def update(self, frame, timestamp, face=None):
+        '''
+        Take the frame the cascade just ran on as the new reference. face is
+        the (x, y, w, h) boundary that was detected, None if none was found.
+        '''
+
+        self._region = None
+        if face is not None:
+            x, y, w, h = face
+            x0 = int(max(x - self._face_margin * w, 0))
+            y0 = int(max(y - self._face_margin * h, 0))
+            x1 = int(min(x + w + self._face_margin * w, frame.shape[1]))
+            y1 = int(min(y + h + self._face_margin * h, frame.shape[0]))
+            if x1 > x0 and y1 > y0:
+                self._region = (x0, y0, x1, y1)
+
+        self._reference = self._thumbnail(frame, self._region)
+        self._timestamp = timestamp
+
+    def _thumbnail(self, frame, region):
+        if region is not None:
+            x0, y0, x1, y1 = region
+            frame = frame[y0:y1, x0:x1]
+        return cv2.resize(frame, self._size, interpolation=cv2.INTER_AREA)
@@ -0,0 +1,281 @@
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import sharedmem
+
+from FaceDetection import FaceDetection, MODE_REUSE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from Records import (DETECTIONS_BOXES, DETECTIONS_COUNT, DETECTIONS_MAX, DETECTIONS_MODE, DETECTIONS_TIMESTAMP,
+                     FACE_W, RESULT_DETECTIONS, RESULT_RECORD_SIZE, RESULT_SEQUENCE)
+from StageStats import StageStats
+from VersionedRecord import VersionedRecord
+
+# Seconds between looks for a new result, or for the collector to take the last one
+_POLL = 0.001
+
+
+class FaceDetectionWorker(FaceDetection):
+    '''
+    One of the detection processes of a ParallelFaceDetection. Workers take
+    turns claiming the newest frame nobody has claimed yet, detect on it in
+    place and hand the raw result to the collector.
+
+    A result is handed over in a record in shared memory of the worker's
+    own, nothing is pickled. The worker holds one result at a time and waits
+    for the collector to take it before it publishes the next one.
+    '''
+
+    def __init__(self, index, x, y, frame_ring, claim_lock, claimed_sequence, claimed, result_record, taken,
+                 **kwargs):
+        FaceDetection.__init__(self, x, y, frame_ring=frame_ring, **kwargs)
+
+        self._index = index
+
+        # Shared claim state: the newest claimed sequence number and the frame each worker works on
+        self._claim_lock = claim_lock
+        self._claimed_sequence = claimed_sequence
+        self._claimed = claimed
+
+        # Record the results are handed to the collector in, see RESULT_*, and the versions the collector took
+        self._result_record = result_record
+        self._taken = taken
+
+    def run(self):
+        # Clear events
+        self._exit.clear()
+
+        self._stats.started()
+
+        # Set up in this process, in parallel with the other workers and stages
+        self._setup()
+        self._stats.ready()
+
+        # Version of the published face the tracking window was last taken from
+        face_version = 0
+
+        # While exit event is not set...
+        while not self._exit.is_set():
+            slot, skipped = self._claim()
+            if slot is None:
+                continue
+
+            try:
+                sequence = self._frame_ring.sequence(slot)
+                timestamp = self._frame_ring.timestamp(slot)
+                self._stats.dropped(skipped)
+                self._stats.consumed()
+
+                # ...track around the published face, it is newer than what this worker saw last
+                if self._tracking:
+                    record, version = self._face_record.read()
+                    if version != face_version and record[FACE_W] > 0:
+                        self._trackedface = tuple(record[:4])
+                        face_version = version
+
+                start = time.time()
+                frame = self._frame_ring.frame(slot)
+                if self._motion_gate is not None and not self._motion_gate.check(frame, timestamp):
+                    # ...reuse this worker's last detection on a static frame
+                    self._stats.skipped()
+                    face, mode = self._lastdetection, MODE_REUSE
+                else:
+                    face, mode = self._search_face(frame)
+                    if self._motion_gate is not None:
+                        self._motion_gate.update(frame, timestamp, face[-1] if len(face) > 0 else None)
+                        self._lastdetection = face
+                self._stats.iteration(time.time() - start)
+            finally:
+                self._frame_ring.release(slot)
+
+            self._hand_over(sequence, timestamp, face, mode)
+
+    def _hand_over(self, sequence, timestamp, face, mode):
+        record = [0.0] * RESULT_RECORD_SIZE
+        record[RESULT_SEQUENCE] = sequence
+        record[RESULT_DETECTIONS + DETECTIONS_TIMESTAMP] = timestamp
+        record[RESULT_DETECTIONS + DETECTIONS_MODE] = mode
+
+        # ...keep the widest faces if there are more than fit, the collector publishes the widest one
+        if len(face) > DETECTIONS_MAX:
+            face = np.asarray(face)
+            face = face[np.sort(np.argsort(face[:, 2])[-DETECTIONS_MAX:])]
+        record[RESULT_DETECTIONS + DETECTIONS_COUNT] = len(face)
+        boxes = RESULT_DETECTIONS + DETECTIONS_BOXES
+        for i, box in enumerate(face):
+            record[boxes + 4 * i:boxes + 4 * i + 4] = [float(v) for v in box]
+
+        # ...wait until the collector took the last result
+        while self._taken[self._index] < self._result_record.version():
+            if self._exit.is_set():
+                return
+            time.sleep(_POLL)
+        self._result_record.write(record)
+
+    def _claim(self):
+        # Claim the newest frame no other worker has claimed, returns the slot and the number of skipped frames
+        if not self._claim_lock.acquire(True, 0.1):
+            return None, 0
+
+        try:
+            # ...the detection rate limit is shared by all workers, so wait for it holding the claim
+            if not self._rate_limiter.wait(self._exit):
+                return None, 0
+
+            last = self._claimed_sequence.value
+            slot = self._frame_ring.acquire_latest(last, timeout=0.1)
+            if slot is None:
+                return None, 0
+
+            sequence = self._frame_ring.sequence(slot)
+            self._claimed_sequence.value = sequence
+            self._claimed[self._index] = sequence
+        finally:
+            self._claim_lock.release()
+
+        return slot, sequence - last - 1 if last else 0
+
+
+class ParallelFaceDetection(FaceDetection):
+    '''
+    Face detection spread over several worker processes.
+
+    Each worker claims the newest unclaimed frame from the frame ring, so
+    frames are handed out in turn to whichever worker is free. This process
+    collects the results in a reorder buffer and publishes them in frame
+    order: a result is held back while a worker is still busy with an older
+    frame, and a result that arrives after a newer frame has been published
+    is dropped. Smoothing is applied here, on the ordered results.
+
+    The frame ring needs a slot per worker plus two for the producer.
+    '''
+
+    def __init__(self, x, y, frame_ring, workers=2, max_hold=0.5, **kwargs):
+        if kwargs.get('remap_window'):
+            raise ValueError('remap_window needs a single detection process, the workers search different windows')
+        if frame_ring.slots < workers + 2:
+            raise ValueError('A frame ring of %d slots is too small for %d workers' % (frame_ring.slots, workers))
+
+        FaceDetection.__init__(self, x, y, frame_ring=frame_ring, **kwargs)
+
+        # Longest time in seconds a result is held back waiting for results of older frames
+        self._max_hold = max_hold
+
+        # Shared claim state of the workers
+        claim_lock = multiprocessing.Lock()
+        claimed_sequence = multiprocessing.Value('q', 0, lock=False)
+        self._claimed = sharedmem.zeros(workers, dtype='int64')
+
+        # Records the workers hand their results over in, and the version of each the collector took
+        self._result_records = [VersionedRecord(RESULT_RECORD_SIZE) for i in range(workers)]
+        self._taken = sharedmem.zeros(workers, dtype='int64')
+
+        # ...workers report to the collector only, it publishes the detections, and share its rate limit
+        # ...their stats records go next to the collector's
+        stats_dir = os.path.dirname(self._stats.path)
+        kwargs.pop('stats', None)
+        kwargs.pop('detections_record', None)
+        kwargs.pop('rate_limiter', None)
+        self._workers = [FaceDetectionWorker(i, x, y, frame_ring, claim_lock, claimed_sequence, self._claimed,
+                                             self._result_records[i], self._taken, face_record=self._face_record,
+                                             rate_limiter=self._rate_limiter,
+                                             stats=StageStats('face_detection.worker%d' % i, stats_dir), **kwargs)
+                         for i in range(workers)]
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        FaceDetection.start(self)
+
+    def run(self):
+        # Clear events
+        self._exit.clear()
+        self.newface_event.clear()
+
+        # ...the collector has nothing to set up, its workers report their own start-up
+        self._stats.started()
+        self._claim_records()
+        self._stats.ready()
+
+        # Results waiting for older frames, by sequence number: (arrival, timestamp, face, mode)
+        pending = {}
+
+        # Sequence number of the newest published result
+        last_published = 0
+
+        # While exit event is not set...
+        while not self._exit.is_set():
+            start = time.time()
+
+            # ...take the results the workers handed over since the last look
+            received = False
+            for i, record in enumerate(self._result_records):
+                if record.version() <= self._taken[i]:
+                    continue
+                values, self._taken[i] = record.read()
+                received = True
+
+                sequence = int(values[RESULT_SEQUENCE])
+                detections = values[RESULT_DETECTIONS:]
+                count = int(detections[DETECTIONS_COUNT])
+                face = detections[DETECTIONS_BOXES:DETECTIONS_BOXES + 4 * count].reshape((count, 4)).astype('int32')
+                self._stats.consumed()
+                if sequence <= last_published:
+                    # ...arrived after a newer frame was published
+                    self._stats.dropped()
+                else:
+                    pending[sequence] = (time.time(), float(detections[DETECTIONS_TIMESTAMP]), face,
+                                         int(detections[DETECTIONS_MODE]))
+
+            # ...release results in frame order
+            published = False
+            now = time.time()
+            for sequence in sorted(pending):
+                arrival, timestamp, face, mode = pending[sequence]
+
+                # ...hold back while a worker is still busy with an older frame
+                busy = [s for s in self._claimed if last_published < s < sequence and s not in pending]
+                if busy and now - arrival < self._max_hold:
+                    break
+
+                del pending[sequence]
+                last_published = sequence
+                published = True
+                self._publish_detections(face, mode, timestamp)
+                if len(face) > 0:
+                    self._publish_face(face, mode, timestamp)
+
+            # ...time the passes that took or published a result, idle passes only poll
+            if received or published:
+                self._stats.iteration(time.time() - start)
+            else:
+                time.sleep(_POLL)
+
+    def terminate(self):
+        # Set exit events of the collector and all workers
+        self._exit.set()
+        for worker in self._workers:
+            worker.terminate()
+
+    def join(self, timeout=None):
+        FaceDetection.join(self, timeout)
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def is_alive(self):
+        # The stage is only alive as a whole
+        return FaceDetection.is_alive(self) and all(worker.is_alive() for worker in self._workers)
+
+    def any_alive(self):
+        # Whether the collector or any worker still runs, what is left of a stage that partly died
+        return FaceDetection.is_alive(self) or any(worker.is_alive() for worker in self._workers)
+
+    def get_workers(self):
+        return list(self._workers)
+
+    def get_worker_pids(self):
+        return [worker.pid for worker in self._workers]
@@ -0,0 +1,91 @@
+class ResolutionController(object):
+    '''
+    Chooses the factor frames are downscaled by before detection so that the
+    detection time per frame stays within a budget.
+
+    Detection time grows with the number of pixels, so the scale is adjusted
+    by the square root of the ratio between budget and measured time. The
+    last measured face width limits how far frames are shrunk, so the face
+    stays well above the size of the cascade's detection window, and raises
+    the minimum face size that is searched for.
+    '''
+
+    def __init__(self, budget, window=(20, 20), min_scale=0.2, max_scale=1.0,
+                 face_margin=2.0, face_minsize_ratio=0.5, max_misses=5):
+
+        # Detection time budget per frame in seconds
+        self._budget = budget
+
+        # Size of the cascade's detection window in pixels
+        self._window = window
+
+        # Range of scales frames are detected at
+        self._min_scale = min_scale
+        self._max_scale = max_scale
+
+        # Smallest face width at the detection scale, relative to the detection window
+        self._face_margin = face_margin
+
+        # Smallest face searched for, relative to the last face width
+        self._face_minsize_ratio = face_minsize_ratio
+
+        # Misses in a row after which the last face width no longer guides the scale
+        self._max_misses = max_misses
+
+        self.scale = max_scale
+        self._facewidth = None
+        self._misses = 0
+
+    def update(self, detection_time, face_width=None):
+        '''
+        Adjust the scale after a detection that took detection_time seconds
+        on a frame scaled by the current scale. face_width is the width of
+        the detected face in full resolution pixels, None if none was found.
+        '''
+
+        if face_width is not None:
+            self._facewidth = float(face_width)
+            self._misses = 0
+        else:
+            self._misses += 1
+            if self._misses >= self._max_misses:
+                self._facewidth = None
+
+        scale = self.scale
+        if detection_time > self._budget:
+            # ...shrink frames in proportion to the overshoot
+            scale *= (self._budget / detection_time) ** 0.5
+        elif detection_time < 0.7 * self._budget:
+            # ...grow back slowly while there is time to spare
+            scale *= 1.1
+
+        self.scale = min(max(scale, self._lowest_scale()), self._max_scale)
+        return self.scale
+
+    def minsize(self, minsize):
+        '''
+        Minimum face size at the detection scale for a minimum face size
+        requested at full resolution.
+        '''
+
+        width = minsize[0] * self.scale
+        height = minsize[1] * self.scale
+
+        # ...no need to look for faces much smaller than the last one
+        if self._facewidth is not None:
+            width = max(width, self._facewidth * self._face_minsize_ratio * self.scale)
+            height = max(height, self._facewidth * self._face_minsize_ratio * self.scale)
+
+        return int(max(width, self._window[0])), int(max(height, self._window[1]))
+
+    def maxsize(self, maxsize):
+        # Maximum face size at the detection scale, () means unlimited
+        if not maxsize:
+            return maxsize
+        return int(maxsize[0] * self.scale), int(maxsize[1] * self.scale)
+
+    def _lowest_scale(self):
+        # Do not shrink the last face below the margin above the detection window
+        if self._facewidth is None:
+            return self._min_scale
+        return min(max(self._min_scale, self._face_margin * self._window[0] / self._facewidth), self._max_scale)
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from Geometry import axis_geometry
+
+
+# Default location for cached angle tables
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'autofan')
+
+
+class AngleTable(object):
+    '''
+    Precomputed fan angles for quantized face centers and sizes.
+
+    The horizontal angle only depends on the horizontal face center and the
+    face width, the vertical angle only on the vertical face center and the
+    face height, so each axis gets its own 2D table. Lookups interpolate
+    bilinearly. Tables are cached on disk, keyed by a hash of the camera and
+    fan geometry.
+    '''
+
+    # Bump whenever the layout of the cached tables changes
+    _CACHE_VERSION = 1
+
+    def __init__(self, face_width, res_x, res_y, f_x, f_y, fan_position,
+                 size_range=(20, 480), center_step=4, size_step=2, cache_dir=None):
+
+        self._facewidth = face_width
+        self._res_x = res_x
+        self._res_y = res_y
+        self._f_x = f_x
+        self._f_y = f_y
+        self._fan_position = tuple(float(p) for p in fan_position)
+
+        # Quantization of face centers and sizes in pixels
+        self._size_min = float(size_range[0])
+        self._size_max = float(size_range[1])
+        self._center_step = float(center_step)
+        self._size_step = float(size_step)
+
+        self._cache_dir = cache_dir
+
+        self._horizontal, self._vertical = self._load_tables()
+
+    @property
+    def horizontal(self):
+        # Horizontal angles in degree, indexed by [face width, face center x]
+        return self._horizontal
+
+    @property
+    def vertical(self):
+        # Vertical angles in degree, indexed by [face height, face center y]
+        return self._vertical
+
+    def cache_key(self):
+        digest = hashlib.sha1()
+        digest.update(np.array([self._facewidth, self._res_x, self._res_y, self._f_x, self._f_y] +
+                               list(self._fan_position) +
+                               [self._size_min, self._size_max, self._center_step, self._size_step,
+                                self._CACHE_VERSION], dtype='float64').tobytes())
+        return digest.hexdigest()
+
+    def lookup(self, x, y, w, h):
+        '''
+        Interpolated (horizontal, vertical) angles in degree for face boxes.
+        Accepts scalars or arrays.
+        '''
+
+        horizontal = self._interpolate(self._horizontal, np.asarray(x, dtype='float64') + np.asarray(w) / 2.0, w)
+        vertical = self._interpolate(self._vertical, np.asarray(y, dtype='float64') + np.asarray(h) / 2.0, h)
+        return horizontal, vertical
+
+    def reachable(self):
+        '''
+        Angle limits over the whole table and the fraction of face positions
+        for which no angle exists.
+        '''
+
+        limits = {}
+        for name, table in (('horizontal', self._horizontal), ('vertical', self._vertical)):
+            valid = np.isfinite(table)
+            limits[name] = {
+                'min': float(np.min(table[valid])) if valid.any() else float('nan'),
+                'max': float(np.max(table[valid])) if valid.any() else float('nan'),
+                'unreachable': float(1.0 - valid.mean()),
+            }
+        return limits
+
+    def _interpolate(self, table, center, size):
+        # Fractional table indices, clipped to the table
+        i = np.clip((np.asarray(size, dtype='float64') - self._size_min) / self._size_step, 0, table.shape[0] - 1)
+        j = np.clip(center / self._center_step, 0, table.shape[1] - 1)
+
+        i0 = np.minimum(np.floor(i).astype('intp'), table.shape[0] - 2)
+        j0 = np.minimum(np.floor(j).astype('intp'), table.shape[1] - 2)
+        di = i - i0
+        dj = j - j0
+
+        return ((1 - di) * ((1 - dj) * table[i0, j0] + dj * table[i0, j0 + 1]) +
+                di * ((1 - dj) * table[i0 + 1, j0] + dj * table[i0 + 1, j0 + 1]))
+
+    def _grid(self, res):
+        sizes = np.arange(self._size_min, self._size_max + self._size_step / 2, self._size_step)
+        centers = np.arange(0, res + self._center_step / 2, self._center_step)
+        return np.meshgrid(sizes, centers, indexing='ij')
+
+    def _build_tables(self):
+        # Evaluate the geometry for every quantized face center and size at once
+        sizes, centers = self._grid(self._res_x)
+        horizontal = axis_geometry(centers, sizes, self._res_x, self._f_x, self._facewidth,
+                                   self._fan_position[0], self._fan_position[1])[3]
+
+        # ...the vertical axis works on the flipped face height
+        sizes, centers = self._grid(self._res_y)
+        vertical = axis_geometry(centers, -sizes, self._res_y, self._f_y, self._facewidth,
+                                 self._fan_position[2], self._fan_position[1])[3]
+
+        return np.degrees(horizontal), np.degrees(vertical)
+
+    def _load_tables(self):
+        path = None
+        if self._cache_dir is not None:
+            path = os.path.join(self._cache_dir, 'angles_' + self.cache_key() + '.npz')
+
+            # ...try to reuse cached tables
+            try:
+                with np.load(path) as cached:
+                    return cached['horizontal'], cached['vertical']
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+        horizontal, vertical = self._build_tables()
+
+        if path is not None:
+            self._save_tables(path, horizontal, vertical)
+
+        return horizontal, vertical
+
+    def _save_tables(self, path, horizontal, vertical):
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+
+            # ...write to a temporary file first so readers never see a partial cache
+            handle, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.npz')
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, horizontal=horizontal, vertical=vertical)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
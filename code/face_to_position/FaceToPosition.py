@@ -1,12 +1,25 @@
 import multiprocessing
+import os
+import sys
+import time
 import numpy as np
-from matplotlib import pyplot as plt
 
-import sharedmem
+from AngleTable import AngleTable, DEFAULT_CACHE_DIR
+from Geometry import face_geometry
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from Records import (ANGLE_HORIZONTAL, ANGLE_RECORD_SIZE, ANGLE_TIMESTAMP, ANGLE_VERTICAL,
+                     FACE_H, FACE_MODE, FACE_RECORD_SIZE, FACE_TIMESTAMP, FACE_W, FACE_X, FACE_Y,
+                     TELEMETRY_ANGLES, TELEMETRY_FACE)
+from StageStats import StageStats
+from VersionedRecord import VersionedRecord
 
 
 class FaceToPosition(multiprocessing.Process):
-    def __init__(self, face_width, res_x, res_y, f_x, f_y, fan_position, visualize=False):
+    def __init__(self, face_width, res_x, res_y, f_x, f_y, fan_position,
+                 use_angle_table=False, angle_table_cache_dir=DEFAULT_CACHE_DIR,
+                 face_record=None, angle_record=None, telemetry=None, stats=None):
 
         # Initialize multiprocessing.Process parent
         multiprocessing.Process.__init__(self)
@@ -17,11 +30,23 @@ class FaceToPosition(multiprocessing.Process):
         # Event that is set, everytime a new servo angle position has been computed
         self.newposition_event = multiprocessing.Event()
 
-        # An array in shared memory for storing the current face position
-        self._currentface = sharedmem.empty((4, 1), dtype='int16')
+        # A record in shared memory holding the current face, e.g. the one published by FaceDetection
+        if face_record is None:
+            face_record = VersionedRecord(FACE_RECORD_SIZE)
+        self._face_record = face_record
+
+        # A record in shared memory the current position angles are published to
+        if angle_record is None:
+            angle_record = VersionedRecord(ANGLE_RECORD_SIZE)
+        self._angle_record = angle_record
 
-        # An array in shared memory for storing the current position angles
-        self._currentangles = sharedmem.empty((2, 1), dtype='float')
+        # An optional telemetry channel every face and the angles computed for it are recorded to
+        self._telemetry = telemetry
+
+        # A stats record in shared memory that is updated every iteration
+        if stats is None:
+            stats = StageStats('face_to_position')
+        self._stats = stats
 
         self._facewidth = face_width
         self._res_x = res_x
@@ -30,145 +55,118 @@ class FaceToPosition(multiprocessing.Process):
         self._f_y = f_y
         self._fan_position = fan_position
 
-        # Defines whether to visualize the servo angles position
-        self._visualize = visualize
+        # Optional table of precomputed angles, looked up instead of computing the geometry, loaded by _setup()
+        self._use_angle_table = use_angle_table
+        self._angle_table_cache_dir = angle_table_cache_dir
+        self._angle_table = None
 
     def run(self):
         # Clear events
         self._exit.clear()
         self.newposition_event.clear()
 
-        if self._visualize:
-            # Interactive plotting mode
-            plt.ion()
-            f, axarray = plt.subplots(2, 1)
-            f.subplots_adjust(hspace=.5)
-
-
-        # While exit event is not set...
-        while not self._exit.is_set():
-            # ..clear new face event
-            self.newposition_event.clear()
-
-            # ...get face parameters
-            x = np.float64(self._currentface[0])
-            y = np.float64(self._currentface[1])
-            w = np.float64(self._currentface[2])
-            h = np.float64(self._currentface[3])
-
-            # ...flip y coordinate
-            #y = h - y
-            h = -h
+        self._stats.started()
 
-            # ...compute position of face center
-            face_center = [x + w / 2, y - h / 2]
+        # Take over the angle record from a predecessor that may have died writing
+        self._angle_record.claim()
 
-            # ...compute distances from camera to face in mm
-            c1_horizontal = self._facewidth * self._f_x / w
-            c1_vertical = self._facewidth * self._f_y / h
+        # Set up in this process, in parallel with the other stages
+        self._setup()
+        self._stats.ready()
 
-            # ...compute face distances from camera center
-            a1_horizontal = (face_center[0] - self._res_x / 2) * ((self._facewidth / 2.0) / (w / 2.0))
-            a1_vertical = (face_center[1] - self._res_y / 2) * ((self._facewidth / 2.0) / (h / 2.0))
+        # Version of the last face the angles have been computed for
+        last_version = 0
 
-            # ...compute distance from camera to face plane
-            b1_horizontal = np.sqrt(c1_horizontal ** 2 - a1_horizontal ** 2)
-            b1_vertical = np.sqrt(c1_vertical ** 2 - a1_vertical ** 2)
-
-            # ...compute a2
-            a2_horizontal = self._fan_position[0] - a1_horizontal
-            a2_vertical = self._fan_position[2] - a1_vertical
+        # While exit event is not set...
+        while not self._exit.is_set():
+            # ...wait for a new face
+            if not self._face_record.wait(last_version, timeout=0.1):
+                continue
 
-            # ...compute b2
-            b2_horizontal = b1_horizontal - self._fan_position[1]
-            b2_vertical = b1_vertical - self._fan_position[1]
+            # ..clear new position event
+            self.newposition_event.clear()
 
-            # ...compute c2
-            c2_horizontal = np.sqrt(a2_horizontal ** 2 + b2_horizontal ** 2)
-            c2_vertical = np.sqrt(a2_vertical ** 2 + b2_vertical ** 2)
+            start = time.time()
 
-            # ...compute alphas
-            alpha_horizontal = np.arccos(
-                (b2_horizontal ** 2 + c2_horizontal ** 2 - a2_horizontal ** 2) / (2 * b2_horizontal * c2_horizontal))
-            if a1_horizontal > self._fan_position[0]:
-                alpha_horizontal = alpha_horizontal * -1
+            # ...get a consistent copy of the face parameters, counting faces that were never seen
+            face, version = self._face_record.read()
+            if last_version:
+                self._stats.dropped(version - last_version - 1)
+            self._stats.consumed()
+            last_version = version
+            timestamp = face[FACE_TIMESTAMP]
+            x = face[FACE_X]
+            y = face[FACE_Y]
+            w = face[FACE_W]
+            h = face[FACE_H]
 
-            alpha_vertical = np.arccos(
-                (b2_vertical ** 2 + c2_vertical ** 2 - a2_vertical ** 2) / (2 * b2_vertical * c2_vertical))
-            if a1_vertical > self._fan_position[2]:
-                alpha_vertical = alpha_vertical * -1
+            angle_horizontal, angle_vertical = self.compute_angles(x, y, w, h)
 
             # TESTING: angle offsets
             offset_horizontal = 0
             offset_vertical = 0
 
-            # Convert angles from radian to degree and copy them into shared memory
-            self._currentangles[0] = (alpha_horizontal * (180 / np.pi) - offset_horizontal).copy()
-            self._currentangles[1] = (alpha_vertical * (180 / np.pi) - offset_vertical).copy()
+            # Publish angles in shared memory
+            angles = [0.0] * ANGLE_RECORD_SIZE
+            angles[ANGLE_HORIZONTAL] = angle_horizontal - offset_horizontal
+            angles[ANGLE_VERTICAL] = angle_vertical - offset_vertical
+            angles[ANGLE_TIMESTAMP] = timestamp
+            self._angle_record.write(angles)
+            self._stats.iteration(time.time() - start)
+            self._stats.output()
+
+            # Record the face and the angles computed for it
+            if self._telemetry is not None:
+                self._telemetry.record(TELEMETRY_FACE, timestamp, (x, y, w, h), int(face[FACE_MODE]))
+                self._telemetry.record(TELEMETRY_ANGLES, timestamp,
+                                       (angles[ANGLE_HORIZONTAL], angles[ANGLE_VERTICAL]))
 
             # Set event
             self.newposition_event.set()
 
-            if self._visualize:
-                # Visualize stuff
-                axarray[0].cla()
-                axarray[0].plot(0, 0, 'ok')
-                axarray[0].plot(a1_horizontal, b1_horizontal, 'or')
-                axarray[0].plot(self._fan_position[0], self._fan_position[1], 'og')
-                x_fan = self._fan_position[0] + (c2_horizontal * np.cos(np.pi / 2 + alpha_horizontal))
-                y_fan = self._fan_position[1] + (c2_horizontal * np.sin(np.pi / 2 + alpha_horizontal))
-                axarray[0].plot([x_fan, self._fan_position[0]], [y_fan, self._fan_position[1]], '--y')
-                axarray[0].set_xlim([1000, -1000])
-                axarray[0].set_ylim([1500, -300])
-                axarray[0].set_title('top view')
-                axarray[0].set_xlabel('x [mm]')
-                axarray[0].set_ylabel('y [mm]')
-                axarray[0].set_aspect('equal', adjustable='box')
-                axarray[0].text(0, -100,
-                                'cam',
-                                horizontalalignment='center', verticalalignment='center')
-                axarray[0].text(self._fan_position[0], self._fan_position[1] - 100,
-                                'fan',
-                                horizontalalignment='center', verticalalignment='center')
-                axarray[0].text(0, -100,
-                                'cam',
-                                horizontalalignment='center', verticalalignment='center')
-                if not np.isinf(a1_horizontal):
-                    axarray[0].text(a1_horizontal, b1_horizontal + 100,
-                                    'face',
-                                    horizontalalignment='center', verticalalignment='center')
-
-                axarray[1].cla()
-                axarray[1].plot(0, 0, 'ok')
-                axarray[1].plot(b1_vertical, a1_vertical, 'or')
-                axarray[1].plot(self._fan_position[1], self._fan_position[2], 'og')
-                z_fan = self._fan_position[2] + (c2_vertical * np.cos(np.pi / 2 + alpha_vertical))
-                y_fan = self._fan_position[1] + (c2_vertical * np.sin(np.pi / 2 + alpha_vertical))
-                axarray[1].plot([y_fan, self._fan_position[1]], [z_fan, self._fan_position[2]], '--y')
-                axarray[1].set_xlim([-300, 1200])
-                axarray[1].set_ylim([-500, 500])
-                axarray[1].set_title('side view')
-                axarray[1].set_xlabel('y [mm]')
-                axarray[1].set_ylabel('z [mm]')
-                axarray[1].set_aspect('equal', adjustable='box')
-                axarray[1].text(0, 60,
-                                'cam',
-                                horizontalalignment='center', verticalalignment='center')
-                axarray[1].text(self._fan_position[1], self._fan_position[2] - 60,
-                                'fan',
-                                horizontalalignment='center', verticalalignment='center')
-                if not np.isinf(a1_horizontal):
-                    axarray[1].text(b1_vertical, a1_vertical + 60,
-                                    'face',
-                                    horizontalalignment='center', verticalalignment='center')
-                plt.pause(0.001)
+    def _setup(self):
+        # Load or compute the angle table
+        if self._use_angle_table and self._angle_table is None:
+            self._angle_table = AngleTable(self._facewidth, self._res_x, self._res_y, self._f_x, self._f_y,
+                                           self._fan_position, cache_dir=self._angle_table_cache_dir)
+
+    def compute_angles(self, x, y, w, h):
+        # Horizontal and vertical angle in degree for a face box
+        self._setup()
+        if self._angle_table is not None:
+            # ...look up the angles in the precomputed table
+            return self._angle_table.lookup(x, y, w, h)
+
+        # ...compute the geometry of both axes
+        horizontal, vertical = face_geometry(x, y, w, h, self._facewidth, self._res_x, self._res_y,
+                                             self._f_x, self._f_y, self._fan_position)
+
+        # ...convert angles from radian to degree
+        return np.degrees(horizontal[3]), np.degrees(vertical[3])
 
     def terminate(self):
         # Set exit event
         self._exit.set()
 
-    def set_face(self, face):
-        self._currentface[:] = face.copy()
+    def set_face(self, face, timestamp=0.0):
+        record = [0.0] * FACE_RECORD_SIZE
+        record[FACE_X:FACE_H + 1] = [float(v) for v in np.ravel(face)[:4]]
+        record[FACE_TIMESTAMP] = timestamp
+        self._face_record.write(record)
 
     def get_angles(self):
-        return self._currentangles
+        angles = self._angle_record.read()[0]
+        return angles[[ANGLE_HORIZONTAL, ANGLE_VERTICAL]].reshape((2, 1))
+
+    def get_angles_timestamp(self):
+        return float(self._angle_record.read()[0][ANGLE_TIMESTAMP])
+
+    def get_angles_version(self):
+        return self._angle_record.version()
+
+    def get_angle_record(self):
+        return self._angle_record
+
+    def get_angle_table(self):
+        self._setup()
+        return self._angle_table
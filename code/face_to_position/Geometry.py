@@ -0,0 +1,72 @@
+import numpy as np
+
+
+def axis_geometry(center, size, res, f, face_width, fan_a, fan_b):
+    '''
+    Geometry of one axis (top or side view) for arrays of face centers and
+    sizes in pixels. fan_a is the fan's offset from the camera along the
+    axis, fan_b its offset towards the face. Returns the face distance from
+    the camera axis a1 and from the camera plane b1, the distance c2 from
+    the fan to the face and the fan angle alpha in radian.
+    '''
+
+    center = np.asarray(center, dtype='float64')
+    size = np.asarray(size, dtype='float64')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # ...compute distances from camera to face in mm
+        c1 = face_width * f / size
+
+        # ...compute face distances from camera center
+        a1 = (center - res / 2) * ((face_width / 2.0) / (size / 2.0))
+
+        # ...compute distance from camera to face plane
+        b1 = np.sqrt(c1 ** 2 - a1 ** 2)
+
+        # ...compute a2
+        a2 = fan_a - a1
+
+        # ...compute b2
+        b2 = b1 - fan_b
+
+        # ...compute c2
+        c2 = np.sqrt(a2 ** 2 + b2 ** 2)
+
+        # ...compute alphas
+        alpha = np.arccos((b2 ** 2 + c2 ** 2 - a2 ** 2) / (2 * b2 * c2))
+        alpha = np.where(a1 > fan_a, -alpha, alpha)
+
+    return a1, b1, c2, alpha
+
+
+def face_geometry(x, y, w, h, face_width, res_x, res_y, f_x, f_y, fan_position):
+    '''
+    Geometry of both axes for arrays of face boxes (x, y, w, h) in pixels,
+    see axis_geometry(). Returns a (horizontal, vertical) pair of
+    (a1, b1, c2, alpha) tuples.
+    '''
+
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    w = np.asarray(w, dtype='float64')
+
+    # ...flip y coordinate
+    h = -np.asarray(h, dtype='float64')
+
+    # ...compute position of face center
+    center_x = x + w / 2
+    center_y = y - h / 2
+
+    horizontal = axis_geometry(center_x, w, res_x, f_x, face_width, fan_position[0], fan_position[1])
+    vertical = axis_geometry(center_y, h, res_y, f_y, face_width, fan_position[2], fan_position[1])
+
+    return horizontal, vertical
+
+
+def face_angles(x, y, w, h, face_width, res_x, res_y, f_x, f_y, fan_position):
+    '''
+    Horizontal and vertical fan angles in degree for arrays of face boxes.
+    '''
+
+    horizontal, vertical = face_geometry(x, y, w, h, face_width, res_x, res_y, f_x, f_y, fan_position)
+    return np.degrees(horizontal[3]), np.degrees(vertical[3])
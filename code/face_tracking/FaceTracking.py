@@ -0,0 +1,184 @@
+import multiprocessing
+import os
+import sys
+import time
+
+from KalmanTrack import KalmanTrack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from Records import (DETECTIONS_BOXES, DETECTIONS_COUNT, DETECTIONS_MODE, DETECTIONS_TIMESTAMP,
+                     FACE_H, FACE_MODE, FACE_RECORD_SIZE, FACE_TIMESTAMP, FACE_W, FACE_X, FACE_Y)
+from StageStats import StageStats
+from VersionedRecord import VersionedRecord
+
+
+class FaceTracking(multiprocessing.Process):
+    '''
+    Tracking stage between FaceDetection and FaceToPosition.
+
+    Every face found by FaceDetection is associated with a track holding a
+    constant-velocity Kalman filter. One track is the target: it is kept for
+    as long as it is seen, and only when it is lost the biggest confirmed
+    track takes over, so a second face in the frame does not make the fan
+    jump. The target is published predicted lead seconds ahead of now, the
+    time the servos will actually move, which hides the latency of capture,
+    detection and actuation. Between detections the prediction is
+    republished at a fixed rate.
+    '''
+
+    def __init__(self, detections_record, face_record=None, lead=0.15, rate=30.0,
+                 gate=1.0, min_hits=2, max_misses=5, max_coast=0.5,
+                 process_noise=1e5, measurement_noise=4.0, stats=None):
+
+        # Initialize multiprocessing.Process parent
+        multiprocessing.Process.__init__(self)
+
+        # Exit event for stopping process
+        self._exit = multiprocessing.Event()
+
+        # Event that is set, everytime a face is published
+        self.newface_event = multiprocessing.Event()
+
+        # Input: every face of a frame, published by FaceDetection
+        self._detections_record = detections_record
+
+        # Output: the predicted target face, in the layout FaceToPosition reads
+        if face_record is None:
+            face_record = VersionedRecord(FACE_RECORD_SIZE)
+        self._face_record = face_record
+
+        # A stats record in shared memory that is updated every iteration
+        if stats is None:
+            stats = StageStats('face_tracking')
+        self._stats = stats
+
+        # Time in seconds from now the target is predicted to, and the rate predictions are republished at
+        self._lead = lead
+        self._period = 1.0 / rate
+
+        # Largest distance of a detection from a track's predicted center, in face widths
+        self._gate = gate
+
+        # Detections before a track can become the target, and misses in a row before it is dropped
+        self._min_hits = min_hits
+        self._max_misses = max_misses
+
+        # Longest time in seconds a track is extrapolated without being seen
+        self._max_coast = max_coast
+
+        # Noise parameters of the Kalman filters
+        self._process_noise = process_noise
+        self._measurement_noise = measurement_noise
+
+        # Tracks and the target, only used within the process
+        self._tracks = []
+        self._target = None
+        self._next_id = 1
+
+    def run(self):
+        # Clear events
+        self._exit.clear()
+        self.newface_event.clear()
+
+        self._stats.started()
+
+        # Take over the target record from a predecessor that may have died writing
+        self._face_record.claim()
+
+        # Version of the last detections that have been processed
+        last_version = 0
+
+        # Detection mode of the last detections, published along with the target
+        mode = 0
+
+        # While exit event is not set...
+        while not self._exit.is_set():
+            # ..clear new face event
+            self.newface_event.clear()
+
+            # ...wait for new detections, or republish the prediction
+            if self._detections_record.wait(last_version, timeout=self._period):
+                start = time.time()
+                detections, version = self._detections_record.read()
+                if last_version:
+                    self._stats.dropped(version - last_version - 1)
+                self._stats.consumed()
+                last_version = version
+
+                mode = detections[DETECTIONS_MODE]
+                count = int(detections[DETECTIONS_COUNT])
+                boxes = [detections[DETECTIONS_BOXES + 4 * i:DETECTIONS_BOXES + 4 * i + 4] for i in range(count)]
+                self.update(boxes, detections[DETECTIONS_TIMESTAMP])
+                self._stats.iteration(time.time() - start)
+
+            self._publish(mode)
+
+    def update(self, boxes, timestamp):
+        '''
+        Associate the (x, y, w, h) boxes detected in a frame captured at
+        timestamp with the tracks and choose the target.
+        '''
+
+        # ...greedily pair detections and tracks, closest first
+        pairs = sorted((track.distance(box, timestamp), i, j)
+                       for i, track in enumerate(self._tracks) for j, box in enumerate(boxes))
+        matched_tracks = set()
+        matched_boxes = set()
+        for distance, i, j in pairs:
+            if distance > self._gate or i in matched_tracks or j in matched_boxes:
+                continue
+            self._tracks[i].update(boxes[j], timestamp)
+            matched_tracks.add(i)
+            matched_boxes.add(j)
+
+        for i, track in enumerate(self._tracks):
+            if i not in matched_tracks:
+                track.miss()
+
+        # ...start tracks for new faces
+        for j, box in enumerate(boxes):
+            if j not in matched_boxes:
+                self._tracks.append(KalmanTrack(self._next_id, box, timestamp,
+                                                self._process_noise, self._measurement_noise))
+                self._next_id += 1
+
+        # ...forget tracks that are lost
+        self._tracks = [track for track in self._tracks
+                        if track.misses <= self._max_misses and timestamp - track.last_seen <= self._max_coast]
+
+        # ...keep the target while it is tracked, otherwise take the biggest confirmed face
+        if self._target not in self._tracks:
+            confirmed = [track for track in self._tracks if track.hits >= self._min_hits]
+            self._target = max(confirmed, key=lambda track: track.box_at(timestamp)[2]) if confirmed else None
+
+    def target_box(self, timestamp):
+        # Predicted box of the target at a given time, None if there is no target
+        if self._target is None or timestamp - self._target.last_seen > self._max_coast + self._lead:
+            return None
+        return self._target.box_at(timestamp)
+
+    def _publish(self, mode):
+        box = self.target_box(time.time() + self._lead)
+        if box is None:
+            return
+
+        record = [0.0] * FACE_RECORD_SIZE
+        record[FACE_X], record[FACE_Y], record[FACE_W], record[FACE_H] = box
+        # ...the capture time of the last detection, so latencies stay measured from capture
+        record[FACE_TIMESTAMP] = self._target.last_seen
+        record[FACE_MODE] = mode
+        self._face_record.write(record)
+        self._stats.output()
+        self.newface_event.set()
+
+    def terminate(self):
+        # Set exit event
+        self._exit.set()
+
+    def get_face_record(self):
+        return self._face_record
+
+    def get_target_id(self):
+        # Only valid within the process
+        return self._target.id if self._target is not None else None
@@ -0,0 +1,102 @@
+import numpy as np
+
+
+class KalmanTrack(object):
+    '''
+    Constant-velocity Kalman filter for one face.
+
+    The state is the face center, width and height and their rates of change
+    in pixels and pixels per second. Changes of velocity are modelled as
+    white noise, so the filter follows a face that starts or stops moving
+    while it still extrapolates steady motion.
+    '''
+
+    def __init__(self, track_id, box, timestamp, process_noise=4000.0, measurement_noise=4.0,
+                 initial_velocity=200.0):
+        self.id = track_id
+
+        # Detections associated with the track and detections missed in a row
+        self.hits = 1
+        self.misses = 0
+
+        # Time of the last associated detection
+        self.last_seen = timestamp
+
+        # Spectral density of the acceleration in pixels/s^2 and standard deviation of detections in pixels
+        self._q = process_noise
+        self._r = measurement_noise
+
+        # State (cx, cy, w, h, vcx, vcy, vw, vh) at self.timestamp and its covariance
+        self._x = np.concatenate((self._measurement(box), np.zeros(4)))
+        self._P = np.diag([measurement_noise ** 2] * 4 + [initial_velocity ** 2] * 4)
+        self.timestamp = timestamp
+
+    def predict(self, timestamp):
+        # Move the state forward to a later time
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            return
+        F, Q = self._transition(dt)
+        self._x = F.dot(self._x)
+        self._P = F.dot(self._P).dot(F.T) + Q
+        self.timestamp = timestamp
+
+    def update(self, box, timestamp):
+        '''
+        Correct the state with a detected (x, y, w, h) box captured at the
+        given time.
+        '''
+
+        self.predict(timestamp)
+
+        # ...the measurement is the first half of the state
+        S = self._P[:4, :4] + np.eye(4) * self._r ** 2
+        K = self._P[:, :4].dot(np.linalg.inv(S))
+        self._x = self._x + K.dot(self._measurement(box) - self._x[:4])
+        self._P = self._P - K.dot(self._P[:4, :])
+
+        self.hits += 1
+        self.misses = 0
+        self.last_seen = timestamp
+
+    def miss(self):
+        self.misses += 1
+
+    def box_at(self, timestamp):
+        '''
+        Predicted (x, y, w, h) box at a given time, without changing the
+        state.
+        '''
+
+        dt = max(timestamp - self.timestamp, 0.0)
+        cx, cy, w, h = self._x[:4] + self._x[4:] * dt
+        w = max(w, 1.0)
+        h = max(h, 1.0)
+        return cx - w / 2, cy - h / 2, w, h
+
+    def distance(self, box, timestamp):
+        # Distance of a detected box from the predicted face center, in predicted face widths
+        x, y, w, h = self.box_at(timestamp)
+        measurement = self._measurement(box)
+        return np.hypot(measurement[0] - (x + w / 2), measurement[1] - (y + h / 2)) / w
+
+    @property
+    def velocity(self):
+        return self._x[4:].copy()
+
+    @staticmethod
+    def _measurement(box):
+        x, y, w, h = [float(v) for v in box]
+        return np.array([x + w / 2, y + h / 2, w, h])
+
+    def _transition(self, dt):
+        # State transition and process noise of the white-noise acceleration model
+        F = np.eye(8)
+        F[:4, 4:] = np.eye(4) * dt
+
+        Q = np.zeros((8, 8))
+        Q[:4, :4] = np.eye(4) * dt ** 3 / 3.0
+        Q[:4, 4:] = np.eye(4) * dt ** 2 / 2.0
+        Q[4:, :4] = np.eye(4) * dt ** 2 / 2.0
+        Q[4:, 4:] = np.eye(4) * dt
+        return F, Q * self._q
@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from StageStats import DEFAULT_STATS_DIR, StageStats, histogram_percentile
+
+
+class AutofanTop(object):
+    '''
+    Live view of the stats records of all running pipeline stages. It only
+    reads the memory-mapped records, the stages are not slowed down.
+    '''
+
+    def __init__(self, directory=DEFAULT_STATS_DIR, interval=1.0):
+        self._directory = directory
+        self._interval = interval
+
+        # Snapshots of the previous refresh, per stage, to compute rates from
+        self._previous = {}
+
+    def rows(self):
+        now = time.time()
+        rows = []
+        for stats in StageStats.attach_all(self._directory):
+            current = stats.snapshot()
+            current['time'] = now
+            previous = self._previous.get(stats.name, current)
+            self._previous[stats.name] = current
+
+            elapsed = max(now - previous['time'], 1e-6)
+
+            # ...percentiles over the last interval if it has samples, otherwise over the whole run
+            histogram = current['histogram'] - previous['histogram']
+            if histogram.sum() == 0:
+                histogram = current['histogram']
+            latencies = current['latencies'] - previous['latencies']
+            if latencies.sum() == 0:
+                latencies = current['latencies']
+
+            rows.append({
+                'stage': stats.name,
+                'pid': current['pid'],
+                'alive': self._alive(current['pid']),
+                'rate': (current['iterations'] - previous['iterations']) / elapsed,
+                'consumed': (current['consumed'] - previous['consumed']) / elapsed,
+                'dropped': current['dropped'],
+                'skipped': (current['skipped'] - previous['skipped']) / elapsed,
+                'p50': histogram_percentile(histogram, 50) / 1000.0,
+                'p99': histogram_percentile(histogram, 99) / 1000.0,
+                'latency': histogram_percentile(latencies, 99) / 1000.0 if latencies.sum() else float('nan'),
+                'idle': now - current['last_output'] if current['last_output'] else float('nan'),
+            })
+        return rows
+
+    def render(self, rows):
+        lines = ['%-20s %7s %5s %9s %9s %9s %9s %9s %9s %9s %9s' % ('stage', 'pid', 'alive', 'iter/s', 'in/s',
+                                                                'skip/s', 'dropped', 'p50 ms', 'p99 ms', 'lat99 ms',
+                                                                'idle s')]
+        for row in rows:
+            lines.append('%-20s %7d %5s %9.1f %9.1f %9.1f %9d %9.2f %9.2f %9.2f %9.2f' % (
+                row['stage'], row['pid'], 'yes' if row['alive'] else 'no', row['rate'], row['consumed'],
+                row['skipped'], row['dropped'], row['p50'], row['p99'], row['latency'], row['idle']))
+        if not rows:
+            lines.append('no stage stats found in ' + self._directory)
+        return '\n'.join(lines)
+
+    def loop(self):
+        while True:
+            output = self.render(self.rows())
+            # ...clear the terminal and redraw
+            sys.stdout.write('\033[H\033[2J' + output + '\n')
+            sys.stdout.flush()
+            time.sleep(self._interval)
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='autofan-top', description='Live view of the AutoFan pipeline stages.')
+    parser.add_argument('--directory', default=DEFAULT_STATS_DIR, help='directory of the stage stats records')
+    parser.add_argument('--interval', type=float, default=1.0, help='refresh interval in seconds')
+    args = parser.parse_args()
+
+    try:
+        AutofanTop(args.directory, args.interval).loop()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,120 @@
+import os
+import socket
+import struct
+import time
+
+
+class ServoBackend(object):
+    '''
+    Base class for servo outputs.
+
+    write() takes the pwm values of all servos for one control tick as a
+    {servo: pwm} dict, in ServoBlaster steps. Values that did not change
+    since the last write are skipped and the remaining ones are sent to the
+    device in one batch.
+    '''
+
+    def __init__(self):
+        # The last pwm value sent to each servo
+        self._last = {}
+
+    def write(self, pwms):
+        # Only send the values that changed
+        changed = dict((servo, pwm) for servo, pwm in pwms.items() if self._last.get(servo) != pwm)
+        if changed:
+            self._write(changed)
+            self._last.update(changed)
+        return len(changed)
+
+    def close(self):
+        pass
+
+    def _write(self, pwms):
+        raise NotImplementedError
+
+    @staticmethod
+    def _format(pwms):
+        # ServoBlaster command format, one "servo=pwm" line per servo
+        return ''.join('%d=%d\n' % (servo, pwm) for servo, pwm in sorted(pwms.items()))
+
+
+class ServoBlasterBackend(ServoBackend):
+    def __init__(self, device='/dev/servoblaster'):
+        ServoBackend.__init__(self)
+
+        # Unbuffered file descriptor, every batch goes out in a single write syscall
+        self._fd = os.open(device, self._flags())
+
+    def _flags(self):
+        return os.O_WRONLY
+
+    def _write(self, pwms):
+        os.write(self._fd, self._format(pwms).encode('ascii'))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class FileBackend(ServoBlasterBackend):
+    '''
+    Appends ServoBlaster commands to a regular file, a stand-in for
+    /dev/servoblaster when running without hardware.
+    '''
+
+    def _flags(self):
+        return os.O_WRONLY | os.O_CREAT | os.O_APPEND
+
+
+class PigpioBackend(ServoBackend):
+    '''
+    Talks to the pigpio daemon over its socket interface. ServoBlaster steps
+    are converted to pulse widths and servo numbers to GPIO pins.
+    '''
+
+    # pigpio command to set a servo pulse width
+    _CMD_SERVO = 8
+
+    def __init__(self, pins, host='localhost', port=8888, step_us=10):
+        ServoBackend.__init__(self)
+
+        # Mapping from servo number to GPIO pin
+        self._pins = pins
+
+        # Length of one ServoBlaster step in microseconds
+        self._step_us = step_us
+
+        self._socket = socket.create_connection((host, port))
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _write(self, pwms):
+        # All commands go out in one send, the daemon answers every command with 16 bytes
+        commands = b''.join(struct.pack('<IIII', self._CMD_SERVO, self._pins[servo], pwm * self._step_us, 0)
+                            for servo, pwm in sorted(pwms.items()))
+        self._socket.sendall(commands)
+
+        expected = 16 * len(pwms)
+        received = 0
+        while received < expected:
+            chunk = self._socket.recv(expected - received)
+            if not chunk:
+                raise IOError('Connection to pigpio daemon closed')
+            received += len(chunk)
+
+    def close(self):
+        self._socket.close()
+
+
+class RecorderBackend(ServoBackend):
+    '''
+    Keeps every batch in memory as a (time, {servo: pwm}) tuple, for tests.
+    The recording lives in the process that writes to the backend.
+    '''
+
+    def __init__(self):
+        ServoBackend.__init__(self)
+        self.records = []
+
+    def _write(self, pwms):
+        self.records.append((time.time(), dict(pwms)))
@@ -0,0 +1,296 @@
+import argparse
+import csv
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+# Servos of a calibration, by the name used in measurement files and compiled tables
+SERVOS = ('horizontal', 'vertical')
+
+
+def read_measurements(path):
+    '''
+    Read measured servo positions: a CSV file with a "servo,pwm,angle" row
+    per measurement, the servo named "horizontal" or "vertical" and the
+    angle in degree. Returns {servo: (angles, pwms)}.
+    '''
+
+    measurements = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            if not row.get('angle') or not row.get('pwm'):
+                # ...skip positions that were not measured
+                continue
+            angles, pwms = measurements.setdefault(row['servo'].strip(), ([], []))
+            angles.append(float(row['angle']))
+            pwms.append(float(row['pwm']))
+    return dict((servo, (np.array(angles), np.array(pwms))) for servo, (angles, pwms) in measurements.items())
+
+
+class LinearModel(object):
+    '''
+    pwm = m * angle + b, the hand-fitted mapping of servo_control's config.
+    It holds for any angle, the pwm range limits it.
+    '''
+
+    def __init__(self, m, b):
+        self._m = float(m)
+        self._b = float(b)
+
+        # Angles the model is valid for, None for all
+        self.angle_range = None
+
+    def __call__(self, angles):
+        return self._m * np.asarray(angles, dtype='float64') + self._b
+
+    def inverse(self, pwm):
+        # Angle the model maps to pwm
+        return (pwm - self._b) / self._m
+
+
+class PiecewiseLinearModel(object):
+    '''
+    Monotone piecewise linear fit through the measurements.
+
+    The pwm values are made monotone in the angle by isotonic regression
+    (pool adjacent violators), in the direction of the overall slope, and
+    interpolated linearly in between. The model is only valid within the
+    measured angles, it does not extrapolate.
+    '''
+
+    def __init__(self, angles, pwms):
+        order = np.argsort(angles, kind='mergesort')
+        angles = np.asarray(angles, dtype='float64')[order]
+        pwms = np.asarray(pwms, dtype='float64')[order]
+
+        # ...average repeated measurements of one angle
+        self._angles, inverse = np.unique(angles, return_inverse=True)
+        counts = np.bincount(inverse)
+        pwms = np.bincount(inverse, weights=pwms) / counts
+        if len(self._angles) < 2:
+            raise ValueError('A piecewise fit needs at least two measured angles')
+
+        # ...fit an increasing sequence to the pwm values, or to their negation for a decreasing servo
+        sign = 1.0 if np.polyfit(self._angles, pwms, 1)[0] >= 0 else -1.0
+        self._pwms = sign * self._isotonic(sign * pwms, counts)
+
+        self.angle_range = (float(self._angles[0]), float(self._angles[-1]))
+
+    def __call__(self, angles):
+        return np.interp(angles, self._angles, self._pwms)
+
+    @staticmethod
+    def _isotonic(values, weights):
+        # Pool adjacent violators: merge neighbouring blocks while their means decrease
+        means, sizes, counts = [], [], []
+        for value, weight in zip(values, weights):
+            means.append(float(value))
+            sizes.append(float(weight))
+            counts.append(1)
+            while len(means) > 1 and means[-2] > means[-1]:
+                size = sizes[-2] + sizes[-1]
+                means[-2] = (means[-2] * sizes[-2] + means[-1] * sizes[-1]) / size
+                sizes[-2] = size
+                counts[-2] += counts[-1]
+                del means[-1], sizes[-1], counts[-1]
+        return np.repeat(means, counts)
+
+
+class PolynomialModel(object):
+    '''
+    Least squares polynomial fit of the pwm over the angle. A polynomial
+    that is not monotone within the measured angles would aim the fan back
+    and forth, so it is rejected. Like the piecewise fit, it is only valid
+    within the measured angles.
+    '''
+
+    def __init__(self, angles, pwms, degree=3):
+        angles = np.asarray(angles, dtype='float64')
+        if len(np.unique(angles)) <= degree:
+            raise ValueError('A polynomial of degree %d needs at least %d measured angles' % (degree, degree + 1))
+        self._coefficients = np.polyfit(angles, np.asarray(pwms, dtype='float64'), degree)
+        self.angle_range = (float(angles.min()), float(angles.max()))
+
+        slopes = np.polyval(np.polyder(self._coefficients), np.linspace(self.angle_range[0], self.angle_range[1],
+                                                                         1000))
+        if np.any(slopes > 0) and np.any(slopes < 0):
+            raise ValueError('The polynomial of degree %d is not monotone within the measured angles, '
+                             'try a lower degree' % degree)
+
+    def __call__(self, angles):
+        return np.polyval(self._coefficients, angles)
+
+
+# Models fitted to measurements by the name they are configured with
+MODELS = {
+    'piecewise': PiecewiseLinearModel,
+    'polynomial': PolynomialModel,
+}
+
+
+def fit(angles, pwms, model='piecewise', **kwargs):
+    return MODELS[model](angles, pwms, **kwargs)
+
+
+class PwmTable(object):
+    '''
+    Integer pwm values of a servo for angles on a grid of resolution
+    degrees, starting at angle_min.
+
+    lookup() rounds an angle to the grid and returns the pwm value of it,
+    angles beyond the ends of the table get the value at that end. The
+    table only holds values within the pwm range, so lookups need no range
+    checks. Angles must not be NaN, the trajectories never produce them.
+
+    compile() rounds the pwm values of a model to the nearest integer. The
+    linear mapping ServoControl used before the tables truncated them with
+    int(), which put a servo up to one pwm step below the fitted position;
+    the same m and b now give the nearest step instead.
+    '''
+
+    def __init__(self, pwms, angle_min, resolution):
+        self.pwms = np.asarray(pwms, dtype='int16')
+        self.angle_min = float(angle_min)
+        self.resolution = float(resolution)
+
+        # ...plain ints index and convert faster than numpy scalars on every tick
+        self._pwms = self.pwms.tolist()
+        self._scale = 1.0 / self.resolution
+        self._last = len(self._pwms) - 1
+
+    @classmethod
+    def compile(cls, model, pwm_min, pwm_max, resolution=0.1):
+        '''
+        Evaluate a model on the grid of angles it reaches within the pwm
+        range, from pwm_min up to but excluding pwm_max, rounded to the
+        nearest pwm value.
+        '''
+
+        angle_range = model.angle_range
+        if angle_range is None:
+            # ...a model valid for every angle is limited by the pwm range alone
+            angle_range = sorted(model.inverse(pwm) for pwm in (pwm_min, pwm_max - 1))
+
+        angles = np.arange(angle_range[0], angle_range[1] + resolution / 2.0, resolution)
+        pwms = model(angles)
+        reachable = (pwms >= pwm_min) & (pwms <= pwm_max - 1)
+        if not reachable.any():
+            raise ValueError('No angle between %.1f and %.1f degree is reachable within pwm %d to %d' %
+                             (angle_range[0], angle_range[1], pwm_min, pwm_max))
+
+        # ...a monotone model reaches one contiguous range of angles
+        first, last = np.flatnonzero(reachable)[[0, -1]]
+        # ...round to the nearest pwm value, not down like int() would
+        pwms = np.clip(np.round(pwms[first:last + 1]), pwm_min, pwm_max - 1)
+        return cls(pwms, angles[first], resolution)
+
+    @property
+    def angle_limits(self):
+        # Lowest and highest angle in degree the servo reaches
+        return self.angle_min, self.angle_min + self._last * self.resolution
+
+    @property
+    def pwm_limits(self):
+        return int(self.pwms.min()), int(self.pwms.max())
+
+    def lookup(self, angle):
+        # ...round to the nearest angle of the grid, int() alone would truncate towards angle_min
+        index = int((angle - self.angle_min) * self._scale + 0.5)
+        return self._pwms[min(max(index, 0), self._last)]
+
+
+def save_tables(path, tables):
+    '''
+    Save the pwm tables of the servos, {servo: PwmTable}, for ServoControl
+    to load.
+    '''
+
+    arrays = {}
+    for servo, table in tables.items():
+        arrays[servo] = table.pwms
+        arrays[servo + '_grid'] = np.array([table.angle_min, table.resolution])
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # ...write to a temporary file first so a starting ServoControl never loads a partial table
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npz')
+    with os.fdopen(handle, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, path)
+
+
+def load_tables(path):
+    with np.load(path) as arrays:
+        return dict((servo, PwmTable(arrays[servo], *arrays[servo + '_grid']))
+                    for servo in SERVOS if servo in arrays)
+
+
+def calibrate(measurements, pwm_min, pwm_max, model='piecewise', resolution=0.1, **kwargs):
+    '''
+    Fit a model to the measurements of each servo and compile it into a pwm
+    table. Returns {servo: (table, report)}, the report holds the fit
+    residuals in pwm and the reachable angle limits.
+    '''
+
+    results = {}
+    for servo, (angles, pwms) in sorted(measurements.items()):
+        fitted = fit(angles, pwms, model, **kwargs)
+        table = PwmTable.compile(fitted, pwm_min, pwm_max, resolution)
+
+        residuals = fitted(angles) - pwms
+        linear = np.polyval(np.polyfit(angles, pwms, 1), angles) - pwms
+        results[servo] = (table, {
+            'measurements': len(angles),
+            'rms_error': float(np.sqrt(np.mean(residuals ** 2))),
+            'max_error': float(np.max(np.abs(residuals))),
+            'linear_rms_error': float(np.sqrt(np.mean(linear ** 2))),
+            'angle_limits': table.angle_limits,
+            'pwm_limits': table.pwm_limits,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit servo calibration measurements and compile the pwm tables '
+                                                 'ServoControl loads.')
+    parser.add_argument('measurements', help='CSV file with a "servo,pwm,angle" row per measured position')
+    parser.add_argument('--output', default=os.path.join(os.path.expanduser('~'), '.config', 'autofan',
+                                                         'servo-calibration.npz'),
+                        help='compiled tables, set as "calibration" of servo_control in the config')
+    parser.add_argument('--model', choices=sorted(MODELS), default='piecewise')
+    parser.add_argument('--degree', type=int, default=3, help='degree of the polynomial model')
+    parser.add_argument('--pwm-min', type=int, default=90, help='lowest pwm value the servos may be set to')
+    parser.add_argument('--pwm-max', type=int, default=226, help='pwm value the servos stay below')
+    parser.add_argument('--resolution', type=float, default=0.1, help='table resolution in degree')
+    parser.add_argument('--require', type=float, nargs=2, metavar=('MIN', 'MAX'),
+                        help='angle range in degree both servos must reach')
+    args = parser.parse_args()
+
+    kwargs = {'degree': args.degree} if args.model == 'polynomial' else {}
+    try:
+        results = calibrate(read_measurements(args.measurements), args.pwm_min, args.pwm_max, args.model,
+                            args.resolution, **kwargs)
+    except ValueError as e:
+        sys.exit('Calibration failed: %s' % e)
+
+    failed = False
+    for servo, (table, report) in sorted(results.items()):
+        line = '%-10s %2d points, error %.2f pwm rms (linear %.2f), %.2f max, reaches %.1f to %.1f deg ' \
+               'with pwm %d to %d' % ((servo, report['measurements'], report['rms_error'],
+                                        report['linear_rms_error'], report['max_error']) +
+                                       report['angle_limits'] + report['pwm_limits'])
+        print line
+        if args.require and (report['angle_limits'][0] > args.require[0] or
+                             report['angle_limits'][1] < args.require[1]):
+            print '%-10s does not reach %.1f to %.1f deg' % (servo, args.require[0], args.require[1])
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+    save_tables(args.output, dict((servo, table) for servo, (table, _) in results.items()))
+    print 'wrote ' + args.output
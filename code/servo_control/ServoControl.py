@@ -1,16 +1,29 @@
-import math
 import multiprocessing
+import os
+import sys
 import time
-import copy
+import numpy as np
 import sharedmem
 
-from Filter import lowpass
+from ServoBackend import ServoBlasterBackend
+from ServoCalibration import LinearModel, PwmTable, load_tables
+from Trajectory import Trajectory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from Filter import LowpassFilter, create_filter
+from RateLimiter import RateLimiter
+from Records import ANGLE_HORIZONTAL, ANGLE_RECORD_SIZE, ANGLE_TIMESTAMP, ANGLE_VERTICAL, TELEMETRY_SERVO
+from StageStats import StageStats
+from VersionedRecord import VersionedRecord
 
 
 class ServoControl(multiprocessing.Process):
     def __init__(self, servo_horizontal, m_horizontal, b_horizontal,
                  servo_vertical, m_vertical, b_vertical,
-                 f, speed, pwm_min, pwm_max):
+                 f, speed, pwm_min, pwm_max, device='/dev/servoblaster', latency_samples=4096,
+                 angle_record=None, backend=None, acceleration=1000.0, lowpass_rc=0.1, tick_samples=4096,
+                 angle_filter=None, calibration=None, telemetry=None, stats=None):
 
         # Initialize multiprocessing.Process parent
         multiprocessing.Process.__init__(self)
@@ -22,97 +35,239 @@ class ServoControl(multiprocessing.Process):
         self._s_h = servo_horizontal
         self._s_v = servo_vertical
 
-        # Set slopes
-        self._m_horizontal = m_horizontal
-        self._m_vertical = m_vertical
-
-        # Set intercepts
-        self._b_horizontal = b_horizontal
-        self._b_vertical = b_vertical
-
         # Set update frequency
         self._f = 1.0 / f
 
-        # Set increment per time step
-        self._increment = speed / f
+        # Current tick rate in shared memory, the update frequency unless lowered by set_rate()
+        self._tick_rate = RateLimiter(f)
+
+        # Set speed and acceleration limits of the servo trajectories
+        self._speed = speed
+        self._acceleration = acceleration
 
-        # Set minimum and maximum pwm ranges
-        self._pwm_min = pwm_min
-        self._pwm_max = pwm_max
+        # Filter applied to the angles of both trajectories, by default a lowpass filter with a time constant
+        # in seconds, None disables it. angle_filter configures another one, see Filter.create_filter()
+        if angle_filter is not None:
+            self._filter = create_filter(angle_filter)
+        elif lowpass_rc is not None:
+            self._filter = LowpassFilter(lowpass_rc)
+        else:
+            self._filter = None
+
+        # Angle to pwm tables of both servos, compiled by ServoCalibration from measured positions, or from
+        # the linear fits given by slope and intercept. Lookups stay within pwm_min up to pwm_max
+        if calibration is not None:
+            self._pwm_tables = self._load_calibration(os.path.expanduser(calibration), pwm_min, pwm_max)
+        else:
+            self._pwm_tables = (PwmTable.compile(LinearModel(m_horizontal, b_horizontal), pwm_min, pwm_max),
+                                PwmTable.compile(LinearModel(m_vertical, b_vertical), pwm_min, pwm_max))
 
-        # An array in shared memory for storing the new desired servo position angles
-        self._newangles = sharedmem.zeros((2, 1), dtype='float')
+        # A record in shared memory holding the new desired servo position angles and their capture
+        # timestamp, e.g. the one published by FaceToPosition
+        if angle_record is None:
+            angle_record = VersionedRecord(ANGLE_RECORD_SIZE)
+        self._angle_record = angle_record
 
         # A list containing the current servo angles
         self._currentangles = sharedmem.ones((2, 1), dtype='float')
 
-        # Initialize ServoBlaster device
-        self._servoblaster = open('/dev/servoblaster', 'w')
+        # A ring buffer of latencies from frame capture to the first pwm write for new angles
+        self._latencies = sharedmem.zeros(latency_samples, dtype='float64')
+        self._latencycount = sharedmem.zeros(1, dtype='int64')
+
+        # Tick statistics: number of ticks, missed ticks, and a ring buffer of how late each tick started
+        self._tickcount = sharedmem.zeros(2, dtype='int64')
+        self._lateness = sharedmem.zeros(tick_samples, dtype='float64')
+
+        # An optional telemetry channel the targets, filtered angles and pwm of every tick are recorded to
+        self._telemetry = telemetry
+
+        # Planned trajectory of each axis, set up by reset_control()
+        self._trajectories = None
+
+        # A stats record in shared memory that is updated every tick
+        if stats is None:
+            stats = StageStats('servo_control')
+        self._stats = stats
+
+        # Servo output, defaults to the ServoBlaster device opened by _setup()
+        self._device = device
+        self._backend = backend
 
     def __del__(self):
-        self._servoblaster.close()
+        # ...the backend is not set if the constructor failed
+        if getattr(self, '_backend', None) is not None:
+            self._backend.close()
 
     def run(self):
         # Clear events
         self._exit.clear()
 
-        self._set_servo_pwm(self._s_h, self._currentangles[0])
-        self._set_servo_pwm(self._s_v, self._currentangles[1])
+        self._stats.started()
+
+        # Set up in this process, in parallel with the other stages
+        self._setup()
+        self._stats.ready()
+
+        self._set_servo_pwm(*self.angles_to_pwm(self._currentangles[0, 0], self._currentangles[1, 0]))
 
-        old_horizontal_angle = self._currentangles[0]
-        old_vertical_angle = self._currentangles[1]
+        self.reset_control(self._currentangles[0, 0], self._currentangles[1, 0])
+
+        # Version of the last new angles, and capture time of the last frame a latency has been recorded for
+        last_version = self._angle_record.version()
+        last_capture = 0.0
+
+        # Ticks run on absolute deadlines so compute time does not add to the period
+        deadline = time.time()
+        last_tick = deadline
 
         # While exit event is not set...
         while not self._exit.is_set():
-
-            # ...increment or decrement horizontal servo angle depending on speed and update frequency
-            if self._newangles[0] > self._currentangles[0]:
-                self._currentangles[0] += self._increment
-            elif self._newangles[0] < self._currentangles[0]:
-                self._currentangles[0] -= self._increment
-
-            # ...increment or decrement vertical servo angle depending on speed and update frequency
-            if self._newangles[1] > self._currentangles[1]:
-                self._currentangles[1] += self._increment
-            elif self._newangles[1] < self._currentangles[1]:
-                self._currentangles[1] -= self._increment
-
-            # ...apply temporal lowpass filter to angles
-            new_horizontal_angle = lowpass(self._currentangles[0],
-                                           old_horizontal_angle,
-                                           0.1, self._f)
-
-            new_vertical_angle = lowpass(self._currentangles[0],
-                                         old_vertical_angle,
-                                         0.1, self._f)
-
-            # ...store angles
-            old_horizontal_angle = new_horizontal_angle
-            old_vertical_angle = new_vertical_angle
-
-            # ...set servo pwm
-            self._set_servo_pwm(self._s_h, self.angle_to_pwm(new_horizontal_angle,
-                                                             self._m_horizontal, self._b_horizontal))
-            self._set_servo_pwm(self._s_v, self.angle_to_pwm(new_vertical_angle,
-                                                             self._m_vertical, self._b_vertical))
-
-            time.sleep(self._f)
-
-    def set_new_angles(self, horizontal_angle, vertical_angle):
-        self._newangles[0] = copy.copy(horizontal_angle)
-        self._newangles[1] = copy.copy(vertical_angle)
-
-    def _set_servo_pwm(self, servo, pwm):
-        if pwm in range(self._pwm_min, self._pwm_max, 1):
-            self._servoblaster.write(str(servo) + '=' + str(pwm) + '\n')
-            self._servoblaster.flush()
-
-    def angle_to_pwm(self, angle, m, b):
-        if math.isnan(angle):
-            return self._pwm_min
-        else:
-            pwm = m * angle + b
-            return int(pwm)
+            # ...record how late this tick started
+            now = time.time()
+            period = self._tick_rate.period()
+            late = now - deadline
+            self._lateness[self._tickcount[0] % len(self._lateness)] = late
+            self._tickcount[0] += 1
+
+            # ...if whole periods were missed, skip them instead of catching up
+            if late >= period:
+                missed = int(late / period)
+                self._tickcount[1] += missed
+                self._stats.dropped(missed)
+                deadline += missed * period
+
+            dt = now - last_tick
+            last_tick = now
+
+            # ...get a consistent copy of the desired angles
+            newangles, version = self._angle_record.read()
+
+            # ...move towards the desired angles and set servo pwm
+            filtered, pwms = self.control_step(newangles[ANGLE_HORIZONTAL], newangles[ANGLE_VERTICAL], dt)
+            changed = self._set_servo_pwm(*pwms)
+
+            # ...only writes towards published angles count as output, not settling at start-up
+            if changed and version:
+                self._stats.output()
+
+            # ...record the tick under its start time, so replays see the same time steps
+            if self._telemetry is not None:
+                self._telemetry.record(TELEMETRY_SERVO, newangles[ANGLE_TIMESTAMP],
+                                       (newangles[ANGLE_HORIZONTAL], newangles[ANGLE_VERTICAL]) + filtered + pwms,
+                                       int(changed), timestamp=now)
+
+            # ...record latency from frame capture to the first pwm write for angles of a new frame. Angles
+            # republished for the same frame, e.g. predicted by FaceTracking, carry its capture time again
+            if version != last_version:
+                self._stats.consumed()
+                last_version = version
+                timestamp = newangles[ANGLE_TIMESTAMP]
+                if timestamp > 0 and timestamp != last_capture:
+                    last_capture = timestamp
+                    self._latencies[self._latencycount[0] % len(self._latencies)] = time.time() - timestamp
+                    self._latencycount[0] += 1
+
+            self._stats.iteration(time.time() - now)
+
+            # ...sleep until the next deadline
+            deadline += period
+            remaining = deadline - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def terminate(self):
+        # Set exit event
+        self._exit.set()
+
+    def _setup(self):
+        # Open the ServoBlaster device unless another output was given
+        if self._backend is None:
+            self._backend = ServoBlasterBackend(self._device)
+
+    def reset_control(self, horizontal_angle, vertical_angle):
+        # Start the trajectories and filters of both axes at rest at the given angles
+        self._trajectories = (Trajectory(self._speed, self._acceleration, horizontal_angle),
+                              Trajectory(self._speed, self._acceleration, vertical_angle))
+        if self._filter is not None:
+            self._filter.reset((horizontal_angle, vertical_angle))
+
+    def control_step(self, horizontal_angle, vertical_angle, dt):
+        '''
+        Advance both axes by dt seconds towards the desired angles. Returns
+        the filtered angles and the pwm values for them.
+        '''
+
+        # ...move along the planned trajectories towards the desired angles
+        for axis, angle in enumerate((horizontal_angle, vertical_angle)):
+            self._currentangles[axis] = self._trajectories[axis].step(angle, dt)
+
+        # ...apply temporal filter to both angles at once
+        filtered = self._currentangles[:, 0]
+        if self._filter is not None:
+            filtered = self._filter.step(filtered, dt)
+        filtered = (float(filtered[0]), float(filtered[1]))
+
+        return filtered, self.angles_to_pwm(*filtered)
+
+    def set_new_angles(self, horizontal_angle, vertical_angle, timestamp=0.0):
+        angles = [0.0] * ANGLE_RECORD_SIZE
+        angles[ANGLE_HORIZONTAL] = horizontal_angle
+        angles[ANGLE_VERTICAL] = vertical_angle
+        angles[ANGLE_TIMESTAMP] = timestamp
+        self._angle_record.write(angles)
+
+    def get_latencies(self):
+        # Latency samples in seconds, oldest samples are overwritten once the buffer is full
+        count = min(self._latencycount[0], len(self._latencies))
+        return self._latencies[:count].copy()
+
+    def get_new_latencies(self, since=0):
+        # Latency samples recorded after the first since samples, and the number of samples recorded so far
+        count = int(self._latencycount[0])
+        if count < since:
+            # ...the counter started over
+            since = 0
+        new = min(count - since, len(self._latencies))
+        return self._latencies[np.arange(count - new, count) % len(self._latencies)], count
+
+    def set_rate(self, rate):
+        # Set the tick rate in Hz, None for the update frequency
+        self._tick_rate.set_rate(rate or 1.0 / self._f)
+
+    def get_rate(self):
+        return self._tick_rate.get_rate()
+
+    def get_tick_stats(self):
+        # Number of ticks and missed ticks, and lateness of recent ticks in seconds
+        count = min(self._tickcount[0], len(self._lateness))
+        lateness = self._lateness[:count]
+        stats = {'ticks': int(self._tickcount[0]), 'missed': int(self._tickcount[1])}
+        if count:
+            stats['late_mean'] = float(lateness.mean())
+            stats['late_p99'] = float(np.percentile(lateness, 99))
+            stats['late_max'] = float(lateness.max())
+        return stats
+
+    def _set_servo_pwm(self, pwm_horizontal, pwm_vertical):
+        # Write both servos in one batch, the pwm tables keep the values within range
+        return self._backend.write({self._s_h: pwm_horizontal, self._s_v: pwm_vertical})
+
+    def angles_to_pwm(self, horizontal_angle, vertical_angle):
+        # Pwm values of both servos, one table lookup each
+        return self._pwm_tables[0].lookup(horizontal_angle), self._pwm_tables[1].lookup(vertical_angle)
+
+    @staticmethod
+    def _load_calibration(path, pwm_min, pwm_max):
+        tables = load_tables(path)
+        for servo in ('horizontal', 'vertical'):
+            if servo not in tables:
+                raise ValueError('No %s servo in calibration %s' % (servo, path))
+            low, high = tables[servo].pwm_limits
+            if low < pwm_min or high >= pwm_max:
+                raise ValueError('The %s servo of calibration %s is set to pwm %d to %d, outside of %d to %d' %
+                                 (servo, path, low, high, pwm_min, pwm_max))
+        return tables['horizontal'], tables['vertical']
 
 
 if __name__ == '__main__':
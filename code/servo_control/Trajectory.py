@@ -0,0 +1,52 @@
+import math
+
+
+class Trajectory(object):
+    '''
+    Moves one servo axis towards a target angle with limited speed and
+    acceleration. The axis speeds up, cruises at max_speed and brakes so that
+    it comes to rest on the target instead of overshooting it.
+    '''
+
+    def __init__(self, max_speed, max_acceleration, position=0.0):
+        # Limits in degree per second and degree per second squared
+        self._max_speed = float(max_speed)
+        self._max_acceleration = float(max_acceleration)
+
+        # Current state of the axis
+        self.position = float(position)
+        self.velocity = 0.0
+
+    def step(self, target, dt):
+        '''
+        Advance the axis by dt seconds towards target and return the new
+        position.
+        '''
+
+        if dt <= 0 or math.isnan(target):
+            return self.position
+
+        distance = target - self.position
+
+        # ...fastest speed from which the axis can still stop at the target, given that
+        # the velocity only changes once per step
+        a = self._max_acceleration
+        speed = min(self._max_speed, a * (math.sqrt(dt ** 2 + 2.0 * abs(distance) / a) - dt))
+        desired = math.copysign(speed, distance)
+
+        # ...change velocity towards it within the acceleration limit
+        dv = self._max_acceleration * dt
+        self.velocity += max(-dv, min(dv, desired - self.velocity))
+
+        # ...settle on the target instead of stepping across it
+        step = self.velocity * dt
+        if abs(step) >= abs(distance) and abs(self.velocity) <= dv * 2:
+            self.position = float(target)
+            self.velocity = 0.0
+        else:
+            self.position += step
+
+        return self.position
+
+    def at_rest(self, target):
+        return self.velocity == 0.0 and self.position == target
@@ -0,0 +1,227 @@
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger('autofan.governor')
+
+# Stages whose rate the governor sets, in pipeline order
+GOVERNED_STAGES = ('unwarping', 'face_detection', 'servo_control')
+
+
+class Governor(object):
+    '''
+    Keeps the pipeline just below the point where the board throttles.
+
+    Each stage otherwise runs flat out, and once the CPU gets hot the
+    firmware lowers the clock for all of them at once, so latency jumps
+    without warning. The governor instead watches the CPU temperature and
+    clock, the end-to-end latency from capture to the servos and the CPU
+    load of each stage, and lowers the camera, detection and servo tick
+    rates before that happens:
+
+    - hotter than target_temperature, latency over target_latency, or the
+      clock lowered while the stages keep a core busy: the rate of the
+      stage with the highest load is cut by the factor decrease, or of all
+      stages if their loads cannot be told apart (e.g. the threads runtime)
+    - cooler than target_temperature - hysteresis with latency to spare:
+      the stage cut furthest is allowed increase more of its maximum rate
+    - otherwise the rates are held
+
+    The level of a stage is its rate relative to its maximum rate. At level
+    1 the stage is not limited at all. Every decision is logged.
+    '''
+
+    def __init__(self, sensors, rates, target_temperature=75.0, hysteresis=5.0, target_latency=0.15,
+                 latency_percentile=95, throttled_ratio=0.95, busy_load=1.0, decrease=0.8, increase=0.1,
+                 min_level=0.25, interval=2.0):
+
+        # Temperature, clock and CPU time readings, see SystemSensors
+        self._sensors = sensors
+
+        # Maximum rate of each governed stage in Hz
+        unknown = sorted(set(rates) - set(GOVERNED_STAGES))
+        if unknown:
+            raise ValueError('Cannot govern the rate of %s, only of %s' % (', '.join(unknown),
+                                                                          ', '.join(GOVERNED_STAGES)))
+        self._rates = dict(rates)
+
+        # Temperature in degree Celsius to stay below, and how far below it rates are raised again
+        self._target_temperature = target_temperature
+        self._hysteresis = hysteresis
+
+        # Latency in seconds from capture to the servos the given percentile should stay below
+        self._target_latency = target_latency
+        self._latency_percentile = latency_percentile
+
+        # A clock below this ratio of its maximum counts as throttled if the stages load at least busy_load cores
+        self._throttled_ratio = throttled_ratio
+        self._busy_load = busy_load
+
+        # Factor a level is cut by, step it is raised by and the lowest level
+        self._decrease = decrease
+        self._increase = increase
+        self._min_level = min_level
+
+        # Seconds between decisions
+        self._interval = interval
+
+        self._levels = dict((name, 1.0) for name in self._rates)
+        self._last_update = None
+        self._cpu_times = {}
+        self._latency_count = 0
+        self._servo_control = None
+
+    def levels(self):
+        return dict(self._levels)
+
+    def rate(self, name):
+        # Rate a stage is limited to in Hz, None if it is not limited
+        level = self._levels.get(name, 1.0)
+        if level >= 1.0:
+            return None
+        return self._rates[name] * level
+
+    def update(self, stages, now=None):
+        '''
+        Take readings and decide on the rates of the stages, given by name,
+        if the interval has passed since the last decision. The rates are
+        applied every time, so a replaced stage gets them too. Returns the
+        reason of a decision or None.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        stages = dict((name, stage) for name, stage in stages.items() if name in self._rates)
+
+        reason = None
+        if self._last_update is None or now - self._last_update >= self._interval:
+            elapsed = now - self._last_update if self._last_update is not None else None
+            self._last_update = now
+            readings = self._read(stages, elapsed)
+            # ...the first readings only set the baseline of the loads and latencies
+            if elapsed is not None:
+                reason = self._decide(readings)
+
+        self._apply(stages)
+        return reason
+
+    def _apply(self, stages):
+        for name, stage in stages.items():
+            stage.set_rate(self.rate(name))
+
+    def _read(self, stages, elapsed):
+        readings = {
+            'temperature': self._sensors.temperature(),
+            'frequency': self._sensors.frequency(),
+            'max_frequency': self._sensors.max_frequency(),
+            'latency': None,
+            'loads': self._loads(stages, elapsed),
+        }
+
+        # ...latencies recorded since the last readings, counted afresh for a replaced stage
+        servo_control = stages.get('servo_control')
+        if servo_control is not None:
+            if servo_control is not self._servo_control:
+                self._servo_control = servo_control
+                self._latency_count = 0
+            latencies, self._latency_count = servo_control.get_new_latencies(self._latency_count)
+            if len(latencies):
+                readings['latency'] = float(np.percentile(latencies, self._latency_percentile))
+
+        return readings
+
+    def _loads(self, stages, elapsed):
+        # CPU load of each stage in cores, None for all if stages share a process
+        pids = {}
+        for name, stage in stages.items():
+            pids[name] = [stage.pid] + (stage.get_worker_pids() if hasattr(stage, 'get_worker_pids') else [])
+
+        cpu_times = {}
+        for name in pids:
+            times = [self._sensors.cpu_time(pid) for pid in pids[name] if pid is not None]
+            if times and None not in times:
+                cpu_times[name] = (tuple(pids[name]), sum(times))
+
+        previous = self._cpu_times
+        self._cpu_times = cpu_times
+
+        all_pids = [pid for name in pids for pid in pids[name]]
+        if elapsed is None or len(all_pids) != len(set(all_pids)):
+            return None
+
+        loads = {}
+        for name, (stage_pids, cpu_time) in cpu_times.items():
+            # ...a replaced stage has new pids and no load until the next readings
+            if name in previous and previous[name][0] == stage_pids:
+                loads[name] = (cpu_time - previous[name][1]) / elapsed
+        return loads
+
+    def _decide(self, readings):
+        temperature = readings['temperature']
+        latency = readings['latency']
+        loads = readings['loads']
+        frequency = readings['frequency']
+        max_frequency = readings['max_frequency']
+
+        throttled = (frequency is not None and max_frequency and loads and
+                     frequency < self._throttled_ratio * max_frequency and sum(loads.values()) >= self._busy_load)
+
+        if temperature is not None and temperature >= self._target_temperature:
+            reason = 'temperature %.1f C above %.1f C' % (temperature, self._target_temperature)
+        elif latency is not None and latency >= self._target_latency:
+            reason = 'latency %.3f s above %.3f s' % (latency, self._target_latency)
+        elif throttled:
+            reason = 'clock throttled to %.0f of %.0f MHz' % (frequency, max_frequency)
+        else:
+            reason = None
+
+        old = dict((name, self.rate(name)) for name in self._levels)
+        if reason is not None:
+            self._cut(loads)
+        elif (temperature is None or temperature < self._target_temperature - self._hysteresis) and \
+                (latency is None or latency < 0.8 * self._target_latency):
+            self._raise()
+            reason = 'headroom'
+
+        changes = ['%s %s -> %s' % (name, self._format_rate(old[name]), self._format_rate(self.rate(name)))
+                   for name in sorted(self._levels) if self.rate(name) != old[name]]
+        details = self._format_readings(readings)
+        if changes:
+            logger.info('%s: %s (%s)', reason, ', '.join(changes), details)
+        else:
+            logger.debug('holding rates, %s (%s)', reason or 'within targets', details)
+        return reason if changes else None
+
+    def _cut(self, loads):
+        # Cut the stage with the highest load that can still be cut, or all stages if the loads are unknown
+        candidates = [name for name in self._levels if self._levels[name] > self._min_level]
+        if loads:
+            candidates = sorted((name for name in candidates if name in loads), key=lambda name: -loads[name])[:1]
+        for name in candidates:
+            self._levels[name] = max(self._levels[name] * self._decrease, self._min_level)
+
+    def _raise(self):
+        # Raise the stage that was cut furthest
+        name = min(self._levels, key=lambda name: self._levels[name])
+        if self._levels[name] < 1.0:
+            self._levels[name] = min(self._levels[name] + self._increase, 1.0)
+
+    @staticmethod
+    def _format_rate(rate):
+        return 'unlimited' if rate is None else '%.1f Hz' % rate
+
+    @staticmethod
+    def _format_readings(readings):
+        details = []
+        if readings['temperature'] is not None:
+            details.append('%.1f C' % readings['temperature'])
+        if readings['frequency'] is not None:
+            details.append('%.0f MHz' % readings['frequency'])
+        if readings['latency'] is not None:
+            details.append('latency %.3f s' % readings['latency'])
+        if readings['loads']:
+            details.append('load ' + ' '.join('%s %.2f' % (name, load)
+                                              for name, load in sorted(readings['loads'].items())))
+        return ', '.join(details)
@@ -0,0 +1,418 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _package in ('common', 'unwarping', 'face_detection', 'face_tracking', 'face_to_position', 'servo_control',
+                 'blink_detection', 'visualization', 'telemetry', 'supervisor'):
+    sys.path.insert(0, os.path.join(_HERE, '..', _package))
+
+# Modules of optional stages are only imported by the builders of enabled stages
+from FaceDetection import FaceDetection
+from FaceToPosition import FaceToPosition
+from FrameRing import FrameRing
+from FrameSource import open_source
+from Records import ANGLE_RECORD_SIZE, BLINK_RECORD_SIZE, DETECTIONS_RECORD_SIZE, FACE_RECORD_SIZE
+from ServoControl import ServoControl
+from StageStats import StageStats
+from StageThread import RUNTIMES, start_stage, stop_stage
+from Undistortion import output_camera
+from Unwarping import Unwarping
+from VersionedRecord import VersionedRecord
+
+logger = logging.getLogger('autofan.supervisor')
+
+# Stages in pipeline order, the telemetry recorder starts first and stops last so it drains every record
+STAGES = ('telemetry', 'unwarping', 'face_detection', 'face_tracking', 'face_to_position', 'servo_control',
+          'blink_detection', 'debug_view')
+
+# Stages that only run if enabled in the config
+OPTIONAL_STAGES = ('telemetry', 'face_tracking', 'debug_view')
+
+
+def launch_time():
+    '''
+    Time the calling process was launched, from the start time the kernel
+    keeps for it, so interpreter start-up and imports are included. None
+    where /proc is not available.
+    '''
+
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return time.time() - uptime + start_ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def pin_to_core(pid, core):
+    # Restrict a process to one CPU core
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, [core])
+    else:
+        subprocess.check_call(['taskset', '-p', '-c', str(core), str(pid)], stdout=open(os.devnull, 'w'))
+
+
+def set_realtime(pid, priority):
+    # Give a process FIFO real-time scheduling priority
+    if hasattr(os, 'sched_setscheduler'):
+        os.sched_setscheduler(pid, os.SCHED_FIFO, os.sched_param(priority))
+    else:
+        subprocess.check_call(['chrt', '-f', '-p', str(priority), str(pid)])
+
+
+class Supervisor(object):
+    '''
+    Builds all pipeline stages from one config, starts them in pipeline
+    order, pins them to CPU cores, gives configured stages real-time
+    priority and replaces stages that crash.
+
+    The shared channels between the stages (frame ring, detection, face and
+    angle records) are owned by the supervisor, so a replaced stage picks up
+    where the crashed one left off.
+
+    The stages run as processes, or with the "threads" runtime as threads of
+    the supervisor process (see StageThread), which saves a Python
+    interpreter and OpenCV per stage but cannot place stages on cores.
+
+    An optional governor lowers the camera, detection and servo rates as the
+    board heats up or latency grows, see Governor.
+    '''
+
+    def __init__(self, config):
+        self._config = config
+
+        camera = config['camera']
+        self._x = camera['x']
+        self._y = camera['y']
+
+        # Shared channels between the stages, the debug view briefly holds a frame slot of its own
+        slots = camera.get('ring_slots', 5)
+        if 'debug_view' in self.enabled():
+            slots += 1
+        out_x, out_y = output_camera(camera)[:2]
+        self._frame_ring = FrameRing(out_x, out_y, slots=slots)
+        self._face_record = VersionedRecord(FACE_RECORD_SIZE)
+        self._angle_record = VersionedRecord(ANGLE_RECORD_SIZE)
+        self._blink_record = VersionedRecord(BLINK_RECORD_SIZE)
+
+        # With face tracking, detections go to the tracker and the face record carries its predicted target
+        self._detections_record = None
+        self._detected_face_record = self._face_record
+        if 'face_tracking' in self.enabled():
+            self._detections_record = VersionedRecord(DETECTIONS_RECORD_SIZE)
+            self._detected_face_record = VersionedRecord(FACE_RECORD_SIZE)
+
+        # With telemetry, the control path records into channels the recorder drains
+        self._telemetry = {}
+        if 'telemetry' in self.enabled():
+            from TelemetryChannel import TelemetryChannel
+            capacity = config['telemetry'].get('capacity', 8192)
+            self._telemetry = {'face_to_position': TelemetryChannel(capacity),
+                               'servo_control': TelemetryChannel(capacity)}
+
+        # Processes or threads, see StageThread
+        self._runtime = config.get('runtime', 'processes')
+        if self._runtime not in RUNTIMES:
+            raise ValueError('Unknown runtime %r, expected one of %s' % (self._runtime, ', '.join(RUNTIMES)))
+
+        # Placement and priorities of the stages, only for processes
+        self._cores = config.get('cores', {})
+        self._realtime = config.get('realtime', {})
+
+        # Optional governor of the camera, detection and servo rates, see Governor
+        self._governor = None
+        governor = dict(config.get('governor', {}))
+        if governor.pop('enabled', False):
+            self._governor = self._build_governor(governor)
+
+        # Restart policy
+        restart = config.get('restart', {})
+        self._max_restarts = restart.get('max_restarts', 5)
+        self._restart_window = restart.get('window', 60.0)
+        self._restart_on_exit = restart.get('on_exit', False)
+
+        self._stages = {}
+        self._restarts = dict((name, []) for name in STAGES)
+        self._stopping = False
+
+        # Frames Unwarping found no free slot for when last checked, and whether that was reported
+        self._stalled = 0
+        self._stall_reported = False
+
+        # Launch time of the supervisor, start-up times are reported relative to it
+        self._launch = launch_time() or time.time()
+        self._startup_reported = False
+
+    def enabled(self):
+        return [name for name in STAGES
+                if self._config.get(name, {}).get('enabled', name not in OPTIONAL_STAGES)]
+
+    def start(self):
+        if self._runtime == 'threads' and (self._cores or self._realtime):
+            logger.warning('stages run as threads, core placement and real-time priorities are ignored')
+        for name in self.enabled():
+            self._start_stage(name)
+
+    def stop(self):
+        self._stopping = True
+
+        # ...stop in reverse pipeline order so no stage waits for a stopped producer
+        for name in reversed(self.enabled()):
+            stage = self._stages.get(name)
+            if stage is not None:
+                stop_stage(stage)
+
+    def supervise(self, interval=0.5):
+        # Replace crashed stages until stopped
+        while not self._stopping:
+            if not self._startup_reported:
+                self._report_startup()
+            if self._governor is not None:
+                self._governor.update(self._stages)
+            for name, stage in list(self._stages.items()):
+                if stage.is_alive() or self._stopping:
+                    continue
+                if stage.exitcode == 0 and not self._restart_on_exit:
+                    continue
+                self._restart_stage(name, stage)
+            self._check_frame_ring()
+            time.sleep(interval)
+
+    def get_stage(self, name):
+        return self._stages.get(name)
+
+    def startup_times(self):
+        '''
+        Seconds from launch until each stage was set up ("<stage>_ready"),
+        until the first frame was unwarped, the first face was detected and
+        the servos first moved for a face. What has not happened yet is left
+        out.
+        '''
+
+        times = {}
+        milestones = {'unwarping': 'first_frame', 'face_detection': 'first_face', 'servo_control': 'first_actuation'}
+        for name in self._stages:
+            try:
+                snapshot = StageStats(name, readonly=True).snapshot()
+            except (IOError, OSError, ValueError):
+                continue
+            if snapshot['ready']:
+                times[name + '_ready'] = snapshot['ready'] - self._launch
+            if name in milestones and snapshot['first_output']:
+                times[milestones[name]] = snapshot['first_output'] - self._launch
+        return times
+
+    def _report_startup(self):
+        # Log the start-up times once the servos moved for the first time
+        times = self.startup_times()
+        if 'first_actuation' not in times:
+            return
+        self._startup_reported = True
+        logger.info('start-up: %s', ', '.join('%s %.2f s' % (key, value) for key, value in
+                                              sorted(times.items(), key=lambda item: item[1])))
+
+    def _restart_stage(self, name, stage):
+        now = time.time()
+        recent = [t for t in self._restarts[name] if now - t < self._restart_window]
+        if len(recent) >= self._max_restarts:
+            logger.error('%s exited with code %s and was restarted %d times within %.0f s, giving up',
+                         name, stage.exitcode, len(recent), self._restart_window)
+            del self._stages[name]
+            return
+
+        logger.warning('%s exited with code %s, restarting', name, stage.exitcode)
+        # ...stop what is left of a stage made of several processes or threads
+        if not stop_stage(stage):
+            # ...a second instance next to a thread that is still running would share its camera and records
+            logger.error('%s did not stop and cannot be restarted next to itself, giving up', name)
+            del self._stages[name]
+            return
+        if hasattr(stage, 'release'):
+            stage.release()
+
+        # ...free the frame ring slots and the lock its processes may have died holding
+        if self._runtime == 'processes':
+            pids = [stage.pid] + (stage.get_worker_pids() if hasattr(stage, 'get_worker_pids') else [])
+            freed = self._frame_ring.reclaim(pids)
+            if freed:
+                logger.warning('freed %d frame ring slots %s held', freed, name)
+
+        self._restarts[name] = recent + [now]
+        self._start_stage(name)
+
+    def _check_frame_ring(self):
+        # Free slots of consumers that died without releasing them once Unwarping finds no free slot
+        stalled = self._frame_ring.stalled()
+        if stalled == self._stalled:
+            self._stall_reported = False
+            return
+        self._stalled = stalled
+
+        # ...threads share the pid of this process and release their slots even when they fail
+        freed = self._frame_ring.reclaim() if self._runtime == 'processes' else 0
+        if freed:
+            logger.warning('freed %d frame ring slots held by processes that died', freed)
+        elif not self._stall_reported:
+            logger.error('frame ring has no free slot, consumers hold every slot, %d frames lost so far', stalled)
+            self._stall_reported = True
+
+    def _start_stage(self, name):
+        stage = getattr(self, '_build_' + name)(dict(self._config.get(name, {})))
+        stage = start_stage(stage, self._runtime)
+        self._stages[name] = stage
+        logger.info('started %s as pid %d', name, stage.pid)
+        if self._runtime == 'threads':
+            return
+
+        # ...place the stage on its core, a stage with workers spreads them over a list of cores
+        if name in self._cores:
+            cores = self._cores[name]
+            if not isinstance(cores, list):
+                cores = [cores]
+            pids = [stage.pid]
+            if hasattr(stage, 'get_worker_pids'):
+                pids += stage.get_worker_pids()
+            for i, pid in enumerate(pids):
+                try:
+                    pin_to_core(pid, cores[max(i - 1, 0) % len(cores)])
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logger.warning('could not pin %s to core %s: %s', name, cores, e)
+        if name in self._realtime:
+            try:
+                set_realtime(stage.pid, self._realtime[name])
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning('could not set real-time priority of %s: %s', name, e)
+
+    def _build_governor(self, kwargs):
+        from Governor import Governor
+        from SystemSensors import SystemSensors
+        # ...the rates the stages reach on a cool board, the servos tick at their update frequency
+        rates = {'unwarping': 30.0, 'face_detection': 15.0, 'servo_control': self._config['servo_control']['f']}
+        rates.update(kwargs.pop('rates', {}))
+        # ...sensors may point at a tree of stand-in files instead of /sys and /proc, see SystemSensors
+        return Governor(SystemSensors(kwargs.pop('sensors', '/')), rates, **kwargs)
+
+    def _build_unwarping(self, kwargs):
+        camera = dict(self._config['camera'])
+        K = np.array([[camera['f_x'], 0., camera['c_x']],
+                      [0., camera['f_y'], camera['c_y']],
+                      [0., 0., 1.]])
+        source = open_source(camera.get('source', 0), self._x, self._y,
+                             paced=camera.get('paced', True), loop=camera.get('loop', False),
+                             latest_frame=camera.get('latest_frame', False))
+        kwargs.pop('enabled', None)
+        return Unwarping(self._x, self._y, K, tuple(camera['d']),
+                         out_x=camera.get('out_x'), out_y=camera.get('out_y'),
+                         frame_ring=self._frame_ring, source=source, **kwargs)
+
+    def _build_face_detection(self, kwargs):
+        kwargs.pop('enabled', None)
+        if 'minsize' in kwargs:
+            kwargs['minsize'] = tuple(kwargs['minsize'])
+        if 'track_scale_range' in kwargs:
+            kwargs['track_scale_range'] = tuple(kwargs['track_scale_range'])
+        kwargs.setdefault('classifier', os.path.join(_HERE, '..', 'face_detection',
+                                                     'haarcascade_frontalface_alt2.xml'))
+        if self._detections_record is not None:
+            # ...let the tracker see every face, not only the biggest
+            kwargs.setdefault('find_biggest', False)
+            kwargs['detections_record'] = self._detections_record
+        ring = self._frame_ring
+        if kwargs.get('workers', 1) > 1:
+            from ParallelFaceDetection import ParallelFaceDetection
+            return ParallelFaceDetection(ring.shape[1], ring.shape[0], ring,
+                                         face_record=self._detected_face_record, **kwargs)
+        kwargs.pop('workers', None)
+        return FaceDetection(ring.shape[1], ring.shape[0], frame_ring=ring,
+                             face_record=self._detected_face_record, **kwargs)
+
+    def _build_face_tracking(self, kwargs):
+        from FaceTracking import FaceTracking
+        kwargs.pop('enabled', None)
+        return FaceTracking(self._detections_record, self._face_record, **kwargs)
+
+    def _build_face_to_position(self, kwargs):
+        kwargs.pop('enabled', None)
+        # ...face boxes are measured in the unwarped frames, at their resolution and focal lengths
+        out_x, out_y, f_x, f_y = output_camera(self._config['camera'])
+        return FaceToPosition(kwargs.pop('face_width'), out_x, out_y, f_x, f_y,
+                              tuple(kwargs.pop('fan_position')),
+                              face_record=self._face_record, angle_record=self._angle_record,
+                              telemetry=self._telemetry.get('face_to_position'), **kwargs)
+
+    def _build_servo_control(self, kwargs):
+        kwargs.pop('enabled', None)
+        return ServoControl(kwargs.pop('servo_horizontal'), kwargs.pop('m_horizontal'), kwargs.pop('b_horizontal'),
+                            kwargs.pop('servo_vertical'), kwargs.pop('m_vertical'), kwargs.pop('b_vertical'),
+                            kwargs.pop('f'), kwargs.pop('speed'), kwargs.pop('pwm_min'), kwargs.pop('pwm_max'),
+                            angle_record=self._angle_record, telemetry=self._telemetry.get('servo_control'),
+                            **kwargs)
+
+    def _build_telemetry(self, kwargs):
+        from TelemetryRecorder import TelemetryRecorder
+        kwargs.pop('enabled', None)
+        kwargs.pop('capacity', None)
+        return TelemetryRecorder(os.path.expanduser(kwargs.pop('path')), self._telemetry, **kwargs)
+
+    def _build_blink_detection(self, kwargs):
+        from BlinkDetection import BlinkDetection
+        kwargs.pop('enabled', None)
+        # ...the eyes are looked for where the face was detected, not where it is predicted to be
+        return BlinkDetection(self._frame_ring, self._detected_face_record, blink_record=self._blink_record,
+                              **kwargs)
+
+    def _build_debug_view(self, kwargs):
+        from DebugView import DebugView
+        kwargs.pop('enabled', None)
+        f_x, f_y = output_camera(self._config['camera'])[2:]
+        blink_record = self._blink_record if 'blink_detection' in self.enabled() else None
+        return DebugView(self._frame_ring, self._face_record, self._angle_record, blink_record,
+                         face_width=self._config['face_to_position']['face_width'],
+                         f_x=f_x, f_y=f_y,
+                         fan_position=tuple(self._config['face_to_position']['fan_position']), **kwargs)
+
+
+def load_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the AutoFan pipeline.')
+    parser.add_argument('config', nargs='?', default=os.path.join(_HERE, 'autofan.json'),
+                        help='pipeline config file (JSON)')
+    parser.add_argument('--runtime', choices=RUNTIMES, help='run the stages as processes or threads, '
+                                                            'overrides the config')
+    parser.add_argument('--verbose', action='store_true', help='log every stage start')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    config = load_config(args.config)
+    if args.runtime:
+        config['runtime'] = args.runtime
+
+    supervisor = Supervisor(config)
+    supervisor_pid = os.getpid()
+
+    def shutdown(signum, frame):
+        # Stages inherit this handler, they are stopped through their exit events instead
+        if os.getpid() == supervisor_pid:
+            supervisor.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    supervisor.start()
+    supervisor.supervise()
@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from Records import TELEMETRY_DTYPE
+from StageStats import StageStats
+
+# File header: magic, record size, number of records, number of records lost
+_MAGIC, _RECORD_SIZE, _COUNT, _LOST = range(4)
+_HEADER_SIZE = 8
+_MAGIC_VALUE = 0x4175746f46616e02
+
+
+def read_telemetry(path):
+    '''
+    Read a recording written by TelemetryRecorder, returns a structured
+    array of TELEMETRY_DTYPE records in time order.
+    '''
+
+    header = np.fromfile(path, dtype='int64', count=_HEADER_SIZE)
+    if len(header) < _HEADER_SIZE or header[_MAGIC] != _MAGIC_VALUE:
+        raise ValueError('Not a telemetry recording: ' + path)
+    if header[_RECORD_SIZE] != TELEMETRY_DTYPE.itemsize:
+        raise ValueError('Telemetry recording %s has records of %d bytes, expected %d'
+                         % (path, header[_RECORD_SIZE], TELEMETRY_DTYPE.itemsize))
+
+    with open(path, 'rb') as f:
+        f.seek(_HEADER_SIZE * 8)
+        return np.fromfile(f, dtype=TELEMETRY_DTYPE, count=int(header[_COUNT]))
+
+
+class TelemetryRecorder(multiprocessing.Process):
+    '''
+    Background flusher of telemetry channels.
+
+    The stages write their records into TelemetryChannels in shared memory.
+    This process drains them every interval seconds and appends the records,
+    merged in time order, to a memory-mapped file that grows in chunks. The
+    number of records in the header is only advanced after the records have
+    been written, so a recording cut off by a power loss stays readable.
+    '''
+
+    def __init__(self, path, channels, interval=1.0, chunk=65536, stats=None):
+
+        # Initialize multiprocessing.Process parent
+        multiprocessing.Process.__init__(self)
+
+        # Exit event for stopping process
+        self._exit = multiprocessing.Event()
+
+        # Recording file, strftime directives are replaced by the start time
+        self.path = time.strftime(path)
+
+        # The channels to drain, by name
+        self._channels = channels
+
+        # Drain interval in seconds and number of records the file grows by
+        self._interval = interval
+        self._chunk = chunk
+
+        # A stats record in shared memory that is updated every drain
+        if stats is None:
+            stats = StageStats('telemetry')
+        self._stats = stats
+
+    def run(self):
+        # Clear events
+        self._exit.clear()
+
+        self._stats.started()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Create the file with its header
+        header = np.zeros(_HEADER_SIZE, dtype='int64')
+        header[_MAGIC] = _MAGIC_VALUE
+        header[_RECORD_SIZE] = TELEMETRY_DTYPE.itemsize
+        header.tofile(self.path)
+        header = np.memmap(self.path, dtype='int64', mode='r+', shape=(_HEADER_SIZE,))
+
+        # Read counts of the channels
+        reads = dict((name, 0) for name in self._channels)
+
+        # Mapped chunk of the file the next records go to, and its position in records
+        chunk = None
+        chunk_start = 0
+
+        # While exit event is not set, and once more after it is set...
+        while True:
+            stopping = self._exit.wait(self._interval)
+
+            start = time.time()
+
+            # ...drain every channel and merge the records in time order
+            drained = []
+            for name, channel in self._channels.items():
+                records, reads[name], lost = channel.drain(reads[name])
+                drained.append(records)
+                if lost:
+                    header[_LOST] += lost
+                    self._stats.dropped(lost)
+            records = np.concatenate(drained) if drained else np.zeros(0, dtype=TELEMETRY_DTYPE)
+            records = records[np.argsort(records['time'], kind='mergesort')]
+            self._stats.consumed(len(records))
+
+            # ...append them chunk by chunk
+            written = 0
+            while written < len(records):
+                count = int(header[_COUNT])
+                if chunk is None or count >= chunk_start + self._chunk:
+                    chunk, chunk_start = self._map_chunk(chunk, count)
+                n = min(len(records) - written, chunk_start + self._chunk - count)
+                chunk[count - chunk_start:count - chunk_start + n] = records[written:written + n]
+                written += n
+                chunk.flush()
+                header[_COUNT] = count + n
+            header.flush()
+
+            self._stats.iteration(time.time() - start)
+            if len(records):
+                self._stats.output()
+
+            if stopping:
+                break
+
+        # ...cut off the unused part of the last chunk
+        count = int(header[_COUNT])
+        del chunk
+        del header
+        with open(self.path, 'r+b') as f:
+            f.truncate(_HEADER_SIZE * 8 + count * TELEMETRY_DTYPE.itemsize)
+
+    def _map_chunk(self, chunk, count):
+        # Grow the file by one chunk and map it
+        if chunk is not None:
+            chunk.flush()
+        offset = _HEADER_SIZE * 8 + count * TELEMETRY_DTYPE.itemsize
+        with open(self.path, 'r+b') as f:
+            f.truncate(offset + self._chunk * TELEMETRY_DTYPE.itemsize)
+        return np.memmap(self.path, dtype=TELEMETRY_DTYPE, mode='r+', offset=offset, shape=(self._chunk,)), count
+
+    def terminate(self):
+        # Set exit event
+        self._exit.set()
+
+    def get_path(self):
+        return self.path
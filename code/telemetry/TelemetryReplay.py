@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _package in ('common', 'unwarping', 'face_to_position', 'servo_control'):
+    sys.path.insert(0, os.path.join(_HERE, '..', _package))
+
+from Records import TELEMETRY_ANGLES, TELEMETRY_FACE, TELEMETRY_SERVO
+from StageStats import StageStats
+from TelemetryRecorder import read_telemetry
+
+
+class TelemetryReplay(object):
+    '''
+    Feeds a telemetry recording back into FaceToPosition or ServoControl,
+    without their processes and without waiting for real time, and compares
+    what they compute now with what they computed during the recording.
+    '''
+
+    def __init__(self, records):
+        self._records = records
+
+    @classmethod
+    def load(cls, path):
+        return cls(read_telemetry(path))
+
+    def records(self, kind):
+        return self._records[self._records['kind'] == kind]
+
+    def replay_face_to_position(self, face_to_position):
+        '''
+        Compute the angles for every recorded face. Returns the replayed
+        angles and a summary of how far they are from the recorded ones.
+
+        A face is paired with the angles written right after it for the same
+        capture, so records the recorder lost drop out of the comparison
+        instead of shifting the faces against the angles. Faces without
+        angles are counted as unpaired.
+        '''
+
+        records = self._records[(self._records['kind'] == TELEMETRY_FACE) |
+                                (self._records['kind'] == TELEMETRY_ANGLES)]
+        paired = np.flatnonzero((records['kind'][:-1] == TELEMETRY_FACE) &
+                                (records['kind'][1:] == TELEMETRY_ANGLES) &
+                                (records['capture'][:-1] == records['capture'][1:]))
+        faces = records[paired]
+        recorded = records[paired + 1]['values'][:, :2]
+
+        start = time.time()
+        replayed = np.array([face_to_position.compute_angles(*face[:4]) for face in faces['values']],
+                            dtype='float64').reshape((-1, 2))
+        elapsed = time.time() - start
+
+        summary = self._summary(faces, elapsed, replayed, recorded)
+        summary['unpaired'] = int(np.sum(records['kind'] == TELEMETRY_FACE)) - len(faces)
+        return replayed, summary
+
+    def replay_servo_control(self, servo_control):
+        '''
+        Run the control steps of every recorded tick with the recorded
+        target angles and time steps. Returns the replayed filtered angles
+        and pwm values and a summary of how far they are from the recorded
+        ones.
+
+        The state of the trajectories and the filter is not recorded, so the
+        replay starts them at rest at the first recorded angles. It is only
+        exact for a recording that starts at rest; summary['from_rest'] tells
+        whether the first step matched, which it does not for a recording
+        that starts in motion.
+        '''
+
+        ticks = self.records(TELEMETRY_SERVO)
+        if len(ticks) == 0:
+            return np.zeros((0, 4)), self._summary(ticks, 0.0, np.zeros((0, 2)), np.zeros((0, 2)))
+
+        values = ticks['values']
+
+        # ...start at rest where the recording starts, a recording that starts in motion will not match
+        servo_control.reset_control(values[0, 2], values[0, 3])
+
+        start = time.time()
+        replayed = [tuple(values[0, 2:6])]
+        for i in range(1, len(ticks)):
+            filtered, pwms = servo_control.control_step(values[i, 0], values[i, 1],
+                                                        ticks['time'][i] - ticks['time'][i - 1])
+            replayed.append(filtered + pwms)
+        elapsed = time.time() - start
+
+        replayed = np.array(replayed, dtype='float64')
+        summary = self._summary(ticks, elapsed, replayed[:, :2], values[:, 2:4])
+        summary['pwm_mismatches'] = int(np.sum(np.any(replayed[:, 2:] != values[:, 4:6], axis=1)))
+        summary['from_rest'] = len(ticks) < 2 or bool(np.all(np.abs(replayed[1, :2] - values[1, 2:4]) < 1e-9))
+        return replayed, summary
+
+    @staticmethod
+    def _summary(records, elapsed, replayed, recorded):
+        span = records['time'][-1] - records['time'][0] if len(records) > 1 else 0.0
+        errors = np.abs(replayed - recorded)
+        return {
+            'records': len(records),
+            'seconds': elapsed,
+            'speedup': span / elapsed if elapsed > 0 else float('inf'),
+            'max_error': float(np.nanmax(errors)) if errors.size else 0.0,
+        }
+
+
+def build_face_to_position(config, stats_dir):
+    from FaceToPosition import FaceToPosition
+    from Undistortion import output_camera
+
+    # ...the same geometry as the supervisor builds the stage with, see Supervisor._build_face_to_position()
+    out_x, out_y, f_x, f_y = output_camera(config['camera'])
+    kwargs = dict(config['face_to_position'])
+    kwargs.pop('enabled', None)
+    return FaceToPosition(kwargs.pop('face_width'), out_x, out_y, f_x, f_y,
+                          tuple(kwargs.pop('fan_position')), stats=StageStats('face_to_position', stats_dir),
+                          **kwargs)
+
+
+def build_servo_control(config, stats_dir):
+    from ServoBackend import RecorderBackend
+    from ServoControl import ServoControl
+
+    kwargs = dict(config['servo_control'])
+    kwargs.pop('enabled', None)
+    return ServoControl(kwargs.pop('servo_horizontal'), kwargs.pop('m_horizontal'), kwargs.pop('b_horizontal'),
+                        kwargs.pop('servo_vertical'), kwargs.pop('m_vertical'), kwargs.pop('b_vertical'),
+                        kwargs.pop('f'), kwargs.pop('speed'), kwargs.pop('pwm_min'), kwargs.pop('pwm_max'),
+                        backend=RecorderBackend(), stats=StageStats('servo_control', stats_dir), **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay an AutoFan telemetry recording through the control path.')
+    parser.add_argument('recording', help='telemetry recording written by TelemetryRecorder')
+    parser.add_argument('--config', default=os.path.join(_HERE, '..', 'supervisor', 'autofan.json'),
+                        help='pipeline config the stages are built from')
+    parser.add_argument('--stage', choices=('face_to_position', 'servo_control', 'all'), default='all')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='largest accepted angle error in degree')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    # The replayed stages keep their stats away from the ones of a running pipeline
+    stats_dir = tempfile.mkdtemp(prefix='autofan_replay_')
+
+    replay = TelemetryReplay.load(args.recording)
+    failed = False
+
+    try:
+        if args.stage in ('face_to_position', 'all'):
+            summary = replay.replay_face_to_position(build_face_to_position(config, stats_dir))[1]
+            line = 'face_to_position: %(records)d faces in %(seconds).3f s (%(speedup).0fx), ' \
+                   'max angle error %(max_error).3g deg, %(unpaired)d unpaired' % summary
+            print line
+            failed = failed or summary['max_error'] > args.tolerance
+
+        if args.stage in ('servo_control', 'all'):
+            summary = replay.replay_servo_control(build_servo_control(config, stats_dir))[1]
+            summary.setdefault('pwm_mismatches', 0)
+            summary.setdefault('from_rest', True)
+            line = 'servo_control: %(records)d ticks in %(seconds).3f s (%(speedup).0fx), ' \
+                   'max angle error %(max_error).3g deg, %(pwm_mismatches)d pwm mismatches' % summary
+            if not summary['from_rest']:
+                line += ', recording starts in motion so it cannot match exactly'
+            print line
+            failed = failed or summary['max_error'] > args.tolerance or summary['pwm_mismatches'] > 0
+    finally:
+        shutil.rmtree(stats_dir, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
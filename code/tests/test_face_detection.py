@@ -0,0 +1,69 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _package in ('common', 'face_detection'):
+    sys.path.insert(0, os.path.join(_HERE, '..', _package))
+
+from FaceDetection import FaceDetection
+from FrameRing import FrameRing
+from StageStats import StageStats
+
+
+class RecordingDetector(object):
+    # Stands in for a cascade, remembers the shape of the images it searched and finds nothing
+    def __init__(self):
+        self.searched = []
+
+    def detect(self, frame, minsize=(60, 60), maxsize=None, find_biggest=True):
+        self.searched.append(frame.shape)
+        return np.zeros((0, 4), dtype='int32')
+
+
+class RemapWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.stats_dir = tempfile.mkdtemp(prefix='autofan_test_')
+        self.ring = FrameRing(64, 48)
+        self.detection = FaceDetection(64, 48, frame_ring=self.ring, tracking=True, remap_window=True,
+                                       use_lowpass=False, stats=StageStats('face_detection', self.stats_dir))
+        self.detection._detector = RecordingDetector()
+        self.frame = np.zeros((48, 64), dtype='uint8')
+
+    def tearDown(self):
+        shutil.rmtree(self.stats_dir, ignore_errors=True)
+
+    def test_requests_the_tracking_window(self):
+        self.detection._trackedface = (20, 16, 10, 10)
+        self.detection._request_window(self.frame.shape)
+        self.assertEqual(self.ring.requested_region(), (15, 11, 20, 20))
+
+    def test_requests_whole_frames_for_a_full_search(self):
+        self.ring.request_region((15, 11, 20, 20))
+        self.detection._process_frame(self.frame, 1.0)
+        self.assertEqual(self.detection._detector.searched, [(48, 64)])
+        self.assertIsNone(self.ring.requested_region())
+
+    def test_skips_partial_frames_when_a_full_search_is_due(self):
+        self.detection._process_frame(self.frame, 1.0, (15, 11, 20, 20))
+        self.assertEqual(self.detection._detector.searched, [])
+        self.assertEqual(self.detection._stats.snapshot()['skipped'], 1)
+
+    def test_tracks_only_within_the_unwarped_region(self):
+        self.detection._trackedface = (20, 16, 10, 10)
+        self.detection._process_frame(self.frame, 1.0, (20, 11, 15, 10))
+        self.assertEqual(self.detection._detector.searched, [(10, 15)])
+
+    def test_needs_tracking_without_tracker_or_motion_gate(self):
+        self.assertRaises(ValueError, FaceDetection, 64, 48, remap_window=True,
+                          stats=StageStats('face_detection', self.stats_dir))
+        self.assertRaises(ValueError, FaceDetection, 64, 48, tracking=True, remap_window=True,
+                          motion_threshold=4.0, stats=StageStats('face_detection', self.stats_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
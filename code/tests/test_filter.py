@@ -0,0 +1,40 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'common'))
+
+from Filter import FILTERS, create_filter
+
+# A config of every filter
+CONFIGS = [{'type': 'lowpass', 'rc': 0.1}, {'type': 'highpass', 'rc': 0.1},
+           {'type': 'one_euro', 'min_cutoff': 1.0, 'beta': 0.1}, {'type': 'critically_damped', 'omega': 10.0}]
+
+
+class FilterTest(unittest.TestCase):
+    def test_every_filter_has_a_config(self):
+        self.assertEqual(sorted(c['type'] for c in CONFIGS), sorted(FILTERS))
+
+    def test_first_value_older_than_reset_sets_the_state(self):
+        for config in CONFIGS:
+            f = create_filter(config)
+            f.reset(timestamp=10.0)
+            first = f.filter([1.0, 2.0], 9.0)
+            self.assertTrue(np.all(np.isfinite(first)), config)
+            self.assertTrue(np.array_equal(f.filter([1.0, 2.0], 9.5), first), config)
+
+    def test_older_values_and_negative_steps_are_dropped(self):
+        for config in CONFIGS:
+            f = create_filter(config)
+            f.filter([0.0], 1.0)
+            value = f.filter([1.0], 1.1)
+            self.assertTrue(np.array_equal(f.filter([5.0], 1.05), value), config)
+            self.assertTrue(np.array_equal(f.step([5.0], -0.1), value), config)
+            self.assertTrue(np.array_equal(f.step([5.0], 0.0), value), config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _package in ('common', 'unwarping'):
+    sys.path.insert(0, os.path.join(_HERE, '..', _package))
+
+from FrameRing import FrameRing
+from StageStats import StageStats
+
+
+def write_frame(ring, value, region=None):
+    # Write a frame of a single grey value, only within region if given, and commit it
+    slot = ring.begin_write()
+    frame = ring.frame(slot)
+    if region is None:
+        frame[:] = value
+    else:
+        x, y, w, h = region
+        frame[y:y + h, x:x + w] = value
+    ring.commit(slot, float(value), region)
+    return slot
+
+
+def hold_and_die(ring, lock=False):
+    # Run in a child process that dies without releasing what it holds
+    if lock:
+        ring._locked().__enter__()
+    else:
+        ring.acquire_latest(timeout=1.0)
+    os._exit(0)
+
+
+class FrameRingTest(unittest.TestCase):
+    def test_acquire_newer_frames_only(self):
+        ring = FrameRing(8, 6)
+        self.assertIsNone(ring.acquire_latest(timeout=0))
+
+        write_frame(ring, 1)
+        slot = ring.acquire_latest(timeout=0)
+        self.assertEqual(ring.sequence(slot), 1)
+        ring.release(slot)
+        self.assertIsNone(ring.acquire_latest(1, timeout=0.01))
+
+    def test_held_slots_are_not_overwritten(self):
+        ring = FrameRing(8, 6, slots=2)
+        write_frame(ring, 1)
+        held = ring.acquire_latest(timeout=0)
+        write_frame(ring, 2)
+
+        # ...one slot holds the newest frame, the other is held by the consumer
+        self.assertIsNone(ring.begin_write())
+        self.assertEqual(ring.stalled(), 1)
+        self.assertTrue(np.all(ring.frame(held) == 1))
+
+        ring.release(held)
+        self.assertEqual(ring.begin_write(), held)
+
+    def test_reclaim_slots_of_a_dead_consumer(self):
+        ring = FrameRing(8, 6, slots=2)
+        write_frame(ring, 1)
+        consumer = multiprocessing.Process(target=hold_and_die, args=(ring,))
+        consumer.start()
+        consumer.join()
+        write_frame(ring, 2)
+        self.assertIsNone(ring.begin_write())
+
+        # ...slots of live holders stay held
+        held = ring.acquire_latest(timeout=0)
+        self.assertEqual(ring.reclaim(), 1)
+        self.assertEqual(ring.reclaim([consumer.pid]), 0)
+        self.assertIsNotNone(ring.begin_write())
+        self.assertEqual(ring._readers[held], 1)
+
+    def test_reclaim_lock_of_a_dead_process(self):
+        ring = FrameRing(8, 6)
+        process = multiprocessing.Process(target=hold_and_die, args=(ring, True))
+        process.start()
+        process.join()
+
+        self.assertEqual(ring.reclaim([process.pid], timeout=0.1), 0)
+        write_frame(ring, 1)
+        self.assertEqual(ring.latest_sequence(), 1)
+
+
+class FrameRingRegionTest(unittest.TestCase):
+    def test_whole_frames_by_default(self):
+        ring = FrameRing(8, 6)
+        slot = write_frame(ring, 1)
+        self.assertEqual(ring.region(slot), (0, 0, 8, 6))
+        self.assertTrue(ring.complete(slot))
+
+    def test_request_round_trip(self):
+        ring = FrameRing(8, 6)
+        self.assertIsNone(ring.requested_region())
+        ring.request_region((1, 2, 3, 4))
+        self.assertEqual(ring.requested_region(), (1, 2, 3, 4))
+        ring.request_region(None)
+        self.assertIsNone(ring.requested_region())
+
+    def test_reused_slot_marks_stale_pixels(self):
+        ring = FrameRing(8, 6, slots=2)
+
+        # ...fill both slots with whole frames, the third frame reuses the first slot for a region only
+        first = write_frame(ring, 1)
+        write_frame(ring, 2)
+        slot = write_frame(ring, 3, (2, 1, 4, 3))
+        self.assertEqual(slot, first)
+
+        x, y, w, h = ring.region(slot)
+        self.assertEqual((x, y, w, h), (2, 1, 4, 3))
+        self.assertFalse(ring.complete(slot))
+        self.assertTrue(np.all(ring.frame(slot)[y:y + h, x:x + w] == 3))
+
+        # ...outside the region the slot still holds the first frame, which is why region() must be honoured
+        outside = np.ones(ring.shape, dtype=bool)
+        outside[y:y + h, x:x + w] = False
+        self.assertTrue(np.all(ring.frame(slot)[outside] == 1))
+
+
+class UnwarpingRegionTest(unittest.TestCase):
+    def setUp(self):
+        import cv2
+        from Undistortion import Undistortion
+        from Unwarping import Unwarping
+
+        K = np.array([[60., 0., 16.], [0., 60., 12.], [0., 0., 1.]])
+        self.stats_dir = tempfile.mkdtemp(prefix='autofan_test_')
+        self.ring = FrameRing(32, 24, slots=2)
+        self.unwarper = Unwarping(32, 24, K, np.zeros(5), frame_ring=self.ring, map_cache_dir=None,
+                                  stats=StageStats('unwarping', self.stats_dir))
+        self.undistortion = Undistortion(32, 24, K, np.zeros(5), interpolation=cv2.INTER_NEAREST)
+
+    def tearDown(self):
+        shutil.rmtree(self.stats_dir, ignore_errors=True)
+
+    def test_region_remap_into_reused_slot(self):
+        old = np.full((24, 32), 200, dtype='uint8')
+        new = np.full((24, 32), 50, dtype='uint8')
+
+        slot = self.ring.begin_write()
+        self.undistortion.remap(old, dst=self.ring.frame(slot))
+        self.ring.commit(slot)
+        slot = self.ring.begin_write()
+        self.undistortion.remap(old, dst=self.ring.frame(slot))
+        self.ring.commit(slot)
+
+        # ...only the region of the new frame is remapped into the slot of the first one
+        slot = self.ring.begin_write()
+        self.undistortion.remap(new, roi=(8, 4, 10, 6), dst=self.ring.frame(slot))
+        self.ring.commit(slot, region=(8, 4, 10, 6))
+
+        frame = self.unwarper.get_current_frame()
+        self.assertTrue(np.all(frame[4:10, 8:18] == 50))
+
+        # ...legacy callers get black instead of the old frame outside the region
+        frame[4:10, 8:18] = 0
+        self.assertFalse(frame.any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'servo_control'))
+
+from ServoCalibration import LinearModel, PwmTable, load_tables, save_tables
+
+
+class PwmTableTest(unittest.TestCase):
+    def test_lookup_rounds_to_the_grid(self):
+        table = PwmTable([100, 101, 102, 103], 0.0, 0.5)
+        self.assertEqual(table.lookup(0.0), 100)
+        self.assertEqual(table.lookup(0.2), 100)
+        self.assertEqual(table.lookup(0.3), 101)
+        self.assertEqual(table.lookup(1.4), 103)
+
+    def test_lookup_beyond_the_ends(self):
+        table = PwmTable([100, 101, 102, 103], 0.0, 0.5)
+        self.assertEqual(table.lookup(-0.2), 100)
+        self.assertEqual(table.lookup(-30.0), 100)
+        self.assertEqual(table.lookup(30.0), 103)
+        self.assertEqual(table.angle_limits, (0.0, 1.5))
+
+    def test_compile_rounds_to_the_nearest_pwm(self):
+        for m, b in ((1.2290352706, 166.3342587025), (-1.2517764093, 166.7882520133)):
+            table = PwmTable.compile(LinearModel(m, b), 90, 226)
+            low, high = table.angle_limits
+            for angle in np.linspace(low, high, 50):
+                grid = table.angle_min + round((angle - table.angle_min) / table.resolution) * table.resolution
+                self.assertEqual(table.lookup(angle), int(round(m * grid + b)))
+            self.assertGreaterEqual(table.pwm_limits[0], 90)
+            self.assertLessEqual(table.pwm_limits[1], 225)
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp(prefix='autofan_test_')
+        try:
+            path = os.path.join(directory, 'calibration.npz')
+            table = PwmTable.compile(LinearModel(1.2, 160.0), 90, 226)
+            save_tables(path, {'horizontal': table})
+
+            loaded = load_tables(path)
+            self.assertEqual(sorted(loaded), ['horizontal'])
+            self.assertTrue(np.array_equal(loaded['horizontal'].pwms, table.pwms))
+            self.assertEqual(loaded['horizontal'].lookup(10.0), table.lookup(10.0))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import unittest
+
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'common'))
+
+from VersionedRecord import VersionedRecord
+
+
+def wait_and_die(record):
+    # Run in a child process that is killed while waiting for a new version
+    record.wait(record.version())
+
+
+class VersionedRecordTest(unittest.TestCase):
+    def test_read_retries_during_a_write(self):
+        record = VersionedRecord(3)
+        record.write([1.0, 1.0, 1.0])
+
+        # ...a write in progress, half of it stored so far
+        record._sequence[0] += 1
+        record._data[0] = 2.0
+
+        def finish():
+            time.sleep(0.05)
+            record._data[:] = 2.0
+            record._sequence[0] += 1
+
+        writer = threading.Thread(target=finish)
+        writer.start()
+        values, version = record.read()
+        writer.join()
+
+        self.assertEqual(values.tolist(), [2.0, 2.0, 2.0])
+        self.assertEqual(version, 2)
+
+    def test_claim_after_a_killed_write(self):
+        record = VersionedRecord(2)
+        record.write([1.0, 2.0])
+        record._sequence[0] += 1
+
+        record.claim()
+        self.assertEqual(record.read()[1], 2)
+        record.write([3.0, 4.0])
+        self.assertEqual(record.read()[0].tolist(), [3.0, 4.0])
+        self.assertEqual(record.version(), 3)
+
+    def test_failed_write_leaves_the_record_readable(self):
+        record = VersionedRecord(2)
+        record.write([1.0, 2.0])
+        self.assertRaises(ValueError, record.write, [1.0, 2.0, 3.0])
+
+        values, version = record.read()
+        self.assertEqual(values.tolist(), [1.0, 2.0])
+        self.assertEqual(version, 1)
+
+    def test_wait(self):
+        record = VersionedRecord(1)
+        self.assertFalse(record.wait(0, timeout=0.01))
+
+        writer = threading.Timer(0.05, record.write, ([1.0],))
+        writer.start()
+        self.assertTrue(record.wait(0, timeout=1.0))
+        writer.join()
+
+    def test_killed_reader_does_not_block_the_writer(self):
+        record = VersionedRecord(1)
+        reader = multiprocessing.Process(target=wait_and_die, args=(record,))
+        reader.start()
+        time.sleep(0.1)
+        reader.terminate()
+        reader.join()
+
+        writer = threading.Thread(target=record.write, args=([1.0],))
+        writer.daemon = True
+        writer.start()
+        writer.join(1.0)
+        self.assertFalse(writer.is_alive())
+        self.assertTrue(np.all(record.read()[0] == 1.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,384 @@
+import glob
+import math
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class FrameSource(object):
+    '''
+    Base class for everything Unwarping can read frames from.
+
+    read() returns a (frame, timestamp) tuple, or (None, None) once the
+    source is exhausted. Only finite sources (files, synthetic frames) are
+    ever exhausted, a camera raises IOError if it stops delivering frames,
+    so its stage fails and is restarted instead of ending cleanly. Frames
+    are either BGR or grayscale images of the requested size. In paced mode
+    frames are delivered at the source's frame rate, otherwise as fast as
+    they can be produced.
+    '''
+
+    def __init__(self, x=None, y=None, fps=30.0, paced=True):
+        self._x = x
+        self._y = y
+        self._fps = fps
+        self._paced = paced
+
+        # Number of frames delivered and the time the first one was delivered
+        self._count = 0
+        self._start = None
+
+    @property
+    def fps(self):
+        return self._fps
+
+    def read(self):
+        frame = self._next_frame()
+        if frame is None:
+            return None, None
+
+        if self._paced:
+            self._wait_for_slot()
+
+        self._count += 1
+        return self._fit(frame), time.time()
+
+    def open(self):
+        # Acquire the device, sources that need one open it on the first read otherwise
+        pass
+
+    def release(self):
+        pass
+
+    def _next_frame(self):
+        raise NotImplementedError
+
+    def _wait_for_slot(self):
+        # Sleep until the frame is due according to the frame rate
+        now = time.time()
+        if self._start is None:
+            self._start = now
+            return
+
+        due = self._start + self._count / float(self._fps)
+        if due > now:
+            time.sleep(due - now)
+
+    def _fit(self, frame):
+        # Scale frames to the requested size if necessary
+        if self._x is None or self._y is None:
+            return frame
+        if frame.shape[1] != self._x or frame.shape[0] != self._y:
+            frame = cv2.resize(frame, (self._x, self._y))
+        return frame
+
+
+class CameraSource(FrameSource):
+    def __init__(self, camid=0, x=640, y=480):
+        # The camera paces itself
+        FrameSource.__init__(self, x, y, paced=False)
+
+        # The camera is opened by the process that reads it, see open()
+        self._camid = camid
+        self._cam = None
+
+    def open(self):
+        # Setup camera object using OpenCV
+        if self._cam is not None:
+            return
+        self._cam = cv2.VideoCapture(self._camid)
+        self._cam.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, self._x)
+        self._cam.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, self._y)
+
+    def _next_frame(self):
+        self.open()
+        ok, frame = self._cam.read()
+        if not ok:
+            raise IOError('Camera %s stopped delivering frames' % self._camid)
+        return frame
+
+    def release(self):
+        if self._cam is not None:
+            self._cam.release()
+            self._cam = None
+
+
+class LatestFrameCameraSource(FrameSource):
+    '''
+    Camera source with a grabbing thread that keeps emptying the driver's
+    buffer queue, so read() always returns the newest frame instead of one
+    that waited in the queue.
+
+    If the camera delivers YUYV, the raw buffers are requested and only the
+    luma plane is taken, which is the grayscale image without any colour
+    conversion. Frames carry the driver's capture timestamp, mapped onto
+    time.time().
+    '''
+
+    def __init__(self, camid=0, x=640, y=480, yuyv=True):
+        # The camera paces itself
+        FrameSource.__init__(self, x, y, paced=False)
+
+        # The camera is opened by the process that reads it, see open()
+        self._camid = camid
+        self._yuyv = yuyv
+        self._cam = None
+
+        # Newest grabbed frame, its timestamp and sequence number, guarded by a condition
+        self._newest = None
+        self._newest_timestamp = None
+        self._newest_sequence = 0
+        self._delivered_sequence = 0
+        self._newframe = threading.Condition()
+
+        # Frames grabbed but never delivered because a newer one arrived first
+        self.skipped = 0
+
+        # Offset from driver timestamps to time.time(), the smallest delay seen between the two
+        self._clock_offset = None
+
+        # The grabbing thread is started on the first read(), in the process that reads
+        self._thread = None
+        self._running = False
+
+    def open(self):
+        # Setup camera object using OpenCV
+        if self._cam is not None:
+            return
+        self._cam = cv2.VideoCapture(self._camid)
+        self._cam.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, self._x)
+        self._cam.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, self._y)
+
+        # ...ask for raw YUYV buffers, drivers that cannot do it keep delivering BGR
+        if self._yuyv:
+            self._cam.set(cv2.cv.CV_CAP_PROP_FOURCC, cv2.cv.CV_FOURCC(*'YUYV'))
+            self._cam.set(cv2.cv.CV_CAP_PROP_CONVERT_RGB, 0)
+
+    def read(self):
+        if self._thread is None:
+            self.open()
+            self._running = True
+            self._thread = threading.Thread(target=self._grab_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+        # ...wait for a frame newer than the last one delivered
+        with self._newframe:
+            while self._running and self._newest_sequence <= self._delivered_sequence:
+                self._newframe.wait(1.0)
+            if self._newest_sequence <= self._delivered_sequence:
+                raise IOError('Camera %s stopped delivering frames' % self._camid)
+            frame = self._newest
+            timestamp = self._newest_timestamp
+            self.skipped += self._newest_sequence - self._delivered_sequence - 1
+            self._delivered_sequence = self._newest_sequence
+
+        self._count += 1
+        return self._fit(self._luma(frame)), timestamp
+
+    def _grab_loop(self):
+        while self._running:
+            # ...dequeue the next buffer, blocks until the driver has one
+            if not self._cam.grab():
+                break
+            grabbed = time.time()
+            ok, frame = self._cam.retrieve()
+            if not ok:
+                break
+            timestamp = self._driver_timestamp(grabbed)
+
+            with self._newframe:
+                self._newest = frame
+                self._newest_timestamp = timestamp
+                self._newest_sequence += 1
+                self._newframe.notify_all()
+
+        # ...wake up a waiting read() once the camera is gone
+        with self._newframe:
+            self._running = False
+            self._newframe.notify_all()
+
+    def _driver_timestamp(self, grabbed):
+        # Driver timestamps are in ms on a clock of their own, 0 if the backend has none
+        driver = self._cam.get(cv2.cv.CV_CAP_PROP_POS_MSEC) / 1000.0
+        if driver <= 0:
+            return grabbed
+
+        # ...the smallest delay between capture and grab is taken as the offset between the clocks
+        offset = grabbed - driver
+        if self._clock_offset is None or offset < self._clock_offset:
+            self._clock_offset = offset
+        return driver + self._clock_offset
+
+    def _luma(self, frame):
+        # Luma plane of a raw YUYV buffer (Y0 U Y1 V ...), other frames are returned as they are
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            return frame
+        data = frame.reshape(-1)
+        if data.size != self._x * self._y * 2:
+            return frame
+        return np.ascontiguousarray(data[0::2].reshape(self._y, self._x))
+
+    def release(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(1.0)
+        if self._cam is not None:
+            self._cam.release()
+            self._cam = None
+
+
+class VideoFileSource(FrameSource):
+    def __init__(self, path, x=None, y=None, paced=True, loop=False):
+        self._path = path
+        self._loop = loop
+        self._video = cv2.VideoCapture(path)
+        if not self._video.isOpened():
+            raise IOError('Could not open video file ' + path)
+
+        # Replay at the frame rate the video was recorded with
+        fps = self._video.get(cv2.cv.CV_CAP_PROP_FPS)
+        if not fps or math.isnan(fps):
+            fps = 30.0
+
+        FrameSource.__init__(self, x, y, fps=fps, paced=paced)
+
+    def _next_frame(self):
+        ok, frame = self._video.read()
+        if not ok and self._loop:
+            # ...start over from the beginning
+            self._video.release()
+            self._video = cv2.VideoCapture(self._path)
+            ok, frame = self._video.read()
+        if not ok:
+            return None
+        return frame
+
+    def release(self):
+        self._video.release()
+
+
+class ImageDirectorySource(FrameSource):
+    def __init__(self, path, x=None, y=None, fps=30.0, paced=True, loop=False,
+                 extensions=('.png', '.jpg', '.jpeg', '.bmp', '.pgm')):
+        FrameSource.__init__(self, x, y, fps=fps, paced=paced)
+
+        self._loop = loop
+
+        # Images are replayed in file name order
+        self._files = sorted(f for f in glob.glob(os.path.join(path, '*'))
+                             if os.path.splitext(f)[1].lower() in extensions)
+        if not self._files:
+            raise IOError('No images found in ' + path)
+
+        self._index = 0
+
+    def _next_frame(self):
+        if self._index >= len(self._files):
+            if not self._loop:
+                return None
+            self._index = 0
+
+        frame = cv2.imread(self._files[self._index], cv2.IMREAD_UNCHANGED)
+        self._index += 1
+        return frame
+
+
+class SyntheticFaceSource(FrameSource):
+    '''
+    Generates grayscale frames with a face moving along a Lissajous path over
+    a noisy background. A photo of a face can be given to get something the
+    cascades detect reliably, otherwise a simple drawn face is used.
+    '''
+
+    def __init__(self, x=640, y=480, fps=30.0, paced=True, frames=None,
+                 face_width=160, face_image=None, period=4.0, noise=8, seed=0):
+        FrameSource.__init__(self, x, y, fps=fps, paced=paced)
+
+        # Number of frames to generate, None for an endless stream
+        self._frames = frames
+
+        # Width of the face and time for one cycle of the motion in seconds
+        self._face_width = face_width
+        self._period = period
+
+        self._noise = noise
+        self._random = np.random.RandomState(seed)
+
+        # Background the face is drawn onto
+        self._background = cv2.GaussianBlur(
+            self._random.randint(0, 256, (y, x)).astype('uint8'), (0, 0), 15)
+
+        # Face template
+        self._face = self._make_face(face_image)
+
+        # Boundaries (x, y, w, h) of the face in the last generated frame
+        self.last_face = None
+
+    def _make_face(self, face_image):
+        w = self._face_width
+        h = int(w * 1.25)
+
+        if face_image is not None:
+            face = cv2.imread(face_image, cv2.IMREAD_GRAYSCALE)
+            if face is None:
+                raise IOError('Could not read face image ' + face_image)
+            return cv2.resize(face, (w, h))
+
+        # ...draw a simple face: head, eyes, eyebrows, nose and mouth
+        face = np.full((h, w), 90, dtype='uint8')
+        cv2.ellipse(face, (w // 2, h // 2), (w // 2 - 2, h // 2 - 2), 0, 0, 360, 200, -1)
+        for side in (-1, 1):
+            eye = (w // 2 + side * w // 5, int(h * 0.4))
+            cv2.ellipse(face, eye, (w // 10, w // 20), 0, 0, 360, 40, -1)
+            cv2.line(face, (eye[0] - w // 8, eye[1] - w // 8), (eye[0] + w // 8, eye[1] - w // 8), 60, 3)
+        cv2.line(face, (w // 2, int(h * 0.45)), (w // 2, int(h * 0.62)), 140, 3)
+        cv2.ellipse(face, (w // 2, int(h * 0.75)), (w // 5, w // 16), 0, 0, 360, 70, -1)
+        return face
+
+    def _next_frame(self):
+        if self._frames is not None and self._count >= self._frames:
+            return None
+
+        x = self._x or 640
+        y = self._y or 480
+        face_h, face_w = self._face.shape
+
+        # Position of the face on a Lissajous path through the frame
+        t = self._count / float(self._fps)
+        phase = 2 * math.pi * t / self._period
+        cx = (x - face_w) / 2.0 * (1 + 0.6 * math.sin(phase))
+        cy = (y - face_h) / 2.0 * (1 + 0.4 * math.sin(2 * phase))
+        left = int(cx)
+        top = int(cy)
+
+        frame = self._background.copy()
+        frame[top:top + face_h, left:left + face_w] = self._face
+        if self._noise:
+            frame = cv2.add(frame, self._random.randint(0, self._noise, frame.shape).astype('uint8'))
+
+        self.last_face = (left, top, face_w, face_h)
+        return frame
+
+
+def open_source(spec, x=640, y=480, paced=True, loop=False, latest_frame=False):
+    '''
+    Open a frame source from a short description: a camera id ("0"), the
+    path of a video file or image directory, or "synthetic". With
+    latest_frame, cameras are read through a grabbing thread that always
+    delivers the newest frame.
+    '''
+
+    spec = str(spec)
+    if spec.isdigit():
+        if latest_frame:
+            return LatestFrameCameraSource(int(spec), x, y)
+        return CameraSource(int(spec), x, y)
+    if spec == 'synthetic':
+        return SyntheticFaceSource(x, y, paced=paced)
+    if os.path.isdir(spec):
+        return ImageDirectorySource(spec, x, y, paced=paced, loop=loop)
+    return VideoFileSource(spec, x, y, paced=paced, loop=loop)
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+
+# Default location for cached remap tables
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'autofan')
+
+
+def output_camera_matrix(x, y, K, d, out_x=None, out_y=None):
+    '''
+    Camera matrix of the undistorted frames at the output resolution, the
+    one face boxes in unwarped frames are measured with.
+    '''
+
+    out_x = out_x if out_x is not None else x
+    out_y = out_y if out_y is not None else y
+
+    # Generate optimal camera matrix for the camera resolution...
+    K = np.asarray(K, dtype='float64')
+    camera_matrix = cv2.getOptimalNewCameraMatrix(K, np.asarray(d, dtype='float64'), (x, y), 0)[0].copy()
+
+    # ...and scale it to the output resolution
+    camera_matrix[0, :] *= float(out_x) / x
+    camera_matrix[1, :] *= float(out_y) / y
+    return camera_matrix
+
+
+def output_camera(camera):
+    '''
+    Output resolution and focal lengths (out_x, out_y, f_x, f_y) of the
+    unwarped frames for the camera section of the pipeline config.
+    '''
+
+    K = np.array([[camera['f_x'], 0., camera['c_x']],
+                  [0., camera['f_y'], camera['c_y']],
+                  [0., 0., 1.]])
+    out_x = camera.get('out_x') or camera['x']
+    out_y = camera.get('out_y') or camera['y']
+    camera_matrix = output_camera_matrix(camera['x'], camera['y'], K, camera['d'], out_x, out_y)
+    return out_x, out_y, camera_matrix[0, 0], camera_matrix[1, 1]
+
+
+class Undistortion(object):
+    '''
+    Undistortion engine using compact 16-bit fixed-point remap tables.
+
+    The tables map the output image (optionally at a smaller resolution than
+    the camera) back to the distorted camera image. They are cached on disk,
+    keyed by a hash of the camera matrix, the distortion coefficients and
+    both resolutions, so they only have to be computed once per setup.
+    '''
+
+    # Bump whenever the layout of the cached maps changes
+    _CACHE_VERSION = 1
+
+    def __init__(self, x, y, K, d, out_x=None, out_y=None, cache_dir=None, interpolation=cv2.INTER_LINEAR):
+
+        # Set camera resolution
+        self._x = x
+        self._y = y
+
+        # Set output resolution, defaults to the camera resolution
+        self._out_x = out_x if out_x is not None else x
+        self._out_y = out_y if out_y is not None else y
+
+        # Define camera matrix K and distortion coefficients d
+        self._K = np.asarray(K, dtype='float64')
+        self._d = np.asarray(d, dtype='float64')
+
+        self._interpolation = interpolation
+
+        # Directory to cache the remap tables in, None disables caching
+        self._cache_dir = cache_dir
+
+        # Camera matrix of the undistorted output
+        self._newcameramatrix = output_camera_matrix(self._x, self._y, self._K, self._d, self._out_x, self._out_y)
+
+        # Load or generate the fixed-point LUTs for undistortion
+        self._map1, self._map2 = self._load_maps()
+
+    @property
+    def output_size(self):
+        return self._out_x, self._out_y
+
+    @property
+    def camera_matrix(self):
+        return self._newcameramatrix
+
+    def cache_key(self):
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(self._K).tobytes())
+        digest.update(np.ascontiguousarray(self._d).tobytes())
+        digest.update(np.array([self._x, self._y, self._out_x, self._out_y, self._CACHE_VERSION],
+                               dtype='int64').tobytes())
+        return digest.hexdigest()
+
+    def remap(self, frame, roi=None, dst=None):
+        '''
+        Undistort a frame.
+
+        roi is an optional (x, y, w, h) region in output coordinates, only
+        that region is computed. If dst is given the result is written into
+        it in place: the full output image, or the roi within it.
+        '''
+
+        if roi is None:
+            if dst is None:
+                return cv2.remap(frame, self._map1, self._map2, self._interpolation)
+            cv2.remap(frame, self._map1, self._map2, self._interpolation, dst=dst)
+            return dst
+
+        x0, y0, x1, y1 = self.clip_roi(roi)
+        map1 = self._map1[y0:y1, x0:x1]
+        map2 = self._map2[y0:y1, x0:x1]
+
+        if dst is None:
+            return cv2.remap(frame, map1, map2, self._interpolation)
+
+        # ...remap straight into the region of the output buffer
+        dst_roi = dst[y0:y1, x0:x1]
+        if dst_roi.flags['C_CONTIGUOUS']:
+            cv2.remap(frame, map1, map2, self._interpolation, dst=dst_roi)
+        else:
+            dst_roi[:] = cv2.remap(frame, map1, map2, self._interpolation)
+        return dst
+
+    def clip_roi(self, roi):
+        # Clip an (x, y, w, h) region to the output image, returns corner coordinates
+        x, y, w, h = [int(round(v)) for v in roi]
+        x0 = min(max(x, 0), self._out_x)
+        y0 = min(max(y, 0), self._out_y)
+        x1 = min(max(x + w, x0), self._out_x)
+        y1 = min(max(y + h, y0), self._out_y)
+        return x0, y0, x1, y1
+
+    def _load_maps(self):
+        path = None
+        if self._cache_dir is not None:
+            path = os.path.join(self._cache_dir, 'undistort_' + self.cache_key() + '.npz')
+
+            # ...try to reuse cached maps
+            try:
+                with np.load(path) as cached:
+                    return cached['map1'], cached['map2']
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+        map1, map2 = self._build_maps()
+
+        if path is not None:
+            self._save_maps(path, map1, map2)
+
+        return map1, map2
+
+    def _build_maps(self):
+        # Generate floating point LUTs...
+        mapx, mapy = cv2.initUndistortRectifyMap(self._K, self._d, None, self._newcameramatrix,
+                                                 (self._out_x, self._out_y), cv2.CV_32FC1)
+
+        # ...and convert them to the fixed-point representation, which is
+        # smaller and lets remap interpolate with integer arithmetic
+        return cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
+
+    def _save_maps(self, path, map1, map2):
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+
+            # ...write to a temporary file first so readers never see a partial cache
+            handle, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.npz')
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, map1=map1, map2=map2)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
@@ -1,11 +1,31 @@
+import logging
 import multiprocessing
+import os
+import sys
+import threading
 import time
 
 import cv2
-import sharedmem
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from FrameRing import FrameRing
+from FrameSource import CameraSource
+from RateLimiter import RateLimiter
+from StageStats import StageStats
+from Undistortion import Undistortion, DEFAULT_CACHE_DIR
+
+logger = logging.getLogger('autofan.unwarping')
+
+# Seconds between warnings while the frame ring has no free slot
+_STALL_WARNING_INTERVAL = 5.0
+
 
 class Unwarping(multiprocessing.Process):
-    def __init__(self, x, y, K, d, camid=0, visualize=False, debug=False):
+    def __init__(self, x, y, K, d, camid=0, debug=False, frame_ring=None, ring_slots=4,
+                 out_x=None, out_y=None, map_cache_dir=DEFAULT_CACHE_DIR,
+                 source=None, stats=None):
 
         # Initialize multiprocessing.Process parent
         multiprocessing.Process.__init__(self)
@@ -19,9 +39,6 @@ class Unwarping(multiprocessing.Process):
         # Event that pauses the main loop if set
         self._pause_event = multiprocessing.Event()
 
-        # Defines whether to visualize the camera output
-        self._visualize = visualize
-
         # Switches debugging mode
         self._debug = debug
 
@@ -33,8 +50,14 @@ class Unwarping(multiprocessing.Process):
         self._x = x  # Get width
         self._y = y  # Get height
 
-        # An empty array in shared memory to store the current image frame
-        self._currentframe = sharedmem.empty((y, x), dtype='uint8')
+        # Set output parameters, frames can be unwarped straight into a smaller resolution
+        self._out_x = out_x if out_x is not None else x
+        self._out_y = out_y if out_y is not None else y
+
+        # A ring of frame buffers in shared memory that unwarped frames are written into
+        if frame_ring is None:
+            frame_ring = FrameRing(self._out_x, self._out_y, slots=ring_slots)
+        self._frame_ring = frame_ring
 
         # Define camera matrix K
         self._K = K
@@ -42,39 +65,97 @@ class Unwarping(multiprocessing.Process):
         # Define distortion coefficients d
         self._d = d
 
-        # Setup camera object using OpenCV
-        self._cam = cv2.VideoCapture(self._cam_device_id)
-        self._cam.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, self._x)
-        self._cam.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, self._y)
+        # A stats record in shared memory that is updated every iteration
+        if stats is None:
+            stats = StageStats('unwarping')
+        self._stats = stats
+
+        # Setup the frame source, defaults to the camera
+        if source is None:
+            source = CameraSource(self._cam_device_id, self._x, self._y)
+        self._source = source
 
-        # Generate optimal camera matrix
-        self._newcameramatrix, self._roi = cv2.getOptimalNewCameraMatrix(self._K, self._d, (self._x, self._y), 0)
+        # Optional limit of the rate frames are unwarped at, frames the source delivers in between are skipped
+        self._rate_limiter = RateLimiter()
 
-        # Generate LUTs for undistortion
-        self._mapx, self._mapy = cv2.initUndistortRectifyMap(self._K, self._d, None, self._newcameramatrix,
-                                                             (self._x, self._y), 5)
+        # Fixed-point LUTs for undistortion, loaded or generated by _setup()
+        self._map_cache_dir = map_cache_dir
+        self._undistortion = None
 
     def run(self):
         # Clear events
         self._exit.clear()
 
-        # While exit event is not set...
-        while not self._exit.is_set() or not self._pause_event.is_set():
-            # ...clear new frame event
-            self.newframe_event.clear()
+        self._stats.started()
+
+        # Set up in this process, in parallel with the other stages
+        self._setup()
+        self._stats.ready()
 
-            # ... read a frame from the camera
-            frame = self._cam.read()[1]
+        try:
+            self._loop()
+        finally:
+            # ...release camera, also if it failed, so a replacement stage can open it
+            self._source.release()
 
-            # ...convert camera image to grayscale
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    def _loop(self):
+        # Time of the last warning about a frame ring without a free slot
+        last_stall_warning = 0.0
 
-            # ...remap image into shared memory
-            self._currentframe[:] = cv2.remap(frame, self._mapx, self._mapy, cv2.INTER_LINEAR).copy()
+        # While exit event is not set...
+        while not self._exit.is_set():
+            # ...clear new frame event
+            self.newframe_event.clear()
 
-            if self._visualize:
-                cv2.imshow('Unwarped image', self._currentframe)
-                cv2.waitKey(1)
+            # ...skip frames while paused
+            if self._pause_event.is_set():
+                time.sleep(0.01)
+                continue
+
+            # ... read a frame from the source
+            frame, timestamp = self._source.read()
+
+            # ...stop once a finite source is exhausted, a failing camera raises instead
+            if frame is None:
+                self._exit.set()
+                break
+
+            start = time.time()
+            self._stats.consumed()
+
+            # ...skip frames that arrive faster than the rate limit
+            if not self._rate_limiter.due(timestamp):
+                self._stats.skipped()
+                continue
+
+            # ...convert colour images to grayscale
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+            # ...get a free slot in the frame ring, the frame is lost if consumers hold every slot
+            slot = self._frame_ring.begin_write()
+            if slot is None:
+                self._update_dropped()
+                if time.time() - last_stall_warning >= _STALL_WARNING_INTERVAL:
+                    logger.warning('no free slot in the frame ring, %d frames lost so far',
+                                   self._frame_ring.stalled())
+                    last_stall_warning = time.time()
+                continue
+
+            # ...remap image (or only the region a consumer asked for) in place into the slot and publish it
+            # together with the region it holds
+            region = None
+            roi = self._frame_ring.requested_region()
+            if roi is not None:
+                x0, y0, x1, y1 = self._undistortion.clip_roi(roi)
+                if x1 > x0 and y1 > y0:
+                    region = (x0, y0, x1 - x0, y1 - y0)
+            self._undistortion.remap(frame, roi=region, dst=self._frame_ring.frame(slot))
+            self._frame_ring.commit(slot, timestamp, region)
+
+            self._stats.iteration(time.time() - start)
+            self._update_dropped()
+            self._stats.output()
 
             if self._debug:
                 print str(1 / (time.time() - self._oldtime)) + " frames/sec"
@@ -83,22 +164,61 @@ class Unwarping(multiprocessing.Process):
             # Set new frame event
             self.newframe_event.set()
 
-        # If exit event set...
-        if self._exit_event.is_set():
-            # ...release camera
-            self._cam.release()
-            # ...close windows
-            cv2.destroyAllWindows()
+    def _update_dropped(self):
+        # Frames overwritten unseen, lost for a free slot and skipped by the source to stay current
+        self._stats.set_dropped(self._frame_ring.dropped() + self._frame_ring.stalled() +
+                                getattr(self._source, 'skipped', 0))
+
+    def _setup(self):
+        # Load or generate fixed-point LUTs for undistortion and open the source, both at the same time
+        opener = threading.Thread(target=self._source.open)
+        opener.start()
+        if self._undistortion is None:
+            self._undistortion = Undistortion(self._x, self._y, self._K, self._d,
+                                              self._out_x, self._out_y, cache_dir=self._map_cache_dir)
+        opener.join()
 
     def terminate(self):
         # Set exit event
         self._exit.set()
 
+    def release(self):
+        # Release the frame source held by the calling process, e.g. before replacing a crashed stage
+        self._source.release()
+
     def get_current_frame(self):
-        return self._currentframe
+        # A copy of the newest frame, taken while its slot is held so it cannot be overwritten, None before the first
+        slot = self._frame_ring.acquire_latest(timeout=0)
+        if slot is None:
+            return None
+        try:
+            # ...black outside the region that was unwarped, the slot holds older frames there
+            x, y, w, h = self._frame_ring.region(slot)
+            frame = np.zeros(self._frame_ring.shape, dtype=self._frame_ring.frame(slot).dtype)
+            frame[y:y + h, x:x + w] = self._frame_ring.frame(slot)[y:y + h, x:x + w]
+            return frame
+        finally:
+            self._frame_ring.release(slot)
+
+    def set_roi(self, roi):
+        # Only unwarp an (x, y, w, h) region of the next frames, None for whole frames, see FrameRing.request_region()
+        self._frame_ring.request_region(roi)
+
+    def set_rate(self, rate):
+        # Limit the rate frames are unwarped at in Hz, None for as fast as the source delivers them
+        self._rate_limiter.set_rate(rate)
+
+    def get_rate(self):
+        return self._rate_limiter.get_rate()
+
+    def get_frame_ring(self):
+        return self._frame_ring
+
+    def get_dropped_frames(self):
+        return self._frame_ring.dropped()
 
 if __name__ == '__main__':
-    import numpy as np
+    from FrameSource import open_source
 
     # width and height of camera image
     x = 320
@@ -117,5 +237,15 @@ if __name__ == '__main__':
                   [0., f_y, c_y],
                   [0., 0., 1.]])
 
-    unwarper = Unwarping(x, y, K, d, visualize=True, debug=True)
-    unwarper.start()
\ No newline at end of file
+    # Read from the camera, or from the video file, image directory or "synthetic" given as first argument
+    source = open_source(sys.argv[1] if len(sys.argv) > 1 else 0, x, y, latest_frame=True)
+
+    unwarper = Unwarping(x, y, K, d, debug=True, source=source)
+    unwarper.start()
+
+    # Show the unwarped frames in a process of their own
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'visualization'))
+    from DebugView import DebugView
+
+    debug_view = DebugView(unwarper.get_frame_ring())
+    debug_view.start()
\ No newline at end of file
@@ -0,0 +1,256 @@
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'face_to_position'))
+
+from Geometry import face_geometry
+from Records import (ANGLE_HORIZONTAL, ANGLE_VERTICAL, BLINK_CLOSED, BLINK_OPENNESS,
+                     FACE_H, FACE_MODE, FACE_TIMESTAMP, FACE_W, FACE_X, FACE_Y)
+from StageStats import StageStats
+
+# Colours (BGR)
+_WHITE = (255, 255, 255)
+_RED = (0, 0, 255)
+_GREEN = (0, 255, 0)
+_YELLOW = (0, 255, 255)
+
+# Names of the face detection modes, see FaceDetection.MODE_*
+_MODES = {0: 'none', 1: 'full', 2: 'track', 3: 'reuse', 4: 'template'}
+
+# Visible area of the geometry views in mm: (left, right, top, bottom)
+_TOP_VIEW = (1000, -1000, -300, 1500)
+_SIDE_VIEW = (-300, 1200, 500, -500)
+
+
+class DebugView(multiprocessing.Process):
+    '''
+    Debug view of the running pipeline in a process of its own.
+
+    It peeks at the newest frame, face and angles in shared memory at a
+    capped rate and draws the face overlay and the top and side views of
+    the geometry on its own copies, so the pipeline stages never spend time
+    on rendering. The view is shown in a window and/or written to a video
+    file.
+    '''
+
+    def __init__(self, frame_ring, face_record=None, angle_record=None, blink_record=None,
+                 face_width=150.0, f_x=None, f_y=None, fan_position=None,
+                 max_rate=10.0, show=True, video_file=None, codec='MJPG', stats=None):
+
+        # Initialize multiprocessing.Process parent
+        multiprocessing.Process.__init__(self)
+
+        # Exit event for stopping process
+        self._exit = multiprocessing.Event()
+
+        # Inputs, all optional except the frames
+        self._frame_ring = frame_ring
+        self._face_record = face_record
+        self._angle_record = angle_record
+        self._blink_record = blink_record
+
+        # Camera and fan parameters for the geometry views, which are only drawn if all are set
+        self._res_y, self._res_x = frame_ring.shape
+        self._facewidth = face_width
+        self._f_x = f_x
+        self._f_y = f_y
+        self._fan_position = fan_position
+
+        # Refresh rate cap in frames per second
+        self._period = 1.0 / max_rate
+
+        # Outputs
+        self._show = show
+        self._video_file = video_file
+        self._codec = codec
+
+        # A stats record in shared memory that is updated every drawn frame
+        if stats is None:
+            stats = StageStats('debug_view')
+        self._stats = stats
+
+    def run(self):
+        # Clear events
+        self._exit.clear()
+
+        self._stats.started()
+        self._stats.ready()
+
+        writer = None
+        next_time = time.time()
+
+        # Sequence number of the last frame drawn
+        last_sequence = 0
+
+        # While exit event is not set...
+        while not self._exit.is_set():
+            # ...keep to the rate cap
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_time = max(next_time + self._period, time.time())
+
+            # ...copy the newest frame and let go of the slot right away
+            slot = self._frame_ring.acquire_latest(timeout=0.1)
+            if slot is None:
+                continue
+            try:
+                # ...count frames published since the last one drawn, the rate cap skips most of them
+                sequence = self._frame_ring.sequence(slot)
+                if last_sequence:
+                    self._stats.skipped(max(sequence - last_sequence - 1, 0))
+                self._stats.consumed()
+                last_sequence = sequence
+
+                start = time.time()
+
+                # ...grey outside the region that was unwarped, the slot holds older frames there
+                x, y, w, h = self._frame_ring.region(slot)
+                frame = np.full((self._res_y, self._res_x, 3), 64, dtype='uint8')
+                frame[y:y + h, x:x + w] = cv2.cvtColor(self._frame_ring.frame(slot)[y:y + h, x:x + w],
+                                                       cv2.COLOR_GRAY2BGR)
+                timestamp = self._frame_ring.timestamp(slot)
+            finally:
+                self._frame_ring.release(slot)
+
+            view = self.render(frame, timestamp)
+
+            if self._video_file is not None:
+                if writer is None:
+                    writer = cv2.VideoWriter(self._video_file, cv2.cv.CV_FOURCC(*self._codec),
+                                             1.0 / self._period, (view.shape[1], view.shape[0]))
+                writer.write(view)
+
+            if self._show:
+                cv2.imshow('AutoFan', view)
+                cv2.waitKey(1)
+
+            self._stats.iteration(time.time() - start)
+            self._stats.output()
+            self._stats.latency(time.time() - timestamp)
+
+        # If exit event set...
+        if writer is not None:
+            writer.release()
+        if self._show:
+            cv2.destroyAllWindows()
+
+    def render(self, frame, timestamp):
+        '''
+        Draw the overlays onto a BGR copy of a frame and put the geometry
+        views next to it.
+        '''
+
+        if self._face_record is None:
+            return frame
+
+        face = self._face_record.read()[0]
+        angles = self._angle_record.read()[0] if self._angle_record is not None else None
+
+        # ...face box and detection mode
+        if face[FACE_W] > 0:
+            x, y, w, h = [int(v) for v in face[[FACE_X, FACE_Y, FACE_W, FACE_H]]]
+            cv2.rectangle(frame, (x, y), (x + w, y + h), _GREEN, 2)
+        text = 'face %s, %.0f ms old' % (_MODES.get(int(face[FACE_MODE]), '?'),
+                                         (timestamp - face[FACE_TIMESTAMP]) * 1000.0)
+        if angles is not None:
+            text += ', fan %.1f / %.1f deg' % (angles[ANGLE_HORIZONTAL], angles[ANGLE_VERTICAL])
+        cv2.putText(frame, text, (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, _YELLOW)
+
+        # ...eye state
+        if self._blink_record is not None:
+            blink = self._blink_record.read()[0]
+            cv2.putText(frame, 'eyes %s, openness %.2f' % ('closed' if blink[BLINK_CLOSED] else 'open',
+                                                            blink[BLINK_OPENNESS]),
+                        (5, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.4, _YELLOW)
+
+        if self._fan_position is None or self._f_x is None or self._f_y is None:
+            return frame
+
+        # ...geometry views stacked to the right of the frame
+        height = frame.shape[0] // 2
+        width = height * 3 // 2
+        top, side = self._geometry_views(face, angles, width, height)
+        return np.hstack((frame, np.vstack((top, side, np.zeros((frame.shape[0] - 2 * height, width, 3),
+                                                                 dtype=frame.dtype)))))
+
+    def _geometry_views(self, face, angles, width, height):
+        fan = self._fan_position
+        top = _Canvas(width, height, _TOP_VIEW, 'top view')
+        side = _Canvas(width, height, _SIDE_VIEW, 'side view')
+
+        top.point(0, 0, _WHITE, 'cam')
+        top.point(fan[0], fan[1], _GREEN, 'fan')
+        side.point(0, 0, _WHITE, 'cam')
+        side.point(fan[1], fan[2], _GREEN, 'fan')
+
+        if face[FACE_W] <= 0:
+            return top.image, side.image
+
+        horizontal, vertical = face_geometry(face[FACE_X], face[FACE_Y], face[FACE_W], face[FACE_H],
+                                             self._facewidth, self._res_x, self._res_y,
+                                             self._f_x, self._f_y, fan)
+        a1_horizontal, b1_horizontal, c2_horizontal, alpha_horizontal = [float(v) for v in horizontal]
+        a1_vertical, b1_vertical, c2_vertical, alpha_vertical = [float(v) for v in vertical]
+
+        # ...point the fan along the published angles, they are what the servos get
+        if angles is not None:
+            alpha_horizontal = np.radians(angles[ANGLE_HORIZONTAL])
+            alpha_vertical = np.radians(angles[ANGLE_VERTICAL])
+
+        if np.isfinite(a1_horizontal) and np.isfinite(b1_horizontal):
+            top.point(a1_horizontal, b1_horizontal, _RED, 'face')
+        if np.isfinite(c2_horizontal):
+            top.line(fan[0], fan[1],
+                     fan[0] + c2_horizontal * np.cos(np.pi / 2 + alpha_horizontal),
+                     fan[1] + c2_horizontal * np.sin(np.pi / 2 + alpha_horizontal), _YELLOW)
+
+        if np.isfinite(a1_vertical) and np.isfinite(b1_vertical):
+            side.point(b1_vertical, a1_vertical, _RED, 'face')
+        if np.isfinite(c2_vertical):
+            side.line(fan[1], fan[2],
+                      fan[1] + c2_vertical * np.sin(np.pi / 2 + alpha_vertical),
+                      fan[2] + c2_vertical * np.cos(np.pi / 2 + alpha_vertical), _YELLOW)
+
+        return top.image, side.image
+
+    def terminate(self):
+        # Set exit event
+        self._exit.set()
+
+
+class _Canvas(object):
+    # An image showing an area given in mm with equal scale on both axes
+
+    def __init__(self, width, height, area, title):
+        self.image = np.zeros((height, width, 3), dtype='uint8')
+        left, right, top, bottom = area
+        self._scale = min(width / float(abs(right - left)), height / float(abs(bottom - top)))
+
+        # ...direction of each axis and the offsets that centre the area
+        self._sign_x = 1 if right > left else -1
+        self._sign_y = 1 if bottom > top else -1
+        self._left = left - self._sign_x * (width / self._scale - abs(right - left)) / 2.0
+        self._top = top - self._sign_y * (height / self._scale - abs(bottom - top)) / 2.0
+
+        cv2.rectangle(self.image, (0, 0), (width - 1, height - 1), _WHITE, 1)
+        cv2.putText(self.image, title, (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, _WHITE)
+
+    def pixel(self, x, y):
+        return (int(round(self._sign_x * (x - self._left) * self._scale)),
+                int(round(self._sign_y * (y - self._top) * self._scale)))
+
+    def point(self, x, y, colour, label=None):
+        center = self.pixel(x, y)
+        cv2.circle(self.image, center, 4, colour, -1)
+        if label is not None:
+            cv2.putText(self.image, label, (center[0] - 10, center[1] - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.35, colour)
+
+    def line(self, x0, y0, x1, y1, colour):
+        cv2.line(self.image, self.pixel(x0, y0), self.pixel(x1, y1), colour, 1)